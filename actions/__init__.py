@@ -1,13 +1,16 @@
-from .base import Action
+from .base import Action, ActionResult
 from .review_code import ReviewCodeAction
 from .review_format import ReviewFormatAction
 from .label import LabelAction
 from .summarize import SummarizeAction
+from .fused import FusedAction
 
 __all__ = [
     "Action",
+    "ActionResult",
     "ReviewCodeAction",
     "ReviewFormatAction",
     "LabelAction",
     "SummarizeAction",
+    "FusedAction",
 ]
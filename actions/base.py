@@ -1,17 +1,40 @@
+import asyncio
+import threading
 from abc import ABC, abstractmethod
+from colorama import Fore, Style
+from pydantic import BaseModel
 from providers import LLMProvider, CompletionResponse
-from repository.code_request import CodeRequest
+from repository.code_request import CodeRequest, CodeChange
 from repository.base import Repository
 from rules import Rule
-from typing import List
+from typing import ContextManager, List, Optional, Type
+from metrics import get_metrics
+from .budget import RESPONSE_TOKENS, SUFFIX_TOKENS, PromptPlan, plan_prompt
+from .prompts import Prompt, render_prefix, shared_prefix
+
+# Errors of a completion itself, handling the same completion again gives them again
+NO_RESPONSE = "No response received from LLM provider"
+UNPARSEABLE = "Could not parse the response"
 
 
 class ActionResult:
-    def __init__(self, tokens_used: int):
+    def __init__(self, tokens_used: int, error: Optional[str] = None):
         self.tokens_used = tokens_used
+        # Why the action failed, None if it completed
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
 
 
 class Action(ABC):
+    # Name of the action in metrics
+    name: str = ""
+
+    # Model of the response, for providers that can constrain it to a schema
+    schema: Optional[Type[BaseModel]] = None
+
     def __init__(
         self,
         provider: LLMProvider,
@@ -23,14 +46,157 @@ class Action(ABC):
         self.repository = repository
         self.rules = rules
         self.verbose = verbose
+        # Tokens of the completions received, kept when the action fails later
+        self.tokens_used = 0
+        self._tokens_lock = threading.Lock()
+
+    @abstractmethod
+    def build_prompt(self, cr: CodeRequest) -> Prompt:
+        """Build the prompt sent to the LLM for the given code request."""
 
     @abstractmethod
+    def process_result(
+        self,
+        cr: CodeRequest,
+        result: CompletionResponse,
+        post: bool = False,
+    ) -> ActionResult:
+        """Parse the LLM response and optionally post it to the code request.
+
+        Args:
+            cr: The code request the prompt was built for
+            result: The completion returned by the provider
+            post: Whether to post the results to the code request
+
+        Returns:
+            The result of the action
+        """
+
     def run(self, cr: CodeRequest, post: bool = False) -> ActionResult:
         """Execute the action on the given code request.
 
         Args:
             cr: The code request to process
+            post: Whether to post the results to the code request
+
+        Returns:
+            The result of the action
+        """
+        with self.timer("prompt"):
+            prompt = self.build_prompt(cr)
+        self.log_prompt(prompt.text)
+
+        with self.timer("llm"):
+            result = self.provider.completion(
+                prompt.suffix, prefix=prompt.prefix, schema=self.response_schema()
+            )
+        if result is None:
+            return self.no_response()
+        self.add_tokens(result.tokens_used)
+
+        return self.process_result(cr, result, post)
+
+    async def arun(self, cr: CodeRequest, post: bool = False) -> ActionResult:
+        """Execute the action without blocking the event loop.
+
+        The completion uses the provider's native async client while parsing
+        and posting, which talk to the repository synchronously, are offloaded
+        to a worker thread.
+        """
+        with self.timer("prompt"):
+            prompt = self.build_prompt(cr)
+        self.log_prompt(prompt.text)
+
+        with self.timer("llm"):
+            result = await self.provider.acompletion(
+                prompt.suffix, prefix=prompt.prefix, schema=self.response_schema()
+            )
+        if result is None:
+            return self.no_response()
+        self.add_tokens(result.tokens_used)
+
+        return await asyncio.to_thread(self.process_result, cr, result, post)
+
+    def add_tokens(self, tokens: int) -> None:
+        """Count the tokens of a completion received by the action."""
+        with self._tokens_lock:
+            self.tokens_used += tokens
+
+    def response_schema(self) -> Optional[Type[BaseModel]]:
+        """Schema to ask the provider for, None to parse its text instead."""
+        return self.schema if self.provider.structured_output else None
+
+    def cached_prompt(self, cr: CodeRequest, suffix: str) -> Prompt:
+        """Build a prompt with the changes that fit before the action suffix.
+
+        The changes are selected leaving SUFFIX_TOKENS for the suffix,
+        whatever the suffix is, so the prefix is the same for every action
+        and providers reuse it from their cache across actions. It is built
+        once per code request. A suffix longer than SUFFIX_TOKENS gets a
+        prefix of its own.
+        """
+        counter = self.provider.token_counter
+        if counter.count(suffix) > SUFFIX_TOKENS:
+            plan = self.plan_changes(cr.changes, render_prefix(cr, []) + suffix)
+            return Prompt(render_prefix(cr, plan.changes), suffix)
+
+        def build() -> str:
+            budget = (
+                self.provider.max_tokens
+                - RESPONSE_TOKENS
+                - SUFFIX_TOKENS
+                - counter.count(render_prefix(cr, []))
+            )
+            plan = self.plan_changes(cr.changes, "", budget=budget)
+            return render_prefix(cr, plan.changes)
+
+        return Prompt(shared_prefix(cr, self.provider.max_tokens, build), suffix)
+
+    def plan_changes(
+        self,
+        changes: List[CodeChange],
+        prompt: str,
+        budget: Optional[int] = None,
+        degrade: bool = True,
+    ) -> PromptPlan:
+        """Select the most valuable changes that fit in the prompt.
+
+        Args:
+            changes: The candidate changes
+            prompt: The rest of the prompt, without the changes
+            budget: Tokens available for the changes, defaults to what is left
+                of the provider context window
+            degrade: Whether changes that don't fit are sent as stat lines
 
         Returns:
-            The result of the action as a CompletionResponse
+            The plan with the changes to send
         """
+        counter = self.provider.token_counter
+        if budget is None:
+            budget = self.provider.max_tokens - RESPONSE_TOKENS - counter.count(prompt)
+
+        if budget <= 0:
+            raise ValueError("Code request is too long to review")
+
+        plan = plan_prompt(changes, budget, counter, self.rules, degrade)
+        plan.report()
+        return plan
+
+    def timer(self, phase: str) -> ContextManager[None]:
+        """Time a phase of the action: prompt, llm, parse or post."""
+        return get_metrics().phase(self.name, phase)
+
+    def no_response(self) -> ActionResult:
+        print(f"{Fore.RED}Error: {NO_RESPONSE}{Style.RESET_ALL}")
+        return ActionResult(0, NO_RESPONSE)
+
+    def log_prompt(self, prompt: str) -> None:
+        if self.verbose:
+            print(f"\n{Fore.GREEN}Prompt sent to LLM:{Style.RESET_ALL}")
+            print(f"{Fore.GREEN}{prompt}{Style.RESET_ALL}\n")
+
+    def log_response(self, text: str, tokens_used: int) -> None:
+        if self.verbose:
+            print(f"\n{Fore.YELLOW}Response from LLM:{Style.RESET_ALL}")
+            print(f"{Fore.YELLOW}{text}{Style.RESET_ALL}\n")
+            print(f"{Fore.YELLOW}Tokens used: {tokens_used}{Style.RESET_ALL}\n")
@@ -0,0 +1,165 @@
+import math
+import re
+from dataclasses import dataclass, field
+from typing import List, Sequence, Tuple
+from colorama import Fore, Style
+from repository import CodeChange, TokenCounter, hunk_lines
+from rules import Rule
+
+# Tokens reserved in the context window for the response
+RESPONSE_TOKENS = 4096
+
+# Tokens reserved in the context window for the suffix of the actions, the
+# rules and instructions after the shared prefix, so that the changes in the
+# prefix don't depend on the action
+SUFFIX_TOKENS = 4096
+
+TEST_PATTERN = re.compile(
+    r"(^|/)(tests?|__tests__|spec)/|(^|/)test_[^/]*$|_test\.\w+$|\.(test|spec)\.\w+$"
+)
+GENERATED_PATTERN = re.compile(
+    r"(^|/)(dist|build|vendor|node_modules|generated)/|\.min\.(js|css)$|"
+    r"_pb2(_grpc)?\.py$|\.pb\.go$|\.snap$|\.lock$|(^|/)package-lock\.json$"
+)
+DOCS_PATTERN = re.compile(r"\.(md|rst|txt)$|(^|/)docs?/")
+
+
+def change_stats(change: CodeChange) -> Tuple[int, int]:
+    """Return the number of lines added and removed by a change."""
+    added = removed = 0
+    for line in hunk_lines(change.diff):
+        if line.startswith("+"):
+            added += 1
+        elif line.startswith("-"):
+            removed += 1
+    return added, removed
+
+
+def stat_line(change: CodeChange) -> str:
+    added, removed = change_stats(change)
+    return f"(diff omitted to fit the prompt: +{added} -{removed} lines)\n"
+
+
+def change_value(change: CodeChange, rules: Sequence[Rule] = ()) -> float:
+    """Estimate how valuable it is to send a change to the LLM.
+
+    Source files are worth more than tests, docs and generated files, bigger
+    changes are worth more than small ones and files targeted by a rule are
+    worth more than the rest.
+    """
+    path = change.path
+    if GENERATED_PATTERN.search(path):
+        value = 0.1
+    elif TEST_PATTERN.search(path):
+        value = 0.6
+    elif DOCS_PATTERN.search(path):
+        value = 0.5
+    else:
+        value = 1.0
+
+    added, removed = change_stats(change)
+    value *= 1 + math.log1p(added + removed)
+
+    for rule in rules:
+        if rule.patterns and rule.applies_to(path):
+            value *= 1.5
+            break
+
+    return value
+
+
+@dataclass
+class PromptPlan:
+    """Changes selected to fit a prompt in a token budget."""
+
+    # Changes to send, in their original order. Degraded changes have their
+    # diff replaced by a stat line.
+    changes: List[CodeChange] = field(default_factory=list)
+    # Index in the original list of every change to send
+    indexes: List[int] = field(default_factory=list)
+    degraded: List[CodeChange] = field(default_factory=list)
+    omitted: List[CodeChange] = field(default_factory=list)
+    tokens: int = 0
+
+    def report(self) -> None:
+        """Print the changes that didn't fit in the prompt."""
+        if self.degraded:
+            print(
+                f"{Fore.RED}Sent {len(self.degraded)} changes as stats only because they exceed the token limit: "
+                f"{', '.join(change.path for change in self.degraded)}{Style.RESET_ALL}"
+            )
+        if self.omitted:
+            print(
+                f"{Fore.RED}Skipped {len(self.omitted)} changes because they exceed the token limit: "
+                f"{', '.join(change.path for change in self.omitted)}{Style.RESET_ALL}"
+            )
+
+
+def plan_prompt(
+    changes: List[CodeChange],
+    budget: int,
+    counter: TokenCounter,
+    rules: Sequence[Rule] = (),
+    degrade: bool = True,
+) -> PromptPlan:
+    """Select the most valuable changes that fit in a token budget.
+
+    Every change first gets a cheap stat line, dropping the least valuable
+    ones if not even those fit. The remaining budget is then spent upgrading
+    stat lines to full diffs by value per token, a greedy approximation of
+    the knapsack problem.
+
+    Args:
+        changes: The candidate changes
+        budget: Tokens available for the changes
+        counter: Token counter of the target model
+        rules: Rules used to weight the changes they apply to
+        degrade: Whether changes that don't fit are sent as stat lines, if not
+            they are omitted
+
+    Returns:
+        The plan with the changes to send and the ones degraded or omitted
+    """
+    full_tokens = counter.count_changes(changes)
+    values = [change_value(change, rules) for change in changes]
+
+    if degrade:
+        stats = [stat_line(change) for change in changes]
+        stat_tokens = counter.count_batch(
+            [change.path + stat for change, stat in zip(changes, stats)]
+        )
+    else:
+        stats = [""] * len(changes)
+        stat_tokens = [0] * len(changes)
+
+    # Reserve the stat lines, most valuable first
+    selected = set()
+    used = 0
+    for i in sorted(range(len(changes)), key=lambda i: -values[i]):
+        if used + stat_tokens[i] <= budget:
+            selected.add(i)
+            used += stat_tokens[i]
+
+    # Upgrade to full diffs by value density
+    full = set()
+    for i in sorted(
+        selected, key=lambda i: -values[i] / max(full_tokens[i] - stat_tokens[i], 1)
+    ):
+        extra = full_tokens[i] - stat_tokens[i]
+        if used + extra <= budget:
+            full.add(i)
+            used += extra
+
+    plan = PromptPlan(tokens=used)
+    for i, change in enumerate(changes):
+        if i in full:
+            plan.changes.append(change)
+            plan.indexes.append(i)
+        elif i in selected and degrade:
+            plan.changes.append(change.with_diff(stats[i]))
+            plan.indexes.append(i)
+            plan.degraded.append(change)
+        else:
+            plan.omitted.append(change)
+
+    return plan
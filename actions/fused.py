@@ -0,0 +1,205 @@
+from .base import UNPARSEABLE, Action, ActionResult
+from .label import LabelAction
+from .prompts import Prompt
+from .review_format import ReviewFormatAction, RuleResult
+from .summarize import SummarizeAction
+from providers import LLMProvider, CompletionResponse, parse_json
+from repository import CodeRequest, Repository
+from colorama import Fore, Style
+from pydantic import ValidationError, create_model
+from rules import Rule
+from typing import Any, Dict, List, Optional
+
+PROMPT = """Perform the tasks below on the merge request above.
+{rules}
+{tasks}
+Return the results of all the tasks in a single JSON object:
+```json
+{{
+{keys}
+}}
+```
+"""
+
+RULES = """
+=== Rules ===
+{rules_text}
+"""
+
+SUMMARY_TASK = """=== Summary ===
+Summarize the code changes according to the rules above. Provide a concise summary in markdown that:
+1. Captures the main purpose of the changes
+2. Highlights key technical decisions
+3. Notes any significant impacts or considerations
+"""
+
+LABELS_TASK = """=== Labels ===
+Based on the rules above, suggest a list of labels that would be appropriate for this merge request.
+{label_instructions}
+"""
+
+FORMAT_TASK = """=== Format ===
+Review the structure and format of the merge request according to the following rules:
+{rules_text}
+
+For each of these rules report its title, whether it passed or failed and explain why.
+"""
+
+# Key of the result of every action in the response, with its example
+KEYS = {
+    "summarize": ("summary", '"summary": "the summary in markdown"'),
+    "label": ("labels", '"labels": ["label", ...]'),
+    "review_format": (
+        "format",
+        '"format": [{"rule_title": str, "result": "passed" or "failed", "explanation": str}, ...]',
+    ),
+}
+
+
+class FusedAction(Action):
+    """Run summarize, label and review_format with a single prompt.
+
+    The merge request and its changes are sent once instead of once per
+    action, and the response has the result of every action under its own
+    key. The results are posted by the actions as if they had run alone.
+    """
+
+    name = "fused"
+
+    def __init__(
+        self,
+        provider: LLMProvider,
+        repository: Repository,
+        rules: List[Rule],
+        verbose: bool = False,
+        actions: Optional[List[Action]] = None,
+    ):
+        super().__init__(provider, repository, rules, verbose)
+        self.actions = actions or [
+            SummarizeAction(provider, repository, rules, verbose),
+            LabelAction(provider, repository, rules, verbose),
+            ReviewFormatAction(provider, repository, rules, verbose),
+        ]
+        for action in self.actions:
+            if action.name not in KEYS:
+                raise ValueError(f"Action '{action.name}' can't be fused")
+
+        fields: Dict[str, Any] = {}
+        for action in self.actions:
+            key = KEYS[action.name][0]
+            if isinstance(action, SummarizeAction):
+                fields[key] = (str, ...)
+            elif isinstance(action, LabelAction):
+                fields[key] = (List[str], ...)
+            else:
+                fields[key] = (List[RuleResult], ...)
+        self.schema = create_model(
+            "FusedReview", __doc__="The results of every task.", **fields
+        )
+
+    def build_prompt(self, cr: CodeRequest) -> Prompt:
+        rules = ""
+        tasks = []
+        for action in self.actions:
+            if isinstance(action, SummarizeAction):
+                tasks.append(SUMMARY_TASK)
+            elif isinstance(action, LabelAction):
+                tasks.append(
+                    LABELS_TASK.format(label_instructions=action.label_instructions())
+                )
+            elif isinstance(action, ReviewFormatAction):
+                rules_text = "\n".join(
+                    f"- {rule.content}" for rule in action.selected_rules()
+                )
+                tasks.append(FORMAT_TASK.format(rules_text=rules_text))
+
+        # Summary and labels follow all the rules, list them once for both
+        if any(isinstance(a, (SummarizeAction, LabelAction)) for a in self.actions):
+            rules = RULES.format(
+                rules_text="\n".join(f"- {rule.content}" for rule in self.rules)
+            )
+
+        keys = ",\n".join(f"    {KEYS[action.name][1]}" for action in self.actions)
+        return self.cached_prompt(
+            cr, PROMPT.format(rules=rules, tasks="\n".join(tasks), keys=keys)
+        )
+
+    def process_result(
+        self, cr: CodeRequest, result: CompletionResponse, post: bool = False
+    ) -> ActionResult:
+        self.log_response(result.text, result.tokens_used)
+
+        with self.timer("parse"):
+            results = self.parse_results(result.text)
+        if results is None:
+            return ActionResult(result.tokens_used, UNPARSEABLE)
+
+        if post:
+            with self.timer("post"):
+                self.post_result(cr, results)
+
+        return ActionResult(result.tokens_used)
+
+    def parse_results(self, text: str) -> Optional[Dict[str, Any]]:
+        """Parse the result of every action, by action name.
+
+        Results missing or invalid in the response are left out, the others
+        are still returned.
+
+        Returns:
+            The results, or None if the response is not a JSON object
+        """
+        try:
+            review = self.schema.model_validate_json(text)
+            return {
+                action.name: getattr(review, KEYS[action.name][0])
+                for action in self.actions
+            }
+        except ValidationError:
+            pass
+
+        try:
+            parsed = parse_json(text)
+        except Exception as e:
+            print(
+                f"{Fore.RED}Error: Could not parse JSON response: {e}{Style.RESET_ALL}"
+            )
+            return None
+
+        if not isinstance(parsed, dict):
+            print(f"{Fore.RED}Error: Could not parse JSON response{Style.RESET_ALL}")
+            return None
+
+        results: Dict[str, Any] = {}
+        for action in self.actions:
+            key = KEYS[action.name][0]
+            value = parsed.get(key)
+            if isinstance(action, ReviewFormatAction):
+                value = action.validate_results(value)
+            elif isinstance(action, LabelAction):
+                if isinstance(value, str):
+                    value = value.split(",")
+                if isinstance(value, list):
+                    value = [str(label).strip() for label in value if label]
+            elif not isinstance(value, str):
+                value = None
+
+            if value is None:
+                print(
+                    f"{Fore.RED}Error: No valid {key} in the response{Style.RESET_ALL}"
+                )
+                continue
+            results[action.name] = value
+        return results
+
+    def post_result(self, cr: CodeRequest, results: Dict[str, Any]) -> None:
+        """Post the result of every action like the action itself does."""
+        for action in self.actions:
+            if action.name not in results:
+                continue
+            try:
+                action.post_result(cr, results[action.name])
+            except Exception as e:
+                print(
+                    f"{Fore.RED}Error posting the result of {action.name}: {e}{Style.RESET_ALL}"
+                )
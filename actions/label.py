@@ -1,27 +1,20 @@
 from .base import Action
-from providers import LLMProvider, stringify_code_changes
+from providers import LLMProvider, CompletionResponse
 from repository import CodeRequest, Repository
 from colorama import Fore, Style
 from rules import Rule
 from actions.base import ActionResult
+from actions.prompts import Prompt
 from typing import List
 import os
 
 CUSTOM_LABELS = [label for label in os.getenv("CUSTOM_LABELS", "").split(",") if label]
 
-PROMPT = """Based on the following pull request and rules, suggest appropriate labels:
+PROMPT = """Based on the pull request above and the following rules, suggest appropriate labels:
 
 Rules:
 {rules_text}
 
-Title: {pr.title}
-
-Description:
-{pr.description}
-
-Changes:
-{changes_text}
-
 Please suggest a list of labels that would be appropriate for this pull request.
 {label_instructions}
 
@@ -40,6 +33,8 @@ Select all appropriate labels from this list that apply to the changes."""
 
 
 class LabelAction(Action):
+    name = "label"
+
     def __init__(
         self,
         provider: LLMProvider,
@@ -49,38 +44,33 @@ class LabelAction(Action):
     ):
         super().__init__(provider, repository, rules, verbose)
 
-    def run(self, pr: CodeRequest, post: bool = False) -> ActionResult:
+    def build_prompt(self, pr: CodeRequest) -> Prompt:
         rules_text = "\n".join(f"- {rule.content}" for rule in self.rules)
-        changes_text = stringify_code_changes(pr.changes)
 
-        # Choose instructions based on whether custom labels are provided
-        if CUSTOM_LABELS:
-            label_instructions = CUSTOM_INSTRUCTIONS.format(", ".join(CUSTOM_LABELS))
-        else:
-            label_instructions = DEFAULT_INSTRUCTIONS
-
-        prompt = PROMPT.format(
-            rules_text=rules_text,
-            pr=pr,
-            changes_text=changes_text,
-            label_instructions=label_instructions,
+        return self.cached_prompt(
+            pr,
+            PROMPT.format(
+                rules_text=rules_text, label_instructions=self.label_instructions()
+            ),
         )
 
-        if self.verbose:
-            print(f"\n{Fore.GREEN}Prompt sent to LLM:{Style.RESET_ALL}")
-            print(f"{Fore.GREEN}{prompt}{Style.RESET_ALL}\n")
-
-        result = self.provider.completion(prompt)
+    def label_instructions(self) -> str:
+        # Choose instructions based on whether custom labels are provided
+        if CUSTOM_LABELS:
+            return CUSTOM_INSTRUCTIONS.format(", ".join(CUSTOM_LABELS))
+        return DEFAULT_INSTRUCTIONS
 
-        labels = result.text.split(",")
+    def process_result(
+        self, pr: CodeRequest, result: CompletionResponse, post: bool = False
+    ) -> ActionResult:
+        with self.timer("parse"):
+            labels = result.text.split(",")
 
-        if self.verbose:
-            print(f"\n{Fore.YELLOW}Response from LLM:{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}{labels}{Style.RESET_ALL}\n")
-            print(f"{Fore.YELLOW}Tokens used: {result.tokens_used}{Style.RESET_ALL}\n")
+        self.log_response(str(labels), result.tokens_used)
 
         if post:
-            self.post_result(pr, labels)
+            with self.timer("post"):
+                self.post_result(pr, labels)
 
         return ActionResult(result.tokens_used)
 
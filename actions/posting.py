@@ -0,0 +1,151 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from repository import CodeRequest, Repository
+
+# Maximum number of discussions posted at the same time
+POST_CONCURRENCY = int(os.getenv("POST_CONCURRENCY", "4"))
+
+Fingerprint = Tuple[Optional[str], Optional[int], str]
+
+
+def normalize(text: str) -> str:
+    """Normalize a comment so that formatting changes don't make it unique."""
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def fingerprint(path: Optional[str], line: Any, text: str) -> Fingerprint:
+    try:
+        line = int(line) if line is not None else None
+    except (TypeError, ValueError):
+        line = None
+    return (path, line, normalize(text))
+
+
+@dataclass
+class PostReport:
+    """Outcome of posting discussions to a code request."""
+
+    posted: int = 0
+    skipped: int = 0
+    # Discussions that failed to post with their error
+    errors: List[Tuple[str, Exception]] = field(default_factory=list)
+
+
+def existing_fingerprints(repository: Repository, cr: CodeRequest) -> Tuple[set, set]:
+    """Fingerprint the notes already in the code request discussions.
+
+    Returns:
+        The fingerprints of positioned notes and the normalized text of the
+        notes without a position
+    """
+    positioned = set()
+    unpositioned = set()
+    for discussion in repository.get_code_request_discussions(cr.project_id, cr.mr_id):
+        for note in discussion.get("notes", []):
+            position = note.get("position") or {}
+            if position.get("new_path"):
+                positioned.add(
+                    fingerprint(
+                        position.get("new_path"), position.get("new_line"), note["body"]
+                    )
+                )
+            else:
+                unpositioned.add(normalize(note["body"]))
+    return positioned, unpositioned
+
+
+class DiscussionPoster:
+    """Post discussions to a code request as they are submitted.
+
+    Discussions are posted in the background so that they can be submitted
+    while the LLM is still generating the rest of the review. The existing
+    discussions are fetched once, before the first post, and discussions
+    already posted are skipped. A failure to post a discussion doesn't stop
+    the others. When the existing discussions can't be fetched nothing is
+    posted, rather than duplicates, and every discussion gets that error.
+    """
+
+    def __init__(
+        self,
+        repository: Repository,
+        cr: CodeRequest,
+        concurrency: int = POST_CONCURRENCY,
+    ):
+        self.repository = repository
+        self.cr = cr
+        self.report = PostReport()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self._lock = threading.Lock()
+        self._existing: Optional[Tuple[set, set]] = None
+        self._fetch_error: Optional[Exception] = None
+
+    def submit(self, comment: str, position: Dict[str, Any]) -> None:
+        """Queue a discussion to post, it never blocks."""
+        self._executor.submit(self._post, comment, position)
+
+    def close(self) -> PostReport:
+        """Wait for the queued discussions to be posted.
+
+        Returns:
+            How many discussions were posted and skipped, and the errors
+        """
+        self._executor.shutdown(wait=True)
+        return self.report
+
+    def _post(self, comment: str, position: Dict[str, Any]) -> None:
+        key = fingerprint(position.get("new_path"), position.get("new_line"), comment)
+        with self._lock:
+            if self._existing is None and self._fetch_error is None:
+                try:
+                    self._existing = existing_fingerprints(self.repository, self.cr)
+                except Exception as e:
+                    self._fetch_error = e
+            if self._existing is None:
+                self.report.errors.append((comment, self._fetch_error))
+                return
+            positioned, unpositioned = self._existing
+
+            if key in positioned or key[2] in unpositioned:
+                self.report.skipped += 1
+                return
+            # Also skip duplicates in the same review, e.g. from overlapping chunks
+            positioned.add(key)
+
+        try:
+            self.repository.post_code_request_discussion(
+                self.cr.project_id, self.cr.mr_id, comment, position
+            )
+        except Exception as e:
+            with self._lock:
+                self.report.errors.append((comment, e))
+            return
+
+        with self._lock:
+            self.report.posted += 1
+
+
+def post_discussions(
+    repository: Repository,
+    cr: CodeRequest,
+    discussions: List[Tuple[str, Dict[str, Any]]],
+    concurrency: int = POST_CONCURRENCY,
+) -> PostReport:
+    """Post discussions to a code request skipping the ones already posted.
+
+    Args:
+        repository: The repository of the code request
+        cr: The code request
+        discussions: List of (comment, position) to post
+        concurrency: Maximum number of discussions posted at the same time
+
+    Returns:
+        How many discussions were posted and skipped, and the errors
+    """
+    poster = DiscussionPoster(repository, cr, concurrency)
+    for comment, position in discussions:
+        poster.submit(comment, position)
+    return poster.close()
@@ -0,0 +1,87 @@
+import threading
+import weakref
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+from providers import stringify_code_changes
+from providers.helpers import DIFF_FORMAT
+from repository import CodeRequest, CodeChange
+
+# Shared by the prompts of every action so that providers can cache it. Only
+# the code request goes here, the rules and the instructions differ between
+# actions and are in the suffix.
+PREFIX = """You are a senior software engineer reviewing a merge request. The merge request and its code changes come first, followed by the task to perform on them.
+
+{legend}
+
+=== Title ===
+{cr.title}
+
+=== Description ===
+{cr.description}
+
+=== Changes ===
+{changes_text}
+
+"""
+
+# How the lines of the diffs are marked, by diff format
+LEGENDS = {
+    "unified": "The lines that were added are marked with a + and the lines that were removed are marked with a -.",
+    "compact": (
+        "The lines that were added are marked with their line number in the new file followed by a +. "
+        "Removed lines are left out and marked with how many they were, and @@ marks unchanged lines left out."
+    ),
+}
+
+
+@dataclass
+class Prompt:
+    """Prompt split into a prefix shared between actions and an action suffix.
+
+    Providers cache the prefix, so it must only depend on the code request
+    and the changes sent.
+    """
+
+    prefix: str
+    suffix: str
+
+    @property
+    def text(self) -> str:
+        return self.prefix + self.suffix
+
+
+def render_prefix(cr: CodeRequest, changes: List[CodeChange]) -> str:
+    return PREFIX.format(
+        cr=cr,
+        legend=LEGENDS.get(DIFF_FORMAT, LEGENDS["unified"]),
+        changes_text=stringify_code_changes(changes),
+    )
+
+
+class _SharedPrefix:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.text: Optional[str] = None
+
+
+# Prefixes shared by the actions run on a code request, by context size
+_shared_prefixes: "weakref.WeakKeyDictionary[CodeRequest, Dict[int, _SharedPrefix]]" = (
+    weakref.WeakKeyDictionary()
+)
+_shared_lock = threading.Lock()
+
+
+def shared_prefix(cr: CodeRequest, max_tokens: int, build: Callable[[], str]) -> str:
+    """Prefix of a code request shared by all its actions, built only once.
+
+    Actions running concurrently on the same code request wait for the first
+    one to build it instead of building it again.
+    """
+    with _shared_lock:
+        entry = _shared_prefixes.setdefault(cr, {}).setdefault(
+            max_tokens, _SharedPrefix()
+        )
+    with entry.lock:
+        if entry.text is None:
+            entry.text = build()
+        return entry.text
@@ -1,27 +1,34 @@
-from providers import LLMProvider, stringify_code_changes, stringify_rules
-from providers.helpers import parse_json
-from repository import CodeRequest
+from providers import LLMProvider, CompletionResponse, stringify_rules
+from providers.helpers import DIFF_FORMAT, JsonArrayParser, parse_json
+from repository import CodeRequest, CodeChange, split
 from colorama import Fore, Style
-from rules import Rule
+from rules import Rule, RuleIndex
 from repository import Repository
-from .base import Action, ActionResult
-from typing import List
+from metrics import PhaseRecord, get_metrics
+from .base import UNPARSEABLE, Action, ActionResult
+from .budget import RESPONSE_TOKENS
+from .prompts import Prompt, render_prefix
+from .posting import DiscussionPoster, PostReport, post_discussions
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pydantic import BaseModel, ValidationError
+from typing import Any, List, Optional, Tuple
+import asyncio
+import os
+import time
 
-PROMPT = """Review the following code changes according to these rules:
+# Upper bound of tokens per chunk, smaller chunks get more focused reviews
+CHUNK_TOKENS = int(os.getenv("REVIEW_CHUNK_TOKENS", "32000"))
 
-=== Rules ===
-{rules_text}
-
-=== Changes ===
-{changes_text}
+# Upper bound of diff tokens reviewed across all the chunks
+MAX_TOKENS = int(os.getenv("REVIEW_MAX_TOKENS", "500000"))
 
-The lines that were added are marked with a + and the lines that were removed are marked with a -.
+PROMPT = """Review the code changes above according to these rules:
 
-Review the rules only for lines starting with a +.
-
-For every rule not followed, provide a clear and structured explanation of why it was not followed as well as the file and line number when that happened.
+=== Rules ===
+{rules_text}
 
-To calculate the line number use the first number in the range in the header of the diff starting with @@.
+{lines_text}
 
 Return your review in a clear and structured JSON format.
 
@@ -37,8 +44,49 @@ Return your review in a clear and structured JSON format.
 ```
 """
 
+# How to find the lines to review and their numbers, by diff format
+LINES_TEXT = {
+    "unified": """Review the rules only for lines starting with a +.
+
+For every rule not followed, provide a clear and structured explanation of why it was not followed as well as the file and line number when that happened.
+
+To calculate the line number use the first number in the range in the header of the diff starting with @@.""",
+    "compact": """Review the rules only for the lines added, the ones with a + after their line number.
+
+For every rule not followed, provide a clear and structured explanation of why it was not followed as well as the file and line number when that happened.
+
+The line number is the number before the + of the line.""",
+}
+
+
+class CodeFinding(BaseModel):
+    """A rule not followed by a line of a change."""
+
+    change_number: int
+    file: str = ""
+    line: int
+    reason: str
+
+
+class CodeReview(BaseModel):
+    """The rules not followed by the code changes."""
+
+    findings: List[CodeFinding]
+
+
+@dataclass
+class Chunk:
+    """Changes reviewed together in a single prompt against the same rules."""
+
+    rules: List[Rule]
+    # Changes with their index in the code request
+    changes: List[Tuple[int, CodeChange]]
+
 
 class ReviewCodeAction(Action):
+    name = "review_code"
+    schema = CodeReview
+
     def __init__(
         self,
         provider: LLMProvider,
@@ -48,58 +96,376 @@ class ReviewCodeAction(Action):
     ):
         super().__init__(provider, repository, rules, verbose)
 
-    def run(self, cr: CodeRequest, post: bool = False) -> ActionResult:
-        # Split code changes into chunks of 1000 lines
-
+    def selected_rules(self) -> List[Rule]:
         selected_rules = []
         for rule in self.rules:
             # Skip format rules that are used for the review_format action instead
             if rule.filename.startswith("format."):
                 continue
             selected_rules.append(rule)
+        return selected_rules
 
-        rules_text = stringify_rules(selected_rules)
-        changes_text = stringify_code_changes(cr.changes)
-        prompt = PROMPT.format(rules_text=rules_text, cr=cr, changes_text=changes_text)
+    def build_prompt(self, cr: CodeRequest) -> Prompt:
+        return self.build_chunk_prompt(
+            cr, Chunk(self.selected_rules(), list(enumerate(cr.changes)))
+        )
 
-        if self.verbose:
-            print(f"\n{Fore.GREEN}Prompt sent to LLM:{Style.RESET_ALL}")
-            print(f"{Fore.GREEN}{prompt}{Style.RESET_ALL}\n")
+    def build_chunk_prompt(self, cr: CodeRequest, chunk: Chunk) -> Prompt:
+        return Prompt(
+            render_prefix(cr, [change for _, change in chunk.changes]),
+            PROMPT.format(
+                rules_text=stringify_rules(chunk.rules),
+                lines_text=LINES_TEXT.get(DIFF_FORMAT, LINES_TEXT["unified"]),
+            ),
+        )
 
-        result = self.provider.completion(prompt)
+    def split(self, cr: CodeRequest) -> List[Chunk]:
+        """Split the code changes in chunks that fit in the provider context.
 
-        if self.verbose:
-            print(f"\n{Fore.YELLOW}Response from LLM:{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}{result.text}{Style.RESET_ALL}\n")
-            print(f"{Fore.YELLOW}Tokens used: {result.tokens_used}{Style.RESET_ALL}\n")
+        Every file is reviewed only against the rules whose globs match it, so
+        files are grouped by their rules and each group is chunked separately.
+        """
+        counter = self.provider.token_counter
 
-        parsed_results = parse_json(result.text)
-        if parsed_results is None:
-            print(f"{Fore.RED}Error: Could not parse JSON response{Style.RESET_ALL}")
-            return ActionResult(
-                result.tokens_used if hasattr(result, "tokens_used") else 0
+        # Review the most valuable changes when the whole diff is too big
+        plan = self.plan_changes(cr.changes, "", budget=MAX_TOKENS, degrade=False)
+
+        index = RuleIndex(self.selected_rules())
+        chunks = []
+        for rules, members in index.group([change.path for change in plan.changes]):
+            # Nothing to review for files not targeted by any rule
+            if not rules and index.rules:
+                print(
+                    f"{Fore.RED}Skipped {len(members)} changes not matched by the globs of any rule: "
+                    f"{', '.join(plan.changes[i].path for i in members)}{Style.RESET_ALL}"
+                )
+                continue
+
+            overhead = counter.count(self.build_chunk_prompt(cr, Chunk(rules, [])).text)
+            budget = min(self.provider.max_tokens - RESPONSE_TOKENS, CHUNK_TOKENS)
+            budget -= overhead
+
+            if budget <= 0:
+                raise ValueError("Rules are too long to review")
+
+            changes = [plan.changes[i] for i in members]
+            for part in split(changes, budget, counter):
+                chunks.append(
+                    Chunk(rules, [(plan.indexes[members[i]], c) for i, c in part])
+                )
+
+        if self.verbose and len(chunks) > 1:
+            print(
+                f"{Fore.WHITE}Split {len(cr.changes)} changes into {len(chunks)} chunks{Style.RESET_ALL}"
             )
 
+        return chunks
+
+    def run(self, cr: CodeRequest, post: bool = False) -> ActionResult:
+        if not cr.changes:
+            return ActionResult(0)
+
+        with self.timer("prompt"):
+            chunks = self.split(cr)
+            prompts = [self.build_chunk_prompt(cr, chunk) for chunk in chunks]
+        for prompt in prompts:
+            self.log_prompt(prompt.text)
+
+        poster = DiscussionPoster(self.repository, cr) if post else None
+        streams = [FindingStream(self, cr, chunk, poster) for chunk in chunks]
+
+        schema = self.response_schema()
+
+        def review(stream: FindingStream, prompt: Prompt) -> int:
+            try:
+                result = self.provider.stream(
+                    prompt.suffix, stream.feed, prefix=prompt.prefix, schema=schema
+                )
+            except Exception as e:
+                return stream.fail(e)
+            return stream.finish(result)
+
+        report = None
+        try:
+            workers = max(1, min(self.provider.concurrency, len(prompts)))
+            with self.timer("llm"), ThreadPoolExecutor(max_workers=workers) as executor:
+                tokens_used = sum(executor.map(review, streams, prompts))
+        finally:
+            # Wait for the findings already submitted even if the review failed
+            if poster is not None:
+                with self.timer("post"):
+                    report = poster.close()
+
+        self.record_parse(streams)
+        errors = [stream.error for stream in streams if stream.error]
+        if report is not None:
+            errors.append(self.report_posts(report))
+
+        return ActionResult(tokens_used, self.join_errors(errors))
+
+    async def arun(self, cr: CodeRequest, post: bool = False) -> ActionResult:
+        if not cr.changes:
+            return ActionResult(0)
+
+        with self.timer("prompt"):
+            chunks = self.split(cr)
+            prompts = [self.build_chunk_prompt(cr, chunk) for chunk in chunks]
+        for prompt in prompts:
+            self.log_prompt(prompt.text)
+
+        poster = DiscussionPoster(self.repository, cr) if post else None
+        streams = [FindingStream(self, cr, chunk, poster) for chunk in chunks]
+
+        schema = self.response_schema()
+
+        async def review(stream: FindingStream, prompt: Prompt) -> int:
+            try:
+                result = await self.provider.astream(
+                    prompt.suffix, stream.feed, prefix=prompt.prefix, schema=schema
+                )
+            except Exception as e:
+                return stream.fail(e)
+            return stream.finish(result)
+
+        report = None
+        try:
+            with self.timer("llm"):
+                tokens_used = sum(
+                    await asyncio.gather(
+                        *(
+                            review(stream, prompt)
+                            for stream, prompt in zip(streams, prompts)
+                        )
+                    )
+                )
+        finally:
+            # Wait for the findings already submitted even if the review failed
+            if poster is not None:
+                with self.timer("post"):
+                    report = await asyncio.to_thread(poster.close)
+
+        self.record_parse(streams)
+        errors = [stream.error for stream in streams if stream.error]
+        if report is not None:
+            errors.append(self.report_posts(report))
+
+        return ActionResult(tokens_used, self.join_errors(errors))
+
+    def record_parse(self, streams: List["FindingStream"]) -> None:
+        """Record the time spent parsing the streamed responses."""
+        get_metrics().record(
+            PhaseRecord(self.name, "parse", sum(s.parse_seconds for s in streams))
+        )
+
+    def process_result(
+        self, cr: CodeRequest, result: CompletionResponse, post: bool = False
+    ) -> ActionResult:
+        chunk = Chunk(self.selected_rules(), list(enumerate(cr.changes)))
+        return self.merge_results(cr, [chunk], [result], post)
+
+    def merge_results(
+        self,
+        cr: CodeRequest,
+        chunks: List[Chunk],
+        results: List[Optional[CompletionResponse]],
+        post: bool = False,
+    ) -> ActionResult:
+        """Merge the findings of every chunk into a single review."""
+        tokens_used = 0
+        findings = []
+        errors: List[Optional[str]] = []
+        with self.timer("parse"):
+            for chunk, result in zip(chunks, results):
+                if result is None:
+                    errors.append(self.no_response().error)
+                    continue
+
+                tokens_used += result.tokens_used
+                self.log_response(result.text, result.tokens_used)
+                chunk_findings = self.parse_findings(chunk, result.text)
+                if chunk_findings is None:
+                    errors.append(UNPARSEABLE)
+                    continue
+                findings.extend(chunk_findings)
+
         if post:
-            self.post_result(cr, parsed_results)
-
-        return ActionResult(result.tokens_used)
-
-    def post_result(self, cr: CodeRequest, parsed_results: List[dict]) -> None:
-        for result in parsed_results:
-            change = cr.changes[result["change_number"] - 1]
-            position = {
-                "base_sha": change.base_sha,
-                "start_sha": change.start_sha,
-                "head_sha": change.head_sha,
-                "old_path": change.path,
-                "new_path": change.path,
-                "old_line": result["line"],
-                "new_line": result["line"],
-            }
-            self.repository.post_code_request_discussion(
-                cr.project_id,
-                cr.mr_id,
-                result["reason"],
-                position,
+            with self.timer("post"):
+                errors.append(self.post_result(cr, findings))
+
+        return ActionResult(tokens_used, self.join_errors(errors))
+
+    def parse_findings(self, chunk: Chunk, text: str) -> Optional[List[CodeFinding]]:
+        """Parse and validate the findings of a whole chunk response.
+
+        Responses constrained to the schema are validated in one go, others
+        are parsed as JSON and their findings validated one by one, so an
+        invalid finding doesn't discard the rest.
+
+        Returns:
+            The valid findings, or None if the response has no findings array
+        """
+        try:
+            parsed_results: Any = CodeReview.model_validate_json(text).findings
+        except ValidationError:
+            try:
+                parsed_results = parse_json(text)
+            except Exception as e:
+                print(
+                    f"{Fore.RED}Error: Could not parse JSON response: {e}{Style.RESET_ALL}"
+                )
+                return None
+
+        if isinstance(parsed_results, dict):
+            parsed_results = parsed_results.get("findings")
+        if not isinstance(parsed_results, list):
+            print(f"{Fore.RED}Error: Could not parse JSON response{Style.RESET_ALL}")
+            return None
+
+        findings = []
+        for finding in parsed_results:
+            finding = self.validate_finding(chunk, finding)
+            if finding is not None:
+                findings.append(finding)
+        return findings
+
+    def validate_finding(self, chunk: Chunk, finding: Any) -> Optional[CodeFinding]:
+        """Check a finding and remap its change number to the code request.
+
+        The change numbers returned by the LLM are relative to the chunk and
+        are remapped to the index of the change in the code request.
+
+        Returns:
+            The remapped finding, or None if it is invalid
+        """
+        try:
+            finding = CodeFinding.model_validate(finding)
+        except ValidationError:
+            print(
+                f"{Fore.RED}Skipping finding without change number, line or reason: {finding}{Style.RESET_ALL}"
+            )
+            return None
+
+        if not 0 < finding.change_number <= len(chunk.changes):
+            print(
+                f"{Fore.RED}Skipping finding with invalid change number: {finding}{Style.RESET_ALL}"
+            )
+            return None
+
+        if not finding.reason:
+            print(
+                f"{Fore.RED}Skipping finding without reason: {finding}{Style.RESET_ALL}"
             )
+            return None
+
+        index = chunk.changes[finding.change_number - 1][0]
+        return finding.model_copy(update={"change_number": index + 1})
+
+    def discussion(self, cr: CodeRequest, finding: CodeFinding) -> Tuple[str, dict]:
+        """Return the comment and position of the discussion for a finding."""
+        change = cr.changes[finding.change_number - 1]
+        position = {
+            "base_sha": change.base_sha,
+            "start_sha": change.start_sha,
+            "head_sha": change.head_sha,
+            "old_path": change.path,
+            "new_path": change.path,
+            "old_line": finding.line,
+            "new_line": finding.line,
+        }
+        return finding.reason, position
+
+    def post_result(
+        self, cr: CodeRequest, parsed_results: List[CodeFinding]
+    ) -> Optional[str]:
+        """Post the findings and return an error if some could not be posted."""
+        discussions = [self.discussion(cr, result) for result in parsed_results]
+        return self.report_posts(post_discussions(self.repository, cr, discussions))
+
+    def report_posts(self, report: PostReport) -> Optional[str]:
+        """Print the outcome of the posts, returning an error if some failed."""
+        if self.verbose:
+            print(
+                f"{Fore.WHITE}Posted {report.posted} comments, skipped {report.skipped} already posted{Style.RESET_ALL}"
+            )
+        for comment, error in report.errors:
+            print(
+                f"{Fore.RED}Error posting comment '{comment}': {error}{Style.RESET_ALL}"
+            )
+        if report.errors:
+            return f"Could not post {len(report.errors)} comments"
+        return None
+
+    @staticmethod
+    def join_errors(errors: List[Optional[str]]) -> Optional[str]:
+        """Errors of the chunks and the posts as one, None if there are none."""
+        unique = list(dict.fromkeys(error for error in errors if error))
+        return "; ".join(unique) or None
+
+
+class FindingStream:
+    """Validate and post the findings of a chunk as the response streams in.
+
+    Findings are posted as soon as the model has finished generating them
+    instead of when the whole review is done.
+    """
+
+    def __init__(
+        self,
+        action: ReviewCodeAction,
+        cr: CodeRequest,
+        chunk: Chunk,
+        poster: Optional[DiscussionPoster] = None,
+    ):
+        self.action = action
+        self.cr = cr
+        self.chunk = chunk
+        self.poster = poster
+        self.parser = JsonArrayParser()
+        self.findings: List[CodeFinding] = []
+        self.parse_seconds = 0.0
+        # Why the chunk was not reviewed, None if it was
+        self.error: Optional[str] = None
+
+    def feed(self, text: str) -> None:
+        start = time.monotonic()
+        findings = self.parser.feed(text)
+        self.parse_seconds += time.monotonic() - start
+
+        for finding in findings:
+            self.accept(self.action.validate_finding(self.chunk, finding))
+
+    def accept(self, finding: Optional[CodeFinding]) -> None:
+        if finding is None:
+            return
+        self.findings.append(finding)
+        if self.poster is not None:
+            self.poster.submit(*self.action.discussion(self.cr, finding))
+
+    def fail(self, error: Exception) -> int:
+        """Handle a completion that raised, the other chunks go on."""
+        print(f"{Fore.RED}Error: Could not review a chunk: {error}{Style.RESET_ALL}")
+        self.error = str(error) or type(error).__name__
+        return 0
+
+    def finish(self, result: Optional[CompletionResponse]) -> int:
+        """Handle the end of the response and return the tokens it used."""
+        if result is None:
+            self.error = self.action.no_response().error
+            return 0
+        self.action.add_tokens(result.tokens_used)
+
+        self.action.log_response(result.text, result.tokens_used)
+
+        # Responses that are not a plain array are parsed once complete
+        if self.parser.count == 0:
+            start = time.monotonic()
+            findings = self.action.parse_findings(self.chunk, result.text)
+            self.parse_seconds += time.monotonic() - start
+
+            if findings is None:
+                self.error = UNPARSEABLE
+                findings = []
+            for finding in findings:
+                self.accept(finding)
+
+        return result.tokens_used
@@ -1,27 +1,19 @@
 from .base import Action
-from providers import LLMProvider, parse_json
+from providers import LLMProvider, CompletionResponse, parse_json
 from repository import CodeRequest
 from colorama import Fore, Style
+from pydantic import BaseModel, Field, ValidationError, field_validator
 from rules import Rule
-from typing import List
+from typing import Any, List, Optional
 from repository import Repository
-from actions.base import ActionResult
-from repository import count_tokens, count_tokens_change
+from actions.base import UNPARSEABLE, ActionResult
+from actions.prompts import Prompt
 
-PROMPT = """You are a senior software engineer. Review the structure and format of this change according to the following rules:
+PROMPT = """Review the structure and format of the change above according to the following rules:
 
 === Rules ===
 {rules_text}
 
-=== Title ===
-{cr.title}
-
-=== Description ===
-{cr.description}
-
-=== Changes ===
-{changes_text}
-
 For each of the rules defined above report:
 - Rule title
 - Rule passed or failed
@@ -43,7 +35,35 @@ Return your review in a clear and structured format using the following JSON sch
 """
 
 
+class RuleResult(BaseModel):
+    """Whether the merge request follows a format rule and why."""
+
+    rule_title: str
+    # "passed" or "failed", the schema asks for one of them but anything other
+    # than "passed" in a text response counts as failed
+    result: str = Field(json_schema_extra={"enum": ["passed", "failed"]})
+    explanation: str
+
+    @field_validator("result", mode="before")
+    @classmethod
+    def normalize_result(cls, value: Any) -> Any:
+        return value.strip().lower() if isinstance(value, str) else value
+
+    @property
+    def passed(self) -> bool:
+        return self.result == "passed"
+
+
+class FormatReview(BaseModel):
+    """The result of every format rule."""
+
+    results: List[RuleResult]
+
+
 class ReviewFormatAction(Action):
+    name = "review_format"
+    schema = FormatReview
+
     def __init__(
         self,
         provider: LLMProvider,
@@ -53,65 +73,74 @@ class ReviewFormatAction(Action):
     ):
         super().__init__(provider, repository, rules, verbose)
 
-    def run(self, cr: CodeRequest, post: bool = False) -> ActionResult:
-        selected_rules = [
-            rule for rule in self.rules if rule.filename.startswith("format.")
-        ]
-        rules_text = "\n".join(f"- {rule.content}" for rule in selected_rules)
+    def selected_rules(self) -> List[Rule]:
+        return [rule for rule in self.rules if rule.filename.startswith("format.")]
 
-        request_tokens = count_tokens(PROMPT + rules_text + cr.title + cr.description)
+    def build_prompt(self, cr: CodeRequest) -> Prompt:
+        rules_text = "\n".join(f"- {rule.content}" for rule in self.selected_rules())
 
-        if request_tokens > self.provider.max_tokens:
-            raise ValueError("Code request is too long to review")
+        return self.cached_prompt(cr, PROMPT.format(rules_text=rules_text))
 
-        changes_text = ""
-        for change in cr.changes:
-            tokens = count_tokens_change(change)
-            request_tokens += tokens
+    def process_result(
+        self, cr: CodeRequest, result: CompletionResponse, post: bool = False
+    ) -> ActionResult:
+        self.log_response(result.text, result.tokens_used)
 
-            if request_tokens < self.provider.max_tokens:
-                changes_text += f"File: {change.path}\n{change.diff}\n"
-            else:
-                print(
-                    f"{Fore.RED}Skipping change {change.path} because it exceeds the token limit{Style.RESET_ALL}"
-                )
-                break
+        with self.timer("parse"):
+            parsed_results = self.parse_results(result.text)
+        if parsed_results is None:
+            return ActionResult(result.tokens_used, UNPARSEABLE)
+
+        if post:
+            with self.timer("post"):
+                self.post_result(cr, parsed_results)
 
-        prompt = PROMPT.format(rules_text=rules_text, changes_text=changes_text, cr=cr)
+        return ActionResult(result.tokens_used)
 
-        if self.verbose:
-            print(f"\n{Fore.GREEN}Prompt sent to LLM:{Style.RESET_ALL}")
-            print(f"{Fore.GREEN}{prompt}{Style.RESET_ALL}\n")
+    def parse_results(self, text: str) -> Optional[List[RuleResult]]:
+        """Parse and validate the result of every rule in a response.
 
-        result = self.provider.completion(prompt)
+        Returns:
+            The valid results, or None if the response is not JSON
+        """
+        try:
+            return FormatReview.model_validate_json(text).results
+        except ValidationError:
+            pass
 
-        if result is None:
+        try:
+            parsed_results = parse_json(text)
+        except Exception as e:
             print(
-                f"{Fore.RED}Error: No response received from LLM provider{Style.RESET_ALL}"
+                f"{Fore.RED}Error: Could not parse JSON response: {e}{Style.RESET_ALL}"
             )
-            return ActionResult(0)
+            return None
 
-        if self.verbose:
-            print(f"\n{Fore.YELLOW}Response from LLM:{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}{result.text}{Style.RESET_ALL}\n")
-            if hasattr(result, "tokens_used"):
-                print(
-                    f"{Fore.YELLOW}Tokens used: {result.tokens_used}{Style.RESET_ALL}\n"
-                )
+        if isinstance(parsed_results, dict):
+            parsed_results = parsed_results.get("results")
+        return self.validate_results(parsed_results)
 
-        parsed_results = parse_json(result.text)
-        if parsed_results is None:
-            print(f"{Fore.RED}Error: Could not parse JSON response{Style.RESET_ALL}")
-            return ActionResult(
-                result.tokens_used if hasattr(result, "tokens_used") else 0
-            )
+    def validate_results(self, parsed_results: Any) -> Optional[List[RuleResult]]:
+        """Validate parsed rule results, skipping the invalid ones.
 
-        if post:
-            self.post_result(cr, parsed_results)
+        Returns:
+            The valid results, or None if they are not a list
+        """
+        if not isinstance(parsed_results, list):
+            print(f"{Fore.RED}Error: Could not parse JSON response{Style.RESET_ALL}")
+            return None
 
-        return ActionResult(result.tokens_used if hasattr(result, "tokens_used") else 0)
+        results = []
+        for rule in parsed_results:
+            try:
+                results.append(RuleResult.model_validate(rule))
+            except ValidationError:
+                print(
+                    f"{Fore.RED}Skipping invalid rule result: {rule}{Style.RESET_ALL}"
+                )
+        return results
 
-    def post_result(self, cr: CodeRequest, results: List[dict]) -> None:
+    def post_result(self, cr: CodeRequest, results: List[RuleResult]) -> None:
         """Post review results as a comment on the merge request."""
         if self.verbose:
             print(
@@ -119,13 +148,12 @@ class ReviewFormatAction(Action):
             )
 
         comment = "# Code Review Results\n\n"
-        failed = [result for result in results if result["result"] != "passed"]
+        failed = [result for result in results if not result.passed]
 
         comment += f"Rules passed: {len(results)-len(failed)}/{len(results)}\n\n"
 
-        for rule in results:
-            if rule.get("result") != "passed":
-                comment += f"❌ {rule.get('rule_title')}\n{rule.get('explanation')}\n\n"
+        for rule in failed:
+            comment += f"❌ {rule.rule_title}\n{rule.explanation}\n\n"
 
         self.repository.post_comment(cr.project_id, cr.mr_id, comment)
 
@@ -1,27 +1,18 @@
 from .base import Action
-from providers import LLMProvider
-from providers.helpers import stringify_code_changes
+from providers import LLMProvider, CompletionResponse
 from repository.code_request import CodeRequest
 from colorama import Fore, Style
 from rules import Rule
 from repository.base import Repository
 from pydantic import BaseModel
 from actions.base import ActionResult
+from actions.prompts import Prompt
 from typing import List
 
-PROMPT = """Summarize the following code changes according to these rules:
+PROMPT = """Summarize the code changes above according to these rules:
 
-Rules:
 {rules_text}
 
-Title: {pr.title}
-
-Description:
-{pr.description}
-
-Changes:
-{changes_text}
-
 Please provide a concise summary that:
 1. Captures the main purpose of the changes
 2. Highlights key technical decisions
@@ -40,6 +31,8 @@ class Summary(BaseModel):
 
 
 class SummarizeAction(Action):
+    name = "summarize"
+
     def __init__(
         self,
         provider: LLMProvider,
@@ -49,23 +42,21 @@ class SummarizeAction(Action):
     ):
         super().__init__(provider, repository, rules, verbose)
 
-    def run(self, pr: CodeRequest, post: bool = False) -> ActionResult:
+    def build_prompt(self, pr: CodeRequest) -> Prompt:
         rules_text = "\n".join(f"- {rule.content}" for rule in self.rules)
-        changes_text = stringify_code_changes(pr.changes)
-        prompt = PROMPT.format(rules_text=rules_text, pr=pr, changes_text=changes_text)
+        return self.cached_prompt(pr, PROMPT.format(rules_text=rules_text))
 
-        if self.verbose:
-            print(f"\n{Fore.GREEN}Prompt sent to LLM:{Style.RESET_ALL}")
-            print(f"{Fore.GREEN}{prompt}{Style.RESET_ALL}\n")
-
-        result = self.provider.completion(prompt)
-
-        if self.verbose:
-            print(f"\n{Fore.YELLOW}Response from LLM:{Style.RESET_ALL}")
-            print(f"{Fore.YELLOW}{result.text}{Style.RESET_ALL}\n")
-            print(f"{Fore.YELLOW}Tokens used: {result.tokens_used}{Style.RESET_ALL}\n")
+    def process_result(
+        self, pr: CodeRequest, result: CompletionResponse, post: bool = False
+    ) -> ActionResult:
+        self.log_response(result.text, result.tokens_used)
 
         if post:
-            self.repository.post_comment(pr.project_id, pr.mr_id, result.text)
+            with self.timer("post"):
+                self.post_result(pr, result.text)
 
         return ActionResult(result.tokens_used)
+
+    def post_result(self, pr: CodeRequest, summary: str) -> None:
+        """Post the summary as a comment on the pull request."""
+        self.repository.post_comment(pr.project_id, pr.mr_id, summary)
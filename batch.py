@@ -0,0 +1,333 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from dataclasses import asdict, dataclass
+from typing import IO, Iterable, List, Optional, Tuple
+from colorama import Fore, Style
+from main import (
+    add_fuse_argument,
+    failed_actions,
+    get_provider,
+    get_repository,
+    parse_actions,
+    print_failover_stats,
+    print_token_usage,
+    review_code_request,
+)
+from metrics import get_metrics, percentile
+from providers import CachedProvider, LLMProvider
+from repository import Repository
+from rules import Rule, load_rules
+
+
+@dataclass
+class BatchResult:
+    """Outcome of the review of one code request in a batch."""
+
+    project_id: int
+    cr_id: int
+    status: str
+    tokens_used: int = 0
+    seconds: float = 0.0
+    error: str = ""
+
+
+def parse_code_request(value: str) -> Tuple[int, int]:
+    """Parse a code request given as PROJECT!MR or PROJECT:MR."""
+    for separator in ("!", ":"):
+        if separator in value:
+            project_id, cr_id = value.rsplit(separator, 1)
+            try:
+                return int(project_id), int(cr_id)
+            except ValueError:
+                break
+    raise ValueError(f"Invalid code request '{value}', expected PROJECT!MR")
+
+
+def read_code_requests(lines: Iterable[str]) -> List[Tuple[int, int]]:
+    """Read code requests from lines of PROJECT!MR, skipping blanks and comments."""
+    code_requests = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            code_requests.append(parse_code_request(line))
+    return code_requests
+
+
+class BatchRunner:
+    """Review many code requests on a shared pool of workers.
+
+    The provider, repository and rules are created once and shared by the
+    workers, so connections, caches and token counters are reused across code
+    requests. A result is written as a JSON line as soon as a review finishes.
+    """
+
+    def __init__(
+        self,
+        action_names: List[str],
+        provider: LLMProvider,
+        repository: Repository,
+        rules: List[Rule],
+        workers: int = 4,
+        post: bool = False,
+        incremental: bool = False,
+        filter_noise: bool = True,
+        tag: bool = False,
+        verbose: bool = False,
+    ):
+        self.action_names = action_names
+        self.provider = provider
+        self.repository = repository
+        self.rules = rules
+        self.workers = workers
+        self.post = post
+        self.incremental = incremental
+        self.filter_noise = filter_noise
+        self.tag = tag
+        self.verbose = verbose
+        self._lock = threading.Lock()
+
+    def review(self, project_id: int, cr_id: int) -> BatchResult:
+        start = time.monotonic()
+        try:
+            results = review_code_request(
+                project_id,
+                cr_id,
+                self.action_names,
+                self.provider,
+                self.repository,
+                self.rules,
+                post=self.post,
+                verbose=self.verbose,
+                jobs=len(self.action_names),
+                incremental=self.incremental,
+                filter_noise=self.filter_noise,
+                tag=self.tag,
+            )
+        except Exception as e:
+            print(
+                f"{Fore.RED}Review of {project_id}!{cr_id} failed: {e}{Style.RESET_ALL}"
+            )
+            return BatchResult(
+                project_id,
+                cr_id,
+                "error",
+                seconds=round(time.monotonic() - start, 3),
+                error=str(e),
+            )
+        # A review that ran but whose actions failed is a failed review too
+        error = failed_actions(results)
+        return BatchResult(
+            project_id,
+            cr_id,
+            "error" if error else "ok",
+            sum(result.tokens_used for result in results.values()),
+            seconds=round(time.monotonic() - start, 3),
+            error=error or "",
+        )
+
+    def run(
+        self, code_requests: List[Tuple[int, int]], output: IO[str]
+    ) -> Tuple[List[BatchResult], float]:
+        """Review the code requests and write their results to output.
+
+        Returns:
+            The results in completion order and the elapsed seconds
+        """
+        # The same code request listed twice would be reviewed twice
+        code_requests = list(dict.fromkeys(code_requests))
+        results = []
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            futures = [
+                executor.submit(self.review, project_id, cr_id)
+                for project_id, cr_id in code_requests
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                with self._lock:
+                    output.write(json.dumps(asdict(result)) + "\n")
+                    output.flush()
+
+        return results, time.monotonic() - start
+
+
+def summarize(results: List[BatchResult], elapsed: float) -> str:
+    """Format the throughput of a batch."""
+    minutes = max(elapsed, 1e-9) / 60
+    tokens_used = sum(result.tokens_used for result in results)
+    failed = sum(1 for result in results if result.status != "ok")
+    latencies = [result.seconds for result in results]
+    return (
+        f"Reviewed {len(results)} code requests ({failed} failed) in {elapsed:.1f}s: "
+        f"{len(results) / minutes:.1f} MRs/min, {tokens_used / minutes:.0f} tokens/min, "
+        f"latency p50 {percentile(latencies, 50):.1f}s p95 {percentile(latencies, 95):.1f}s"
+    )
+
+
+def add_code_request_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the arguments selecting the code requests to review."""
+    parser.add_argument(
+        "code_requests",
+        nargs="*",
+        help="Merge requests to review as PROJECT!MR",
+    )
+    parser.add_argument(
+        "-f",
+        "--file",
+        help="File with a PROJECT!MR per line, - to read from stdin",
+    )
+    parser.add_argument("-g", "--group", help="Review the merge requests of a group")
+    parser.add_argument("--project", help="Review the merge requests of a project")
+    parser.add_argument(
+        "--updated-after",
+        help="Only review merge requests of the group or project updated after this ISO 8601 time",
+    )
+    parser.add_argument(
+        "--state",
+        default="opened",
+        help="Only review merge requests of the group or project in this state",
+    )
+
+
+def gather_code_requests(
+    args: argparse.Namespace, repository: Repository
+) -> List[Tuple[int, int]]:
+    """Code requests selected by the arguments of add_code_request_arguments."""
+    code_requests = [parse_code_request(value) for value in args.code_requests]
+
+    if args.file == "-":
+        code_requests += read_code_requests(sys.stdin)
+    elif args.file:
+        with open(args.file, "r") as f:
+            code_requests += read_code_requests(f)
+
+    if args.group or args.project:
+        code_requests += repository.list_code_requests(
+            group_id=args.group,
+            project_id=args.project,
+            updated_after=args.updated_after,
+            state=args.state,
+        )
+
+    if not code_requests:
+        raise ValueError("No merge requests to review")
+    return code_requests
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Review many GitLab merge requests in one run"
+    )
+    parser.add_argument(
+        "actions",
+        help="Comma-separated list of actions to perform (review_code,review_format,label,summarize)",
+    )
+    add_code_request_arguments(parser)
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="-",
+        help="File to write the results to as JSON lines, stdout by default",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=int(os.getenv("BATCH_WORKERS", "8")),
+        help="Number of merge requests reviewed at the same time",
+    )
+    parser.add_argument(
+        "-r", "--rules", help="Optional path to rules file or directory"
+    )
+    parser.add_argument(
+        "-p", "--post", action="store_true", help="Post results to merge/pull requests"
+    )
+    parser.add_argument(
+        "-t",
+        "--tag",
+        action="store_true",
+        help="Tag merge/pull requests and avoid duplication",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        action="store_true",
+        default=os.getenv("SIDEKICK_CACHE", "").lower() in ("1", "true", "yes"),
+        help="Cache LLM responses on disk and reuse them for identical prompts",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only review the code pushed since the last review posted by sidekick",
+    )
+    parser.add_argument(
+        "--no-filter",
+        action="store_true",
+        help="Review lockfiles, generated, vendored and whitespace-only changes too",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        default=os.getenv("SIDEKICK_METRICS"),
+        help="Write metrics to this file, as a Prometheus textfile if it ends in .prom or else as JSON lines",
+    )
+    add_fuse_argument(parser)
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Enable verbose output with colors"
+    )
+    args = parser.parse_args()
+
+    output: Optional[IO[str]] = None
+    try:
+        get_metrics().configure(args.metrics)
+        action_names = parse_actions(args.actions, args.fuse)
+        repository = get_repository()
+        code_requests = gather_code_requests(args, repository)
+
+        runner = BatchRunner(
+            action_names,
+            get_provider(args.cache),
+            repository,
+            load_rules(args.rules),
+            workers=args.workers,
+            post=args.post,
+            incremental=args.incremental,
+            filter_noise=not args.no_filter,
+            tag=args.tag,
+            verbose=args.verbose,
+        )
+
+        output = sys.stdout if args.output == "-" else open(args.output, "w")
+        # Keep stdout for the JSON lines, the progress of the reviews goes to stderr
+        with redirect_stdout(sys.stderr):
+            results, elapsed = runner.run(code_requests, output)
+
+            print(f"{Fore.WHITE}{summarize(results, elapsed)}{Style.RESET_ALL}")
+            print_token_usage()
+            print_failover_stats(runner.provider)
+            if isinstance(runner.provider, CachedProvider):
+                print(
+                    f"{Fore.WHITE}Cache hits: {runner.provider.hits}, misses: {runner.provider.misses}{Style.RESET_ALL}"
+                )
+
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        get_metrics().close()
+        if output is not None and output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
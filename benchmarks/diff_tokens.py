@@ -0,0 +1,82 @@
+"""Token savings of the compact diff format on the benchmark merge requests.
+
+Renders the changes of synthetic merge requests of every hunk size in the
+unified format sent by default and in the compact format with several
+context sizes, and reports the tokens of each with the OpenAI tokenizer.
+
+    python benchmarks/diff_tokens.py
+    python benchmarks/diff_tokens.py --files 200 --context 0 1 2 3 --json
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import HUNK_SIZES, generate_merge_request  # noqa: E402
+from providers import stringify_code_changes  # noqa: E402
+from repository import CodeChange, DiffRefs, get_token_counter  # noqa: E402
+
+
+def merge_request_changes(files: int, hunk: str, seed: int) -> List[CodeChange]:
+    """Changes of a benchmark merge request as the repository returns them."""
+    _, data = generate_merge_request(1, 1, files, hunk, seed)
+    diff_refs = DiffRefs(**data["diff_refs"])
+    return [
+        CodeChange(change["new_path"], change["diff"], diff_refs)
+        for change in data["changes"]
+    ]
+
+
+def measure(changes: List[CodeChange], contexts: List[int]) -> Dict[str, int]:
+    """Tokens of the changes in the unified format and the compact ones."""
+    texts = {"unified": stringify_code_changes(changes, "unified")}
+    for context in contexts:
+        texts[f"compact_{context}"] = stringify_code_changes(
+            changes, "compact", context
+        )
+    tokens = get_token_counter().count_batch(list(texts.values()))
+    return dict(zip(texts, tokens))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=50, help="Files per merge request")
+    parser.add_argument(
+        "--context",
+        type=int,
+        nargs="+",
+        default=[0, 1, 3],
+        help="Unchanged lines around the changes of the compact format",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--json", action="store_true", help="Print results as JSON lines"
+    )
+    args = parser.parse_args()
+
+    for hunk in HUNK_SIZES:
+        # Keep the huge hunks to a size that renders quickly
+        files = args.files if HUNK_SIZES[hunk] < 1000 else max(args.files // 10, 1)
+        result = measure(merge_request_changes(files, hunk, args.seed), args.context)
+        unified = result["unified"]
+
+        if args.json:
+            print(json.dumps({"hunk": hunk, "files": files, **result}))
+            continue
+
+        columns = [f"unified {unified:>9,}"]
+        for context in args.context:
+            tokens = result[f"compact_{context}"]
+            columns.append(
+                f"compact -U{context} {tokens:>9,} ({(tokens - unified) / unified:+.0%})"
+            )
+        print(f"{hunk:<8} {files:>4} files  " + "  ".join(columns))
+
+
+if __name__ == "__main__":
+    main()
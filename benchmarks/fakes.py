@@ -0,0 +1,743 @@
+"""Fakes of the LLM providers and of GitLab for the offline benchmarks.
+
+FakeProvider answers every action deterministically after a simulated
+latency, FakeGitLab serves synthetic merge requests from another process so
+that its CPU time is not counted as sidekick's, and generate_merge_request
+builds merge requests from 1 to thousands of files with hunks of any size.
+FakeBatchAPI serves the batch endpoints of OpenAI and Anthropic with the
+answers of FakeProvider, for the deferred reviews.
+"""
+
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+from urllib.parse import parse_qs, urlparse
+from pydantic import BaseModel
+from providers import LLMProvider, CompletionResponse
+
+# Lines changed in every hunk of the hunk sizes
+HUNK_SIZES = {"small": 3, "medium": 20, "large": 120, "huge": 1000}
+
+# User of the token of the GitLab stub, the author of every note
+USER = {"id": 1, "username": "sidekick"}
+
+# Characters per token used to report token counts without a tokenizer
+CHARS_PER_TOKEN = 4
+
+# First words of the prompt of every action, after the cached prefix
+TASK_OPENINGS = (
+    "Review the code changes",
+    "Review the structure",
+    "Based on the pull request",
+    "Perform the tasks",
+)
+
+WORDS = (
+    "value result index buffer request handler config session cache token "
+    "client record parser stream writer reader update delete create count"
+).split()
+
+
+class FakeProvider(LLMProvider):
+    """Deterministic LLM provider simulating the latency of a real one.
+
+    Responses depend only on the prompt: review_code gets findings on the
+    changes it was sent, review_format a verdict per rule, label a list of
+    labels and summarize a summary. Completions wait latency seconds for the
+    first token then generate tokens_per_second, streamed in pieces. Prefixes
+    seen before are reported as cached input tokens, like a provider cache.
+    Schemas are ignored, like providers without structured output do.
+    """
+
+    name = "fake"
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        tokens_per_second: float = 2000.0,
+        output_tokens: int = 200,
+        findings: int = 3,
+        context_window: int = 128000,
+        concurrency: int = 16,
+    ):
+        self.model = "fake"
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.findings = findings
+        self.context_window = context_window
+        self._concurrency = concurrency
+        self._lock = threading.Lock()
+        self._prefixes: set = set()
+
+    @property
+    def max_tokens(self) -> int:
+        return self.context_window
+
+    @property
+    def concurrency(self) -> int:
+        return self._concurrency
+
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        return self.stream(prompt, lambda text: None, prefix=prefix)
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        text = self.respond(prompt, prefix)
+        time.sleep(self.latency)
+        for piece, seconds in self._pieces(text):
+            time.sleep(seconds)
+            on_text(piece)
+        return self._to_completion_response(text, prompt, prefix)
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        return await self._astream(prompt, lambda text: None, prefix)
+
+    async def _astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        text = self.respond(prompt, prefix)
+        await asyncio.sleep(self.latency)
+        for piece, seconds in self._pieces(text):
+            await asyncio.sleep(seconds)
+            on_text(piece)
+        return self._to_completion_response(text, prompt, prefix)
+
+    def respond(self, prompt: str, prefix: str = "") -> str:
+        """Text of the completion of a prompt."""
+        rng = random.Random(hashlib.sha256((prefix + prompt).encode()).digest())
+        words = max(self.output_tokens // max(self.findings, 1), 1)
+
+        if prompt.startswith(TASK_OPENINGS[0]):
+            paths = re.findall(r"^Change \d+:[\n ](.*)$", prefix, re.MULTILINE)
+            findings = [
+                {
+                    "change_number": number,
+                    "file": paths[number - 1],
+                    "line": rng.randint(1, 20),
+                    "reason": sentence(rng, words),
+                }
+                for number in sorted(
+                    rng.sample(range(1, len(paths) + 1), min(self.findings, len(paths)))
+                )
+            ]
+            return json.dumps(findings, indent=4)
+
+        if prompt.startswith(TASK_OPENINGS[1]):
+            return json.dumps(self._format(rng, prompt, words), indent=4)
+
+        if prompt.startswith(TASK_OPENINGS[2]):
+            return ", ".join(self._labels(rng))
+
+        if prompt.startswith(TASK_OPENINGS[3]):
+            # Fused summarize, label and review_format
+            result: Dict[str, Any] = {}
+            if "=== Summary ===" in prompt:
+                result["summary"] = sentence(rng, self.output_tokens)
+            if "=== Labels ===" in prompt:
+                result["labels"] = self._labels(rng)
+            if "=== Format ===" in prompt:
+                result["format"] = self._format(
+                    rng, prompt.split("=== Format ===")[1], words
+                )
+            return json.dumps(result, indent=4)
+
+        return sentence(rng, self.output_tokens)
+
+    def _format(
+        self, rng: random.Random, prompt: str, words: int
+    ) -> List[Dict[str, Any]]:
+        rules = re.findall(r"^- (.*)$", prompt.split("For each")[0], re.MULTILINE)
+        return [
+            {
+                "rule_title": rule[:40],
+                "result": rng.choice(["passed", "failed"]),
+                "explanation": sentence(rng, words),
+            }
+            for rule in rules
+        ]
+
+    def _labels(self, rng: random.Random) -> List[str]:
+        return rng.sample(["feature", "bugfix", "refactor", "backend"], 2)
+
+    def _pieces(self, text: str) -> List[Tuple[str, float]]:
+        """Split a text in streamed pieces with the time to generate each."""
+        size = 16 * CHARS_PER_TOKEN
+        seconds = 16 / self.tokens_per_second
+        return [(text[i : i + size], seconds) for i in range(0, len(text), size)]
+
+    def _to_completion_response(
+        self, text: str, prompt: str, prefix: str
+    ) -> CompletionResponse:
+        with self._lock:
+            cached = prefix in self._prefixes and self.prompt_cache
+            self._prefixes.add(prefix)
+
+        input_tokens = len(prefix + prompt) // CHARS_PER_TOKEN
+        output_tokens = len(text) // CHARS_PER_TOKEN
+        return CompletionResponse(
+            text=text,
+            tokens_used=input_tokens + output_tokens,
+            input_tokens=input_tokens,
+            cached_input_tokens=len(prefix) // CHARS_PER_TOKEN if cached else 0,
+            output_tokens=output_tokens,
+        )
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(max(words, 1))).capitalize() + "."
+
+
+def generate_diff(rng: random.Random, hunks: int, lines: int) -> str:
+    """Unified diff with hunks of changed lines between unchanged ones."""
+    parts = []
+    start = 1
+    for _ in range(hunks):
+        added = [
+            f"+    {rng.choice(WORDS)}_{rng.randint(0, 999)} = {rng.choice(WORDS)}({rng.randint(0, 99)})"
+            for _ in range(lines)
+        ]
+        removed = [f"-    {line[5:]}" for line in added[: lines // 3]]
+        context = [f"     # {rng.choice(WORDS)}" for _ in range(3)]
+        parts.append(
+            f"@@ -{start},{len(removed) + 6} +{start},{len(added) + 6} @@ def {rng.choice(WORDS)}():\n"
+            + "\n".join(context + removed + added + context)
+        )
+        start += lines + 40
+    return "\n".join(parts) + "\n"
+
+
+def generate_merge_request(
+    project_id: int, mr_id: int, files: int, hunk: str = "medium", seed: int = 0
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Merge request and its changes, as returned by the GitLab API.
+
+    Args:
+        project_id: The project ID
+        mr_id: The merge request IID
+        files: Number of files changed
+        hunk: Size of the hunks, one of HUNK_SIZES
+        seed: Seed of the generated content, the same seed gives the same diffs
+
+    Returns:
+        The merge request and its changes
+    """
+    rng = random.Random(f"{seed}:{project_id}:{mr_id}")
+    lines = HUNK_SIZES[hunk]
+    # Big hunks come alone, small ones are scattered across the file
+    hunks = max(1, min(4, 60 // lines))
+    diff_refs = {
+        "base_sha": hashlib.sha1(f"base{seed}{mr_id}".encode()).hexdigest(),
+        "start_sha": hashlib.sha1(f"start{seed}{mr_id}".encode()).hexdigest(),
+        "head_sha": hashlib.sha1(f"head{seed}{mr_id}".encode()).hexdigest(),
+    }
+    extensions = [".py", ".js", ".go", ".java"]
+    changes = []
+    for i in range(files):
+        path = f"src/{rng.choice(WORDS)}_{i // 50}/{rng.choice(WORDS)}_{i}{extensions[i % 4]}"
+        changes.append(
+            {
+                "old_path": path,
+                "new_path": path,
+                "new_file": False,
+                "deleted_file": False,
+                "renamed_file": False,
+                "diff": generate_diff(rng, hunks, lines),
+            }
+        )
+
+    merge_request = {
+        "id": project_id * 100000 + mr_id,
+        "iid": mr_id,
+        "project_id": project_id,
+        "title": f"Update the {rng.choice(WORDS)} {rng.choice(WORDS)}",
+        "description": sentence(rng, 40),
+        "target_branch": "main",
+        "state": "opened",
+        "sha": diff_refs["head_sha"],
+    }
+    return merge_request, {**merge_request, "diff_refs": diff_refs, "changes": changes}
+
+
+@dataclass
+class MergeRequestSpec:
+    """Synthetic merge requests served by FakeGitLab."""
+
+    project_id: int = 1
+    count: int = 1
+    files: int = 50
+    hunk: str = "medium"
+    seed: int = 0
+
+
+class GitLabHandler(BaseHTTPRequestHandler):
+    """Handle the GitLab API requests made by GitLabRepository."""
+
+    server: "GitLabServer"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def do_PUT(self) -> None:
+        self._handle("PUT")
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _handle(self, method: str) -> None:
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+
+        time.sleep(self.server.latency)
+        status, data, headers = self.server.route(method, url.path, query, body)
+
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class GitLabServer(ThreadingHTTPServer):
+    """Stub of the GitLab merge request API over synthetic merge requests."""
+
+    daemon_threads = True
+
+    def __init__(self, spec: MergeRequestSpec, latency: float = 0.0):
+        super().__init__(("127.0.0.1", 0), GitLabHandler)
+        self.latency = latency
+        self.merge_requests = {}
+        for mr_id in range(1, spec.count + 1):
+            self.merge_requests[(spec.project_id, mr_id)] = generate_merge_request(
+                spec.project_id, mr_id, spec.files, spec.hunk, spec.seed
+            )
+        self.notes: Dict[Tuple[int, int], List[dict]] = {}
+        self.discussions: Dict[Tuple[int, int], List[dict]] = {}
+        self._lock = threading.Lock()
+
+    def route(
+        self, method: str, path: str, query: Dict[str, str], body: Optional[dict]
+    ) -> Tuple[int, Any, Dict[str, str]]:
+        if path == "/api/v4/user":
+            return 200, USER, {}
+
+        match = re.match(r"/api/v4/(?:projects|groups)/[^/]+/merge_requests$", path)
+        if match and method == "GET":
+            listed = [mr for mr, _ in self.merge_requests.values()]
+            return self._page(listed, query)
+
+        match = re.match(
+            r"/api/v4/projects/(\d+)/merge_requests/(\d+)(?:/(\w+))?(?:/(\d+))?$", path
+        )
+        if not match:
+            return 404, {"message": "404 Not Found"}, {}
+
+        key = (int(match.group(1)), int(match.group(2)))
+        resource = match.group(3)
+        if key not in self.merge_requests:
+            return 404, {"message": "404 Not found"}, {}
+        merge_request, changes = self.merge_requests[key]
+
+        if resource is None:
+            return 200, {**merge_request, "diff_refs": changes["diff_refs"]}, {}
+        if resource == "changes":
+            return 200, changes, {}
+        if resource == "diffs":
+            return self._page(changes["changes"], query)
+        if resource in ("notes", "discussions"):
+            with self._lock:
+                items = getattr(self, resource).setdefault(key, [])
+                if method == "GET":
+                    return self._page(list(items), query)
+                if method == "PUT":
+                    return 200, body, {}
+                note = {"id": len(items) + 1, "body": body["body"], "author": USER}
+                if resource == "discussions":
+                    position = {
+                        k: body.get(k) for k in ("new_path", "new_line", "old_path")
+                    }
+                    note = {
+                        "id": str(len(items) + 1),
+                        "notes": [{**note, "position": position}],
+                    }
+                items.append(note)
+                return 201, note, {}
+        return 404, {"message": "404 Not Found"}, {}
+
+    def _page(
+        self, items: List[Any], query: Dict[str, str]
+    ) -> Tuple[int, Any, Dict[str, str]]:
+        per_page = int(query.get("per_page", 20))
+        page = int(query.get("page", 1))
+        start = (page - 1) * per_page
+        more = start + per_page < len(items)
+        return (
+            200,
+            items[start : start + per_page],
+            {
+                "X-Next-Page": str(page + 1) if more else "",
+                "X-Total-Pages": str(max(-(-len(items) // per_page), 1)),
+            },
+        )
+
+
+def serve(spec: MergeRequestSpec, latency: float, connection: Any) -> None:
+    server = GitLabServer(spec, latency)
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeGitLab:
+    """GitLab stub running in a child process.
+
+    with FakeGitLab(MergeRequestSpec(count=10, files=50)) as gitlab:
+        os.environ["GITLAB_HOST"] = gitlab.url
+    """
+
+    def __init__(self, spec: MergeRequestSpec, latency: float = 0.0):
+        self.spec = spec
+        self.latency = latency
+        self.url = ""
+        self._process: Optional[multiprocessing.Process] = None
+
+    def __enter__(self) -> "FakeGitLab":
+        parent, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(
+            target=serve, args=(self.spec, self.latency, child), daemon=True
+        )
+        self._process.start()
+        self.url = f"http://127.0.0.1:{parent.recv()}"
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+
+def split_prompt(text: str) -> Tuple[str, str]:
+    """Prefix and prompt of a text sent as one message, split at the task."""
+    start = max((text.rfind(opening) for opening in TASK_OPENINGS), default=-1)
+    return (text[:start], text[start:]) if start > 0 else ("", text)
+
+
+def structured(text: str, schema: Dict[str, Any]) -> Any:
+    """Response matching a schema, lists go in the array property of the schema.
+
+    Returns:
+        The response as JSON data, None when the text is not JSON
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return None
+    if isinstance(data, list):
+        properties = schema.get("properties", {})
+        key = next(k for k, v in properties.items() if v.get("type") == "array")
+        data = {key: data}
+    return data
+
+
+class BatchAPIHandler(BaseHTTPRequestHandler):
+    """Handle the batch requests made by the OpenAI and Anthropic SDKs."""
+
+    server: "BatchAPIServer"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        self._handle("GET")
+
+    def do_POST(self) -> None:
+        self._handle("POST")
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _handle(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        status, data = self.server.route(
+            method, urlparse(self.path).path, self.headers, body
+        )
+
+        if isinstance(data, bytes):
+            payload, content_type = data, "application/octet-stream"
+        else:
+            payload, content_type = json.dumps(data).encode(), "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class BatchAPIServer(ThreadingHTTPServer):
+    """Stub of the files and batches API of OpenAI and the message batches API
+    of Anthropic, answering every request with a FakeProvider.
+
+    Batches are answered when they are created but report that they are still
+    running to the first polls of their status.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, provider: FakeProvider, polls: int = 1):
+        super().__init__(("127.0.0.1", 0), BatchAPIHandler)
+        self.provider = provider
+        self.polls = polls
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def route(
+        self, method: str, path: str, headers: Any, body: bytes
+    ) -> Tuple[int, Any]:
+        with self._lock:
+            if method == "POST" and path == "/v1/files":
+                return 200, self._upload(headers["Content-Type"], body)
+            match = re.match(r"/v1/files/([\w-]+)/content$", path)
+            if match and match.group(1) in self.files:
+                return 200, self.files[match.group(1)]
+
+            if method == "POST" and path == "/v1/batches":
+                return 200, self._openai_batch(json.loads(body))
+            if method == "POST" and path == "/v1/messages/batches":
+                return 200, self._anthropic_batch(json.loads(body))
+
+            match = re.match(r"/v1(/messages)?/batches/([\w-]+)(/results)?$", path)
+            if not match or match.group(2) not in self.batches:
+                return 404, {"error": {"type": "not_found_error", "message": path}}
+            batch = self.batches[match.group(2)]
+            if match.group(1) and match.group(3):
+                return 200, batch["results"]
+            return 200, self._poll(batch)
+
+    def _upload(self, content_type: str, body: bytes) -> Dict[str, Any]:
+        message = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body
+        )
+        content = next(
+            part.get_payload(decode=True)
+            for part in message.iter_parts()
+            if part.get_param("name", header="content-disposition") == "file"
+        )
+        file_id = f"file-{len(self.files) + 1}"
+        self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": "batch.jsonl",
+            "purpose": "batch",
+            "status": "processed",
+        }
+
+    def _openai_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        lines = []
+        for line in self.files[body["input_file_id"]].decode().splitlines():
+            request = json.loads(line)
+            params = request["body"]
+            prefix, prompt = split_prompt(params["messages"][0]["content"])
+            text = self.provider.respond(prompt, prefix)
+            if "response_format" in params:
+                schema = params["response_format"]["json_schema"]["schema"]
+                data = structured(text, schema)
+                text = text if data is None else json.dumps(data)
+            usage = self.provider._to_completion_response(text, prompt, prefix)
+            completion = {
+                "id": f"chatcmpl-{request['custom_id']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": params["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": usage.input_tokens,
+                    "completion_tokens": usage.output_tokens,
+                    "total_tokens": usage.tokens_used,
+                },
+            }
+            lines.append(
+                {
+                    "id": f"response-{request['custom_id']}",
+                    "custom_id": request["custom_id"],
+                    "response": {"status_code": 200, "body": completion},
+                    "error": None,
+                }
+            )
+
+        batch_id = f"batch-{len(self.batches) + 1}"
+        output_id = f"file-{len(self.files) + 1}"
+        self.files[output_id] = "\n".join(json.dumps(line) for line in lines).encode()
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "created_at": int(time.time()),
+            "status": "in_progress",
+            "output_file_id": None,
+            "error_file_id": None,
+        }
+        self.batches[batch_id] = {
+            "data": batch,
+            "polls": 0,
+            "done": {"status": "completed", "output_file_id": output_id},
+        }
+        return batch
+
+    def _anthropic_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        lines = []
+        for request in body["requests"]:
+            params = request["params"]
+            blocks = params["messages"][0]["content"]
+            prefix = blocks[0]["text"] if len(blocks) > 1 else ""
+            prompt = blocks[-1]["text"]
+            text = self.provider.respond(prompt, prefix)
+            content: Dict[str, Any] = {"type": "text", "text": text}
+            if "tools" in params:
+                data = structured(text, params["tools"][0]["input_schema"])
+                if data is not None:
+                    content = {
+                        "type": "tool_use",
+                        "id": f"toolu-{request['custom_id']}",
+                        "name": params["tools"][0]["name"],
+                        "input": data,
+                    }
+            usage = self.provider._to_completion_response(text, prompt, prefix)
+            message = {
+                "id": f"msg-{request['custom_id']}",
+                "type": "message",
+                "role": "assistant",
+                "model": params["model"],
+                "content": [content],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {
+                    "input_tokens": usage.input_tokens - usage.cached_input_tokens,
+                    "cache_read_input_tokens": usage.cached_input_tokens,
+                    "output_tokens": usage.output_tokens,
+                },
+            }
+            lines.append(
+                {
+                    "custom_id": request["custom_id"],
+                    "result": {"type": "succeeded", "message": message},
+                }
+            )
+
+        batch_id = f"msgbatch-{len(self.batches) + 1}"
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        batch = {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "in_progress",
+            "request_counts": {
+                "processing": len(lines),
+                "succeeded": 0,
+                "errored": 0,
+                "canceled": 0,
+                "expired": 0,
+            },
+            "created_at": now,
+            "expires_at": now,
+            "ended_at": None,
+            "cancel_initiated_at": None,
+            "archived_at": None,
+            "results_url": None,
+        }
+        self.batches[batch_id] = {
+            "data": batch,
+            "polls": 0,
+            "results": "\n".join(json.dumps(line) for line in lines).encode(),
+            "done": {
+                "processing_status": "ended",
+                "ended_at": now,
+                "request_counts": {
+                    **batch["request_counts"],
+                    "processing": 0,
+                    "succeeded": len(lines),
+                },
+                "results_url": f"{self.url}/v1/messages/batches/{batch_id}/results",
+            },
+        }
+        return batch
+
+    def _poll(self, batch: Dict[str, Any]) -> Dict[str, Any]:
+        batch["polls"] += 1
+        if batch["polls"] > self.polls:
+            batch["data"].update(batch["done"])
+        return batch["data"]
+
+
+class FakeBatchAPI:
+    """Batch API stub running in a thread of this process.
+
+    with FakeBatchAPI(FakeProvider(latency=0)) as api:
+        os.environ["OPENAI_BASE_URL"] = api.url + "/v1"
+        os.environ["ANTHROPIC_BASE_URL"] = api.url
+    """
+
+    def __init__(self, provider: Optional[FakeProvider] = None, polls: int = 1):
+        self.server = BatchAPIServer(provider or FakeProvider(latency=0), polls)
+        self.url = self.server.url
+        self._thread: Optional[threading.Thread] = None
+
+    def __enter__(self) -> "FakeBatchAPI":
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,103 @@
+"""Import-time benchmark of the sidekick CLI.
+
+Measures how long a fresh interpreter takes to import the CLI entry point and
+checks that no provider SDK is imported until a provider is selected. Exits
+with an error when the median import time is over the budget so it can run
+in CI to catch regressions.
+
+    python benchmarks/import_time.py --runs 10 --budget-ms 600
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must only be imported when they are needed
+LAZY_MODULES = ["openai", "anthropic", "google.generativeai", "boto3", "tiktoken"]
+
+CHECK = """
+import sys
+import {module}
+print(",".join(m for m in {lazy!r} if m in sys.modules))
+"""
+
+
+def measure(module: str) -> float:
+    """Seconds taken by a fresh interpreter to import a module."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def baseline() -> float:
+    """Seconds taken by a fresh interpreter to start without imports."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], cwd=ROOT, check=True)
+    return time.perf_counter() - start
+
+
+def eager_modules(module: str) -> list:
+    """Lazy modules that were imported anyway by importing a module."""
+    output = subprocess.run(
+        [sys.executable, "-c", CHECK.format(module=module, lazy=LAZY_MODULES)],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+    return [m for m in output.split(",") if m]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="main", help="Module to import")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=float(os.getenv("IMPORT_BUDGET_MS", "600")),
+        help="Maximum median import time in milliseconds, interpreter start excluded",
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    # Warm up the filesystem and bytecode caches
+    measure(args.module)
+
+    startup = statistics.median(baseline() for _ in range(args.runs))
+    times = [measure(args.module) - startup for _ in range(args.runs)]
+    median_ms = statistics.median(times) * 1000
+    eager = eager_modules(args.module)
+
+    result = {
+        "module": args.module,
+        "runs": args.runs,
+        "median_ms": round(median_ms, 1),
+        "min_ms": round(min(times) * 1000, 1),
+        "max_ms": round(max(times) * 1000, 1),
+        "budget_ms": args.budget_ms,
+        "eager_modules": eager,
+    }
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(
+            f"import {args.module}: median {result['median_ms']} ms "
+            f"(min {result['min_ms']}, max {result['max_ms']}, budget {args.budget_ms} ms)"
+        )
+        if eager:
+            print(f"Imported eagerly: {', '.join(eager)}")
+
+    if median_ms > args.budget_ms or eager:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""Offline benchmarks of sidekick's own overhead and scaling.
+
+Runs scenarios covering every action, merge request sizes from 1 to 5,000
+files, hunks from a few lines to thousands and several concurrency levels
+against a fake LLM provider and a stub GitLab server, so no tokens are spent
+and no network is used. The time is mostly the simulated latency, the CPU
+time is sidekick's own work. Results are compared with stored baselines and
+the run fails when a scenario got slower or used more tokens or requests.
+
+    python benchmarks/suite.py                  # quick suite against the baselines
+    python benchmarks/suite.py --suite full -k files
+    python benchmarks/suite.py --save-baseline  # after an intended change
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import zlib
+from contextlib import redirect_stdout
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from batch import BatchRunner  # noqa: E402
+from fakes import FakeGitLab, FakeProvider, MergeRequestSpec  # noqa: E402
+from metrics import get_metrics  # noqa: E402
+from providers import MeteredProvider  # noqa: E402
+from repository import GitLabRepository  # noqa: E402
+from rules import Rule  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+ALL_ACTIONS = ["review_code", "review_format", "label", "summarize"]
+
+# All the actions with --fuse
+FUSED_ACTIONS = ["review_code", "review_format+label+summarize"]
+
+RULES = [
+    Rule(
+        "naming.md",
+        "Naming",
+        "",
+        "true",
+        "Use descriptive names for variables and functions",
+    ),
+    Rule(
+        "errors.md",
+        "Errors",
+        "",
+        "false",
+        "Handle errors explicitly, never ignore them",
+    ),
+    Rule(
+        "python.md", "Python", "**/*.py", "false", "Add type hints to public functions"
+    ),
+    Rule("javascript.md", "JavaScript", "**/*.js", "false", "Prefer const over let"),
+    Rule(
+        "format.title.md",
+        "Title",
+        "",
+        "false",
+        "The title is a short imperative sentence",
+    ),
+    Rule(
+        "format.description.md",
+        "Description",
+        "",
+        "false",
+        "The description explains why",
+    ),
+]
+
+# Times compared with the baselines with a tolerance, and the seconds always
+# allowed over it so that very short scenarios don't fail on noise
+TIMES = ["seconds", "cpu_seconds"]
+TIME_SLACK = 0.05
+
+# Counters are deterministic, any increase is a regression
+COUNTERS = ["llm_calls", "input_tokens", "output_tokens", "repository_requests"]
+
+PHASES = ["fetch", "filter", "prompt", "llm", "parse", "post"]
+
+
+@dataclass
+class Scenario:
+    """Merge requests reviewed by some actions at a concurrency level."""
+
+    name: str
+    actions: List[str]
+    files: int = 50
+    hunk: str = "medium"
+    # Merge requests reviewed in a batch
+    merge_requests: int = 1
+    # Batch workers reviewing merge requests at the same time
+    workers: int = 1
+    # Completions in flight for the chunks of a review
+    concurrency: int = 16
+    suites: List[str] = field(default_factory=lambda: ["quick", "full"])
+
+
+SCENARIOS = [
+    Scenario("review_code", ["review_code"]),
+    Scenario("review_format", ["review_format"]),
+    Scenario("label", ["label"]),
+    Scenario("summarize", ["summarize"]),
+    Scenario("all_actions", ALL_ACTIONS),
+    Scenario("all_actions_fused", FUSED_ACTIONS),
+    Scenario("files_1", ["review_code"], files=1, hunk="small"),
+    Scenario("files_500", ["review_code"], files=500),
+    Scenario("files_5000", ["review_code"], files=5000, hunk="small", suites=["full"]),
+    Scenario(
+        "files_5000_all_actions", ALL_ACTIONS, files=5000, hunk="small", suites=["full"]
+    ),
+    Scenario(
+        "files_5000_all_actions_fused",
+        FUSED_ACTIONS,
+        files=5000,
+        hunk="small",
+        suites=["full"],
+    ),
+    Scenario("hunks_large", ["review_code"], files=100, hunk="large", suites=["full"]),
+    Scenario("hunks_huge", ["review_code"], files=10, hunk="huge"),
+    Scenario("chunks_concurrency_1", ["review_code"], files=500, concurrency=1),
+    Scenario("workers_1", ALL_ACTIONS, files=20, merge_requests=16, workers=1),
+    Scenario("workers_4", ALL_ACTIONS, files=20, merge_requests=16, workers=4),
+    Scenario("workers_16", ALL_ACTIONS, files=20, merge_requests=16, workers=16),
+    Scenario(
+        "workers_64",
+        ALL_ACTIONS,
+        files=20,
+        merge_requests=128,
+        workers=64,
+        suites=["full"],
+    ),
+]
+
+
+def run_scenario(
+    scenario: Scenario, args: argparse.Namespace, run: int = 0
+) -> Dict[str, float]:
+    """Review the merge requests of a scenario and measure the run."""
+    spec = MergeRequestSpec(
+        count=scenario.merge_requests,
+        files=scenario.files,
+        hunk=scenario.hunk,
+        # Different diffs per scenario and run, so that token counts memoized
+        # by a previous run don't make the next one faster
+        seed=zlib.crc32(f"{scenario.name}:{run}".encode()),
+    )
+    with FakeGitLab(spec, args.gitlab_latency) as gitlab:
+        os.environ["GITLAB_HOST"] = gitlab.url
+        os.environ.setdefault("GITLAB_TOKEN", "benchmark")
+
+        provider = FakeProvider(
+            latency=args.latency,
+            tokens_per_second=args.tokens_per_second,
+            concurrency=scenario.concurrency,
+        )
+        runner = BatchRunner(
+            scenario.actions,
+            MeteredProvider(provider),
+            GitLabRepository(),
+            RULES,
+            workers=scenario.workers,
+            post=True,
+        )
+
+        metrics = get_metrics()
+        metrics.reset()
+        cpu = time.process_time()
+        # The reviews print their progress, only the results matter here
+        with redirect_stdout(io.StringIO()):
+            results, elapsed = runner.run(
+                [(spec.project_id, i + 1) for i in range(spec.count)], io.StringIO()
+            )
+        cpu = time.process_time() - cpu
+
+    result = {
+        "seconds": round(elapsed, 3),
+        "cpu_seconds": round(cpu, 3),
+        "failed": sum(1 for r in results if r.status != "ok"),
+        "llm_calls": metrics.total("sidekick_llm_calls_total"),
+        "input_tokens": metrics.total("sidekick_llm_input_tokens_total"),
+        "cached_input_tokens": metrics.total("sidekick_llm_cached_input_tokens_total"),
+        "output_tokens": metrics.total("sidekick_llm_output_tokens_total"),
+        "repository_requests": metrics.total("sidekick_repository_requests_total"),
+    }
+    for phase in PHASES:
+        result[f"{phase}_seconds"] = round(
+            metrics.total("sidekick_action_phase_seconds", phase=phase), 3
+        )
+    return result
+
+
+def median_run(scenario: Scenario, args: argparse.Namespace) -> Dict[str, float]:
+    """Run a scenario several times and keep the median of every metric."""
+    runs = [run_scenario(scenario, args, run) for run in range(args.runs)]
+    return {
+        key: round(statistics.median(run[key] for run in runs), 3) for key in runs[0]
+    }
+
+
+def compare(
+    name: str,
+    result: Dict[str, float],
+    baseline: Optional[Dict[str, float]],
+    tolerance: float,
+) -> List[str]:
+    """Regressions of a scenario result over its baseline."""
+    if baseline is None:
+        return []
+    regressions = []
+    for metric in TIMES + COUNTERS:
+        if metric not in baseline:
+            continue
+        limit = baseline[metric]
+        if metric in TIMES:
+            limit = limit * (1 + tolerance) + TIME_SLACK
+        if result[metric] > limit:
+            regressions.append(
+                f"{name}: {metric} {result[metric]:g} > baseline {baseline[metric]:g}"
+            )
+    return regressions
+
+
+def format_result(
+    name: str, result: Dict[str, float], baseline: Optional[Dict[str, float]]
+) -> str:
+    def delta(metric: str) -> str:
+        if not baseline or not baseline.get(metric):
+            return ""
+        return f" ({(result[metric] / baseline[metric] - 1) * 100:+.0f}%)"
+
+    phases = ", ".join(
+        f"{phase} {result[f'{phase}_seconds']:.2f}s"
+        for phase in PHASES
+        if result[f"{phase}_seconds"]
+    )
+    return (
+        f"{name:<26} {result['seconds']:7.2f}s{delta('seconds'):<7} "
+        f"cpu {result['cpu_seconds']:6.2f}s{delta('cpu_seconds'):<7} "
+        f"{result['llm_calls']:4.0f} calls {result['input_tokens']:9.0f} tokens{delta('input_tokens'):<7} "
+        f"{result['repository_requests']:5.0f} requests"
+        + (f", {result['failed']:.0f} failed" if result["failed"] else "")
+        + f"\n{'':<26} {phases}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--suite", choices=["quick", "full"], default="quick")
+    parser.add_argument(
+        "-k",
+        "--filter",
+        default="",
+        help="Only run the scenarios whose name contains this",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=1, help="Runs per scenario, the median is kept"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="Seconds until the first token of a completion",
+    )
+    parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=2000.0,
+        help="Generation speed of completions",
+    )
+    parser.add_argument(
+        "--gitlab-latency",
+        type=float,
+        default=0.0,
+        help="Seconds added to every GitLab request",
+    )
+    parser.add_argument(
+        "--baseline", default=BASELINES, help="File of the stored baselines"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the new baselines",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=float(os.getenv("BENCHMARK_TOLERANCE", "0.25")),
+        help="Relative slowdown over the baseline allowed before failing",
+    )
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    scenarios = [
+        s for s in SCENARIOS if args.suite in s.suites and args.filter in s.name
+    ]
+    results = {}
+    regressions = []
+    for scenario in scenarios:
+        result = median_run(scenario, args)
+        results[scenario.name] = result
+        baseline = baselines.get(scenario.name)
+        regressions.extend(compare(scenario.name, result, baseline, args.tolerance))
+
+        if args.json:
+            print(json.dumps({"scenario": scenario.name, **result}))
+        else:
+            print(format_result(scenario.name, result, baseline), flush=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({**baselines, **results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return
+
+    for regression in regressions:
+        print(f"Regression: {regression}", file=sys.stderr)
+    if regressions or any(result["failed"] for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
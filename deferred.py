@@ -0,0 +1,402 @@
+import argparse
+import os
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+from colorama import Fore, Style, init
+from dotenv import load_dotenv
+from actions import Action, ActionResult, ReviewCodeAction
+from actions.base import NO_RESPONSE, UNPARSEABLE
+from actions.prompts import Prompt
+from actions.review_code import Chunk
+from batch import add_code_request_arguments, gather_code_requests
+from main import (
+    add_fuse_argument,
+    fetch_code_request,
+    get_action,
+    get_repository,
+    parse_actions,
+)
+from providers import BatchRequest, CompletionResponse, LLMProvider, get_provider_class
+from providers.batches import BatchStore
+from repository import CodeChange, CodeRequest, DiffRefs, Repository
+from rules import Rule, load_rules
+
+init()
+load_dotenv()
+
+# Maximum number of requests per batch, the providers accept up to 50,000
+MAX_REQUESTS = int(os.getenv("DEFERRED_MAX_REQUESTS", "10000"))
+
+# Seconds between polls of the pending batches when waiting for them
+POLL_INTERVAL = float(os.getenv("DEFERRED_POLL_INTERVAL", "60"))
+
+# Times the results of an action are handled before giving up on them
+MAX_ATTEMPTS = int(os.getenv("DEFERRED_MAX_ATTEMPTS", "3"))
+
+
+def dump_code_request(cr: CodeRequest) -> Dict[str, Any]:
+    return {
+        "title": cr.title,
+        "description": cr.description,
+        "changes": [
+            {"path": change.path, "diff": change.diff} for change in cr.changes
+        ],
+        "project_id": cr.project_id,
+        "mr_id": cr.mr_id,
+        "base_branch": cr.base_branch,
+        "head_sha": cr.head_sha,
+        "diff_refs": cr.diff_refs.to_dict(),
+    }
+
+
+def load_code_request(data: Dict[str, Any]) -> CodeRequest:
+    changes = data["changes"]
+    if "diff_refs" in data:
+        diff_refs = DiffRefs(**data["diff_refs"])
+    else:
+        # Snapshots of older versions have the refs in every change
+        first = changes[0] if changes else {}
+        diff_refs = DiffRefs(
+            first.get("base_sha", ""),
+            first.get("start_sha", ""),
+            first.get("head_sha", ""),
+        )
+    return CodeRequest(
+        **{
+            **data,
+            "changes": [
+                CodeChange(change["path"], change["diff"], diff_refs)
+                for change in changes
+            ],
+            "diff_refs": diff_refs,
+        }
+    )
+
+
+def retryable(error: str) -> bool:
+    """Whether handling the results again may succeed, e.g. if posting failed.
+
+    Completions of a batch don't change, handling them again doesn't help if
+    they are missing or could not be parsed.
+    """
+    return any(part not in (NO_RESPONSE, UNPARSEABLE) for part in error.split("; "))
+
+
+def action_prompts(
+    action: Action, cr: CodeRequest
+) -> List[Tuple[Prompt, Optional[Dict[str, Any]]]]:
+    """Prompts of an action for a code request, with the chunk of each review."""
+    if not isinstance(action, ReviewCodeAction):
+        return [(action.build_prompt(cr), None)]
+
+    if not cr.changes:
+        return []
+    return [
+        (
+            action.build_chunk_prompt(cr, chunk),
+            {
+                "rules": [rule.filename for rule in chunk.rules],
+                "changes": [index for index, _ in chunk.changes],
+            },
+        )
+        for chunk in action.split(cr)
+    ]
+
+
+def submit(
+    code_requests: List[Tuple[int, int]],
+    action_names: List[str],
+    provider: LLMProvider,
+    repository: Repository,
+    rules: List[Rule],
+    store: BatchStore,
+    filter_noise: bool = True,
+    verbose: bool = False,
+) -> List[str]:
+    """Submit the prompts of the actions for the code requests as batches.
+
+    The code requests are stored as they are now, the results are posted
+    against these versions even if they got new commits in the meantime.
+
+    Returns:
+        The IDs of the batches submitted
+    """
+    requests: List[BatchRequest] = []
+    contexts: Dict[str, Dict[str, Any]] = {}
+    snapshots: Dict[str, Dict[str, Any]] = {}
+
+    for project_id, cr_id in dict.fromkeys(code_requests):
+        try:
+            cr = fetch_code_request(
+                repository, project_id, cr_id, filter_noise, verbose
+            )
+        except Exception as e:
+            print(f"{Fore.RED}Could not get {project_id}!{cr_id}: {e}{Style.RESET_ALL}")
+            continue
+
+        key = f"{project_id}!{cr_id}"
+        snapshots[key] = dump_code_request(cr)
+        for name in action_names:
+            try:
+                action = get_action(name, provider, repository, rules, verbose)
+                prompts = action_prompts(action, cr)
+            except Exception as e:
+                print(f"{Fore.RED}Action {name} failed for {key}: {e}{Style.RESET_ALL}")
+                continue
+
+            for index, (prompt, chunk) in enumerate(prompts):
+                # Custom IDs can't have the + of fused actions
+                custom_id = f"{project_id}-{cr_id}-{name.replace('+', '-')}-{index}"
+                requests.append(
+                    BatchRequest(
+                        custom_id=custom_id,
+                        prompt=prompt.suffix,
+                        prefix=prompt.prefix,
+                        response_schema=action.response_schema(),
+                    )
+                )
+                contexts[custom_id] = {
+                    "code_request": key,
+                    "action": name,
+                    "chunk": chunk,
+                }
+
+    batch_ids = []
+    for start in range(0, len(requests), MAX_REQUESTS):
+        part = requests[start : start + MAX_REQUESTS]
+        batch_id = provider.submit_batch(part)
+        part_contexts = {r.custom_id: contexts[r.custom_id] for r in part}
+        keys = {context["code_request"] for context in part_contexts.values()}
+        store.add(
+            batch_id,
+            provider.name,
+            getattr(provider, "model", ""),
+            part_contexts,
+            {key: snapshots[key] for key in keys},
+        )
+        batch_ids.append(batch_id)
+        print(
+            f"{Fore.WHITE}Submitted batch {batch_id} with {len(part)} prompts{Style.RESET_ALL}"
+        )
+
+    return batch_ids
+
+
+def process_results(
+    batch_id: str,
+    results: Dict[str, Optional[CompletionResponse]],
+    provider: LLMProvider,
+    repository: Repository,
+    rules: List[Rule],
+    store: BatchStore,
+    post: bool = False,
+    verbose: bool = False,
+) -> ActionResult:
+    """Hand the results of a batch to their actions.
+
+    The requests of the actions that succeeded are dropped from the store, so
+    that only the failed ones are handled again when the batch is retried.
+    Actions are given up on after MAX_ATTEMPTS, or right away when their
+    completions are missing or could not be parsed.
+
+    Returns:
+        The tokens used and the errors of the actions to handle again, if any
+    """
+    groups: Dict[Tuple[str, str], List[Tuple[str, Dict[str, Any]]]] = defaultdict(list)
+    for custom_id, context in store.contexts(batch_id).items():
+        groups[(context["code_request"], context["action"])].append(
+            (custom_id, context)
+        )
+
+    rules_by_file = {rule.filename: rule for rule in rules}
+    tokens_used = 0
+    errors = []
+    for (key, name), requests in groups.items():
+        print(f"\n{Fore.WHITE}Running action: {name} on {key}{Style.RESET_ALL}")
+        try:
+            cr = load_code_request(store.snapshot(batch_id, key))
+            action = get_action(name, provider, repository, rules, verbose)
+
+            if isinstance(action, ReviewCodeAction):
+                chunks = [
+                    Chunk(
+                        [
+                            rules_by_file[f]
+                            for f in context["chunk"]["rules"]
+                            if f in rules_by_file
+                        ],
+                        [(i, cr.changes[i]) for i in context["chunk"]["changes"]],
+                    )
+                    for _, context in requests
+                ]
+                result = action.merge_results(
+                    cr,
+                    chunks,
+                    [results.get(custom_id) for custom_id, _ in requests],
+                    post,
+                )
+            else:
+                response = results.get(requests[0][0])
+                if response is None:
+                    result = action.no_response()
+                else:
+                    result = action.process_result(cr, response, post)
+        except Exception as e:
+            result = ActionResult(0, str(e))
+
+        tokens_used += result.tokens_used
+        custom_ids = [custom_id for custom_id, _ in requests]
+        if result.ok:
+            store.handled(batch_id, custom_ids)
+            continue
+
+        attempts = store.failed(batch_id, custom_ids)
+        if not retryable(result.error) or attempts >= MAX_ATTEMPTS:
+            print(
+                f"{Fore.RED}Action {name} failed for {key}, giving up after "
+                f"{attempts} attempts: {result.error}{Style.RESET_ALL}"
+            )
+            store.handled(batch_id, custom_ids)
+        else:
+            print(
+                f"{Fore.RED}Action {name} failed for {key}, attempt {attempts} of "
+                f"{MAX_ATTEMPTS}: {result.error}{Style.RESET_ALL}"
+            )
+            errors.append(f"{name} on {key}: {result.error}")
+
+    return ActionResult(tokens_used, "; ".join(errors) or None)
+
+
+def collect(
+    repository: Repository,
+    rules: List[Rule],
+    store: BatchStore,
+    post: bool = False,
+    verbose: bool = False,
+) -> Tuple[int, int]:
+    """Process the results of the batches that completed.
+
+    Returns:
+        The tokens used by the batches collected and the batches still running
+    """
+    providers: Dict[str, LLMProvider] = {}
+    tokens_used = 0
+    running = 0
+    for batch_id, provider_name, model, submitted in store.pending():
+        if provider_name not in providers:
+            providers[provider_name] = get_provider_class(provider_name)()
+        provider = providers[provider_name]
+
+        results = provider.get_batch_results(batch_id)
+        if results is None:
+            running += 1
+            if verbose:
+                print(
+                    f"{Fore.WHITE}Batch {batch_id} is still running after "
+                    f"{(time.time() - submitted) / 60:.0f} minutes{Style.RESET_ALL}"
+                )
+            continue
+
+        print(
+            f"{Fore.WHITE}Collecting batch {batch_id} of {provider_name}/{model}{Style.RESET_ALL}"
+        )
+        result = process_results(
+            batch_id, results, provider, repository, rules, store, post, verbose
+        )
+        tokens_used += result.tokens_used
+        if result.ok:
+            store.collected(batch_id)
+        else:
+            print(
+                f"{Fore.RED}Batch {batch_id} stays pending, its failed actions are "
+                f"handled again by the next collect{Style.RESET_ALL}"
+            )
+
+    return tokens_used, running
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Review merge requests through the batch APIs of the providers"
+    )
+    parser.add_argument(
+        "-r", "--rules", help="Optional path to rules file or directory"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Enable verbose output with colors"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = commands.add_parser(
+        "submit", help="Submit the prompts of merge requests as batches"
+    )
+    submit_parser.add_argument(
+        "actions",
+        help="Comma-separated list of actions to perform (review_code,review_format,label,summarize)",
+    )
+    add_code_request_arguments(submit_parser)
+    submit_parser.add_argument(
+        "--no-filter",
+        action="store_true",
+        help="Review lockfiles, generated, vendored and whitespace-only changes too",
+    )
+    add_fuse_argument(submit_parser)
+
+    collect_parser = commands.add_parser(
+        "collect", help="Process the results of the batches that completed"
+    )
+    collect_parser.add_argument(
+        "-p", "--post", action="store_true", help="Post results to merge/pull requests"
+    )
+    collect_parser.add_argument(
+        "-w",
+        "--wait",
+        action="store_true",
+        help=f"Poll every {POLL_INTERVAL:g}s until all the batches are collected",
+    )
+    args = parser.parse_args()
+
+    try:
+        repository = get_repository()
+        rules = load_rules(args.rules)
+        store = BatchStore()
+
+        if args.command == "submit":
+            # Batches are submitted to the first provider, there is no failover
+            provider_name = (
+                os.getenv("PROVIDER", "openai").lower().split(",")[0].strip()
+            )
+            submit(
+                gather_code_requests(args, repository),
+                parse_actions(args.actions, args.fuse),
+                get_provider_class(provider_name)(),
+                repository,
+                rules,
+                store,
+                filter_noise=not args.no_filter,
+                verbose=args.verbose,
+            )
+            return
+
+        while True:
+            tokens_used, running = collect(
+                repository, rules, store, post=args.post, verbose=args.verbose
+            )
+            if tokens_used:
+                print(f"{Fore.WHITE}Total tokens used: {tokens_used}{Style.RESET_ALL}")
+            if not running or not args.wait:
+                print(f"{Fore.WHITE}{running} batches still running{Style.RESET_ALL}")
+                break
+            time.sleep(POLL_INTERVAL)
+
+    except ValueError as e:
+        print(f"Error: {e}")
+    except NotImplementedError as e:
+        print(f"{Fore.RED}Error: {e}{Style.RESET_ALL}")
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
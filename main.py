@@ -1,23 +1,30 @@
 import os
 import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 from colorama import init, Fore, Style
 from providers import (
-    OpenAIProvider,
-    AnthropicProvider,
-    GoogleProvider,
-    BedrockProvider,
+    CachedProvider,
+    FailoverProvider,
     LLMProvider,
+    MeteredProvider,
+    get_provider_class,
+    rate_limited,
 )
-from repository.code_request import CodeRequest
-from repository import Repository, GitLabRepository
+from repository.code_request import CodeChange, CodeRequest
+from repository import FilterResult, Repository, GitLabRepository, NoiseFilter
 from actions import (
     ReviewCodeAction,
     ReviewFormatAction,
     SummarizeAction,
     LabelAction,
+    FusedAction,
     Action,
+    ActionResult,
 )
+from metrics import PhaseRecord, get_metrics
 from rules import load_rules
 
 # Initialize colorama
@@ -26,24 +33,29 @@ init()
 # Load environment variables
 load_dotenv()
 
+# Actions that can run with a single prompt, see FusedAction
+FUSABLE_ACTIONS = ["summarize", "label", "review_format"]
 
-def get_provider() -> LLMProvider:
-    provider_name = os.getenv("PROVIDER", "openai").lower()
 
-    providers = {
-        "openai": OpenAIProvider,
-        "anthropic": AnthropicProvider,
-        "google": GoogleProvider,
-        "bedrock": BedrockProvider,
-    }
+def get_provider(cache: bool = False) -> LLMProvider:
+    provider_names = [
+        name.strip() for name in os.getenv("PROVIDER", "openai").lower().split(",")
+    ]
+    # Metered inside the cache so that only actual calls are recorded, and
+    # per backend so that hedged and failed over calls are recorded too. The
+    # rate limiter is outside the metering so that waiting for the quota is
+    # not counted as latency of the provider.
+    providers = [
+        rate_limited(MeteredProvider(get_provider_class(name)()))
+        for name in provider_names
+        if name
+    ]
+    provider = providers[0] if len(providers) == 1 else FailoverProvider(providers)
 
-    if provider_name not in providers:
-        raise ValueError(
-            f"Invalid provider '{provider_name}'. "
-            f"Must be one of: {', '.join(providers.keys())}"
-        )
+    if cache:
+        provider = CachedProvider(provider)
 
-    return providers[provider_name]()
+    return provider
 
 
 def get_repository() -> Repository:
@@ -67,6 +79,19 @@ def get_action(
     rules: list,
     verbose: bool = False,
 ) -> Action:
+    # Fused actions are named after the actions they run, e.g. summarize+label
+    if "+" in action_name:
+        return FusedAction(
+            provider,
+            repository,
+            rules,
+            verbose,
+            [
+                get_action(name, provider, repository, rules, verbose)
+                for name in action_name.split("+")
+            ],
+        )
+
     actions = {
         "review_code": ReviewCodeAction,
         "review_format": ReviewFormatAction,
@@ -83,6 +108,316 @@ def get_action(
     return actions[action_name](provider, repository, rules, verbose)
 
 
+def get_review_request(
+    repository: Repository, code_request: CodeRequest
+) -> CodeRequest:
+    """Get the code request with the changes not reviewed yet by sidekick."""
+    reviewed_sha = repository.get_reviewed_sha(
+        code_request.project_id, code_request.mr_id
+    )
+    if not reviewed_sha:
+        return code_request
+
+    if reviewed_sha == code_request.head_sha:
+        print(f"{Fore.WHITE}No changes since last review{Style.RESET_ALL}")
+    else:
+        print(
+            f"{Fore.WHITE}Reviewing changes since {reviewed_sha[:8]}{Style.RESET_ALL}"
+        )
+
+    try:
+        return repository.get_code_request_delta(code_request, reviewed_sha)
+    except Exception as e:
+        # e.g. the reviewed commit was removed by a force push
+        print(
+            f"{Fore.RED}Could not get changes since {reviewed_sha[:8]}, reviewing all changes: {e}{Style.RESET_ALL}"
+        )
+        return code_request
+
+
+def fetch_code_request(
+    repository: Repository,
+    project_id: int,
+    cr_id: int,
+    filter_noise: bool = True,
+    verbose: bool = False,
+) -> CodeRequest:
+    """Fetch a code request, filtering the noise out of its changes.
+
+    The changes are filtered as their pages are downloaded, so the lockfiles
+    and generated files of big merge requests are never all in memory.
+    """
+    if not filter_noise:
+        with get_metrics().phase("all", "fetch"):
+            return repository.get_code_request(project_id, cr_id)
+
+    noise = NoiseFilter.from_config()
+    result = FilterResult()
+    filter_seconds = 0.0
+
+    def keep(change: CodeChange) -> Optional[CodeChange]:
+        nonlocal filter_seconds
+        start = time.monotonic()
+        try:
+            return noise.filter(change, result)
+        finally:
+            filter_seconds += time.monotonic() - start
+
+    start = time.monotonic()
+    try:
+        code_request = repository.get_code_request(project_id, cr_id, keep)
+    finally:
+        metrics = get_metrics()
+        metrics.record(
+            PhaseRecord("all", "fetch", time.monotonic() - start - filter_seconds)
+        )
+        metrics.record(PhaseRecord("all", "filter", filter_seconds))
+
+    report_filter(result, verbose)
+    return code_request
+
+
+def filter_code_request(
+    code_request: CodeRequest, verbose: bool = False
+) -> CodeRequest:
+    """Remove lockfiles, generated files and other noise from a code request."""
+    result = NoiseFilter.from_config().apply(code_request.changes)
+    report_filter(result, verbose)
+    code_request.changes = result.changes
+    return code_request
+
+
+def report_filter(result: FilterResult, verbose: bool = False) -> None:
+    """Print the noise filtered out of a code request."""
+    if result.removed or result.hunks_removed:
+        print(
+            f"{Fore.WHITE}Filtered {len(result.removed)} noise files and {result.hunks_removed} whitespace-only hunks, "
+            f"saving {result.tokens_saved} tokens{Style.RESET_ALL}"
+        )
+    if verbose:
+        for change, reason in result.removed:
+            print(f"{Fore.WHITE}Filtered {change.path} ({reason}){Style.RESET_ALL}")
+
+
+def run_action(
+    action_name: str,
+    code_request: CodeRequest,
+    provider: LLMProvider,
+    repository: Repository,
+    rules: list,
+    post: bool = False,
+    verbose: bool = False,
+) -> ActionResult:
+    """Run a single action and return its result.
+
+    Errors are reported and swallowed so that one failing action does not
+    abort the others running against the same code request. The result of a
+    failed action has the error and the tokens it used before failing.
+    """
+    print(f"\n{Fore.WHITE}Running action: {action_name}{Style.RESET_ALL}")
+
+    action = None
+    try:
+        action = get_action(action_name, provider, repository, rules, verbose)
+        result = action.run(code_request, post)
+    except Exception as e:
+        print(f"{Fore.RED}Action {action_name} failed: {e}{Style.RESET_ALL}")
+        return ActionResult(action.tokens_used if action else 0, str(e))
+
+    if verbose:
+        print(f"\n{Fore.WHITE}Action {action_name} completed{Style.RESET_ALL}")
+
+    return result
+
+
+def run_actions(
+    action_names: List[str],
+    code_request: CodeRequest,
+    provider: LLMProvider,
+    repository: Repository,
+    rules: list,
+    post: bool = False,
+    verbose: bool = False,
+    jobs: int = 1,
+    review_request: Optional[CodeRequest] = None,
+) -> Dict[str, ActionResult]:
+    """Run the actions against the same code request and return their results.
+
+    With more than one job the actions are fanned out on a thread pool so the
+    wall-clock time is close to the slowest action instead of the sum of all.
+    review_request, when given, replaces the code request for review_code.
+
+    Returns:
+        The result of every action by name
+    """
+
+    def request_for(name: str) -> CodeRequest:
+        if name == "review_code" and review_request is not None:
+            return review_request
+        return code_request
+
+    if jobs <= 1 or len(action_names) <= 1:
+        return {
+            name: run_action(
+                name, request_for(name), provider, repository, rules, post, verbose
+            )
+            for name in action_names
+        }
+
+    with ThreadPoolExecutor(max_workers=min(jobs, len(action_names))) as executor:
+        futures = {
+            name: executor.submit(
+                run_action,
+                name,
+                request_for(name),
+                provider,
+                repository,
+                rules,
+                post,
+                verbose,
+            )
+            for name in action_names
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def parse_actions(actions: str, fuse: bool = False) -> List[str]:
+    """Parse and validate a comma-separated list of actions.
+
+    With fuse, the actions that can run with a single prompt are replaced by
+    one fused action, if there are more than one of them.
+    """
+    action_names = [action.strip() for action in actions.split(",")]
+
+    valid_actions = ["review_code", "review_format", "label", "summarize"]
+    invalid_actions = [action for action in action_names if action not in valid_actions]
+    if invalid_actions:
+        raise ValueError(
+            f"Invalid action(s): {', '.join(invalid_actions)}. "
+            f"Must be one of: {', '.join(valid_actions)}"
+        )
+
+    fused = [action for action in action_names if action in FUSABLE_ACTIONS]
+    if fuse and len(fused) > 1:
+        index = action_names.index(fused[0])
+        action_names = [action for action in action_names if action not in fused]
+        action_names.insert(index, "+".join(fused))
+
+    return action_names
+
+
+def add_fuse_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--fuse",
+        action="store_true",
+        default=os.getenv("SIDEKICK_FUSE", "").lower() in ("1", "true", "yes"),
+        help="Run summarize, label and review_format with a single prompt",
+    )
+
+
+def review_code_request(
+    project_id: int,
+    cr_id: int,
+    action_names: List[str],
+    provider: LLMProvider,
+    repository: Repository,
+    rules: list,
+    post: bool = False,
+    verbose: bool = False,
+    jobs: int = 1,
+    incremental: bool = False,
+    filter_noise: bool = True,
+    tag: bool = False,
+) -> Dict[str, ActionResult]:
+    """Fetch a code request and run the actions on it.
+
+    Returns:
+        The result of every action by name, see run_actions
+    """
+    code_request = fetch_code_request(
+        repository, project_id, cr_id, filter_noise, verbose
+    )
+
+    if verbose:
+        print(f"\n{Fore.WHITE}Changes from repository:{Style.RESET_ALL}")
+        for change in code_request.changes:
+            print(f"\n{Fore.WHITE}File: {change.path}{Style.RESET_ALL}")
+            print(f"{Fore.WHITE}{change.diff}{Style.RESET_ALL}")
+
+    review_request = None
+    if incremental and "review_code" in action_names:
+        with get_metrics().phase("all", "fetch"):
+            review_request = get_review_request(repository, code_request)
+
+    # The delta of an incremental review has new hunks to trim
+    if (
+        filter_noise
+        and review_request is not None
+        and review_request is not code_request
+    ):
+        with get_metrics().phase("all", "filter"):
+            review_request = filter_code_request(review_request)
+
+    results = run_actions(
+        action_names,
+        code_request,
+        provider,
+        repository,
+        rules,
+        post,
+        verbose,
+        jobs,
+        review_request,
+    )
+    # Commits of a failed review are reviewed again on the next run
+    review = results.get("review_code")
+    if incremental and post and review is not None:
+        if review.ok:
+            repository.set_reviewed_sha(project_id, cr_id, code_request.head_sha)
+        else:
+            print(
+                f"{Fore.RED}Not recording the reviewed commit, review_code failed: "
+                f"{review.error}{Style.RESET_ALL}"
+            )
+
+    if tag:
+        repository.label_code_request(project_id, cr_id, ["sidekick"])
+
+    return results
+
+
+def failed_actions(results: Dict[str, ActionResult]) -> Optional[str]:
+    """Errors of the actions that failed as one, None if they all succeeded."""
+    errors = [
+        f"{name}: {result.error}" for name, result in results.items() if not result.ok
+    ]
+    return "; ".join(errors) or None
+
+
+def print_token_usage() -> None:
+    """Print the input, cached and output tokens of the LLM calls."""
+    metrics = get_metrics()
+    print(
+        f"{Fore.WHITE}Input tokens: {metrics.total('sidekick_llm_input_tokens_total'):.0f} "
+        f"({metrics.total('sidekick_llm_cached_input_tokens_total'):.0f} cached), "
+        f"output tokens: {metrics.total('sidekick_llm_output_tokens_total'):.0f}{Style.RESET_ALL}"
+    )
+
+
+def print_failover_stats(provider: LLMProvider) -> None:
+    """Print the calls and latency of every backend of a failover provider."""
+    if isinstance(provider, CachedProvider):
+        provider = provider.provider
+    if not isinstance(provider, FailoverProvider):
+        return
+
+    for label, stats in provider.stats().items():
+        print(
+            f"{Fore.WHITE}Provider {label}: {stats['calls']} calls, {stats['failures']} failed, "
+            f"{stats['hedges']} hedged, latency p50 {stats['p50']:.1f}s p95 {stats['p95']:.1f}s{Style.RESET_ALL}"
+        )
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         description="AI-powered GitLab merge request tools"
@@ -103,63 +438,89 @@ def main() -> None:
         "-p", "--post", action="store_true", help="Post results to merge/pull request"
     )
     parser.add_argument(
-        "-t", "--tag", action="store_true", help="Tag merge/pull request and avoid duplication"
+        "-t",
+        "--tag",
+        action="store_true",
+        help="Tag merge/pull request and avoid duplication",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=int(os.getenv("SIDEKICK_JOBS", "4")),
+        help="Maximum number of actions to run concurrently (1 runs them serially)",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        action="store_true",
+        default=os.getenv("SIDEKICK_CACHE", "").lower() in ("1", "true", "yes"),
+        help="Cache LLM responses on disk and reuse them for identical prompts",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only review the code pushed since the last review posted by sidekick",
+    )
+    parser.add_argument(
+        "--no-filter",
+        action="store_true",
+        help="Review lockfiles, generated, vendored and whitespace-only changes too",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        default=os.getenv("SIDEKICK_METRICS"),
+        help="Write metrics to this file, as a Prometheus textfile if it ends in .prom or else as JSON lines",
     )
+    add_fuse_argument(parser)
     args = parser.parse_args()
 
     try:
-        # Parse actions
-        action_names = [action.strip() for action in args.actions.split(",")]
-
-        # Validate actions
-        valid_actions = ["review_code", "review_format", "label", "summarize"]
-        invalid_actions = [
-            action for action in action_names if action not in valid_actions
-        ]
-        if invalid_actions:
-            raise ValueError(
-                f"Invalid action(s): {', '.join(invalid_actions)}. "
-                f"Must be one of: {', '.join(valid_actions)}"
-            )
+        get_metrics().configure(args.metrics)
 
-        repository = get_repository()
-        code_request = repository.get_code_request(args.project_id, args.cr_id)
-
-        if args.verbose:
-            print(f"\n{Fore.WHITE}Changes from repository:{Style.RESET_ALL}")
-            for change in code_request.changes:
-                print(f"\n{Fore.WHITE}File: {change.path}{Style.RESET_ALL}")
-                print(f"{Fore.WHITE}{change.diff}{Style.RESET_ALL}")
+        action_names = parse_actions(args.actions, args.fuse)
 
+        repository = get_repository()
         rules = load_rules(args.rules)
 
         print(
             f"{Fore.WHITE}Loaded {len(rules)} rules from {'rules'if args.rules else 'default'} locations{Style.RESET_ALL}"
         )
 
-        provider = get_provider()
-
-        total_tokens_used = 0
-        # Run each action
-        for action_name in action_names:
-            print(f"\n{Fore.WHITE}Running action: {action_name}{Style.RESET_ALL}")
-
-            action = get_action(action_name, provider, repository, rules, args.verbose)
-            result = action.run(code_request, args.post)
-
-            total_tokens_used += result.tokens_used
-
-            if args.verbose:
-                print(f"\n{Fore.WHITE}Action {action_name} completed{Style.RESET_ALL}")
+        provider = get_provider(args.cache)
+
+        results = review_code_request(
+            args.project_id,
+            args.cr_id,
+            action_names,
+            provider,
+            repository,
+            rules,
+            post=args.post,
+            verbose=args.verbose,
+            jobs=args.jobs,
+            incremental=args.incremental,
+            filter_noise=not args.no_filter,
+            tag=args.tag,
+        )
 
-        if args.tag:
-            repository.label_code_request(args.project_id, args.cr_id, ["sidekick"])
+        total_tokens_used = sum(result.tokens_used for result in results.values())
         print(f"{Fore.WHITE}Total tokens used: {total_tokens_used}{Style.RESET_ALL}")
+        print_token_usage()
+        print_failover_stats(provider)
+        if isinstance(provider, CachedProvider):
+            print(
+                f"{Fore.WHITE}Cache hits: {provider.hits}, misses: {provider.misses}{Style.RESET_ALL}"
+            )
 
     except ValueError as e:
         print(f"Error: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
+    finally:
+        get_metrics().close()
 
 
 if __name__ == "__main__":
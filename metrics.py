@@ -0,0 +1,371 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple, Union
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Type and help of every exported metric
+METRICS = {
+    "sidekick_llm_calls_total": ("counter", "LLM completions"),
+    "sidekick_llm_input_tokens_total": ("counter", "Prompt tokens sent to the LLM"),
+    "sidekick_llm_cached_input_tokens_total": (
+        "counter",
+        "Prompt tokens read from the provider prompt cache",
+    ),
+    "sidekick_llm_output_tokens_total": ("counter", "Tokens generated by the LLM"),
+    "sidekick_llm_retries_total": ("counter", "Retries of LLM requests"),
+    "sidekick_llm_latency_seconds": ("histogram", "Duration of LLM completions"),
+    "sidekick_llm_first_token_seconds": (
+        "histogram",
+        "Time until the first text of streamed LLM completions",
+    ),
+    "sidekick_llm_throttle_seconds": (
+        "histogram",
+        "Time LLM completions waited for the rate limiter",
+    ),
+    "sidekick_repository_requests_total": ("counter", "Requests to the repository API"),
+    "sidekick_repository_retries_total": (
+        "counter",
+        "Retries of requests to the repository API",
+    ),
+    "sidekick_repository_latency_seconds": (
+        "histogram",
+        "Duration of requests to the repository API, retries included",
+    ),
+    "sidekick_action_phase_seconds": (
+        "histogram",
+        "Duration of the phases of the actions: fetch, prompt, llm, parse and post",
+    ),
+}
+
+
+@dataclass
+class CallRecord:
+    """An LLM completion."""
+
+    provider: str
+    model: str
+    latency: float
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_input_tokens: int = 0
+    retries: int = 0
+    # Seconds until the first text of a streamed completion
+    first_token_latency: Optional[float] = None
+    error: str = ""
+    type: str = field(default="llm_call", init=False)
+
+
+@dataclass
+class ThrottleRecord:
+    """An LLM completion delayed by the rate limiter."""
+
+    provider: str
+    model: str
+    seconds: float
+    type: str = field(default="llm_throttle", init=False)
+
+
+@dataclass
+class RequestRecord:
+    """A request to the repository API."""
+
+    method: str
+    # 0 when no response was received
+    status: int
+    latency: float
+    retries: int = 0
+    type: str = field(default="repository_request", init=False)
+
+
+@dataclass
+class PhaseRecord:
+    """A phase of an action."""
+
+    action: str
+    phase: str
+    seconds: float
+    type: str = field(default="action_phase", init=False)
+
+
+Record = Union[CallRecord, ThrottleRecord, RequestRecord, PhaseRecord]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Performance metrics of LLM calls, repository requests and actions.
+
+    Records are aggregated in memory into counters and histograms that can
+    be written as a Prometheus textfile, and are also appended to a JSON
+    lines file when one is configured.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        # Count of every bucket followed by the sum and the count
+        self._histograms: Dict[Tuple[str, Labels], List[float]] = {}
+        self._sink: Optional[TextIO] = None
+        self.prometheus_path: Optional[str] = None
+
+    def configure(self, path: Optional[str]) -> None:
+        """Export to a Prometheus textfile if path ends in .prom, else JSON lines."""
+        if not path:
+            return
+        if path.endswith(".prom"):
+            self.prometheus_path = path
+        else:
+            self._sink = open(path, "a")
+
+    def record(self, record: Record) -> None:
+        with self._lock:
+            self._aggregate(record)
+            if self._sink is not None:
+                self._sink.write(
+                    json.dumps({"time": time.time(), **asdict(record)}) + "\n"
+                )
+                self._sink.flush()
+
+    @contextmanager
+    def phase(self, action: str, phase: str) -> Iterator[None]:
+        """Time a phase of an action."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(PhaseRecord(action, phase, time.monotonic() - start))
+
+    def total(self, name: str, **labels: str) -> float:
+        """Sum of a counter, or of the observations of a histogram.
+
+        Series are summed over all their labels but the ones given.
+        """
+        wanted = set(labels.items())
+        with self._lock:
+            if METRICS[name][0] == "counter":
+                return sum(
+                    v
+                    for (n, l), v in self._counters.items()
+                    if n == name and wanted <= set(l)
+                )
+            return sum(
+                v[-2]
+                for (n, l), v in self._histograms.items()
+                if n == name and wanted <= set(l)
+            )
+
+    def reset(self) -> None:
+        """Forget the aggregated metrics, e.g. between benchmark scenarios."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def close(self) -> None:
+        if self.prometheus_path:
+            self.write_prometheus(self.prometheus_path)
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+    def write_prometheus(self, path: str) -> None:
+        """Write the metrics to a file for the node exporter textfile collector."""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # The collector must never read a partially written file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp, path)
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(value) for key, value in self._histograms.items()}
+
+        lines = []
+        for name, (kind, help) in METRICS.items():
+            series = counters if kind == "counter" else histograms
+            keys = sorted(key for key in series if key[0] == name)
+            if not keys:
+                continue
+
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key in keys:
+                labels = key[1]
+                if kind == "counter":
+                    lines.append(f"{name}{format_labels(labels)} {counters[key]:g}")
+                    continue
+
+                values = histograms[key]
+                cumulative = 0.0
+                for bound, count in zip(BUCKETS, values):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {cumulative:g}"
+                    )
+                lines.append(
+                    f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {values[-1]:g}"
+                )
+                lines.append(f"{name}_sum{format_labels(labels)} {values[-2]:g}")
+                lines.append(f"{name}_count{format_labels(labels)} {values[-1]:g}")
+
+        lines.append(
+            "# HELP sidekick_last_update_timestamp_seconds Time the metrics were written"
+        )
+        lines.append("# TYPE sidekick_last_update_timestamp_seconds gauge")
+        lines.append(f"sidekick_last_update_timestamp_seconds {time.time():.3f}")
+        return "\n".join(lines) + "\n"
+
+    def _aggregate(self, record: Record) -> None:
+        if isinstance(record, CallRecord):
+            labels = (("provider", record.provider), ("model", record.model))
+            status = "error" if record.error else "ok"
+            self._inc("sidekick_llm_calls_total", labels + (("status", status),))
+            self._inc("sidekick_llm_input_tokens_total", labels, record.input_tokens)
+            self._inc(
+                "sidekick_llm_cached_input_tokens_total",
+                labels,
+                record.cached_input_tokens,
+            )
+            self._inc("sidekick_llm_output_tokens_total", labels, record.output_tokens)
+            self._inc("sidekick_llm_retries_total", labels, record.retries)
+            self._observe("sidekick_llm_latency_seconds", labels, record.latency)
+            if record.first_token_latency is not None:
+                self._observe(
+                    "sidekick_llm_first_token_seconds",
+                    labels,
+                    record.first_token_latency,
+                )
+        elif isinstance(record, ThrottleRecord):
+            labels = (("provider", record.provider), ("model", record.model))
+            self._observe("sidekick_llm_throttle_seconds", labels, record.seconds)
+        elif isinstance(record, RequestRecord):
+            labels = (("method", record.method),)
+            self._inc(
+                "sidekick_repository_requests_total",
+                labels + (("status", str(record.status)),),
+            )
+            self._inc("sidekick_repository_retries_total", labels, record.retries)
+            self._observe("sidekick_repository_latency_seconds", labels, record.latency)
+        else:
+            labels = (("action", record.action), ("phase", record.phase))
+            self._observe("sidekick_action_phase_seconds", labels, record.seconds)
+
+    def _inc(self, name: str, labels: Labels, value: float = 1) -> None:
+        key = (name, labels)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def _observe(self, name: str, labels: Labels, value: float) -> None:
+        key = (name, labels)
+        values = self._histograms.get(key)
+        if values is None:
+            values = self._histograms[key] = [0.0] * (len(BUCKETS) + 2)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                values[i] += 1
+                break
+        values[-2] += value
+        values[-1] += 1
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Return the p-th percentile of the values with the nearest-rank method."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+_metrics = Metrics()
+
+
+def get_metrics() -> Metrics:
+    """Metrics of the process, shared by the providers, repositories and actions."""
+    return _metrics
+
+
+@dataclass
+class Attempts:
+    """Requests made by the SDK of an LLM provider during a completion."""
+
+    requests: int = 0
+    retries: int = 0
+
+    @property
+    def total_retries(self) -> int:
+        return max(self.retries, self.requests - 1)
+
+
+_attempts: ContextVar[Optional[Attempts]] = ContextVar(
+    "sidekick_attempts", default=None
+)
+
+
+@contextmanager
+def count_attempts() -> Iterator[Attempts]:
+    """Count the requests and retries of the SDK calls made in the block."""
+    attempts = Attempts()
+    token = _attempts.set(attempts)
+    try:
+        yield attempts
+    finally:
+        _attempts.reset(token)
+
+
+def count_request(**kwargs: Any) -> None:
+    """Count a request, used as a hook by SDKs that have them."""
+    attempts = _attempts.get()
+    if attempts is not None:
+        attempts.requests += 1
+
+
+class RetryLogFilter(logging.Filter):
+    """Count the retries that an SDK logs for the call in progress.
+
+    The level of the SDK logger is lowered to see its retry messages, the
+    filter drops the other messages under the original level so the output
+    doesn't change.
+    """
+
+    def __init__(self, level: int):
+        super().__init__()
+        self.level = level
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.getMessage().startswith("Retrying"):
+            attempts = _attempts.get()
+            if attempts is not None:
+                attempts.retries += 1
+        return record.levelno >= self.level
+
+
+def watch_retries(logger_name: str, level: int = logging.INFO) -> None:
+    """Count the retries logged by an SDK logger at the given level."""
+    logger = logging.getLogger(logger_name)
+    if any(isinstance(f, RetryLogFilter) for f in logger.filters):
+        return
+    logger.addFilter(RetryLogFilter(logger.getEffectiveLevel()))
+    if logger.getEffectiveLevel() > level:
+        logger.setLevel(level)
@@ -1,18 +1,41 @@
-from .base import LLMProvider, CompletionResponse
-from .openai import OpenAIProvider
-from .anthropic import AnthropicProvider
-from .google import GoogleProvider
-from .bedrock import BedrockProvider
+from .base import LLMProvider, BatchRequest, CompletionResponse
+from .cache import CachedProvider
+from .failover import FailoverProvider
+from .metered import MeteredProvider
+from .ratelimit import RateLimitedProvider, rate_limited
 from .helpers import parse_json, stringify_code_changes, stringify_rules
+from .registry import available_providers, get_provider_class
 
 __all__ = [
     "LLMProvider",
     "CompletionResponse",
+    "BatchRequest",
     "OpenAIProvider",
     "AnthropicProvider",
     "GoogleProvider",
     "BedrockProvider",
+    "CachedProvider",
+    "FailoverProvider",
+    "MeteredProvider",
+    "RateLimitedProvider",
+    "rate_limited",
+    "available_providers",
+    "get_provider_class",
     "parse_json",
     "stringify_code_changes",
     "stringify_rules",
 ]
+
+# Provider classes are imported on first access, which also imports their SDK
+_LAZY_PROVIDERS = {
+    "OpenAIProvider": "openai",
+    "AnthropicProvider": "anthropic",
+    "GoogleProvider": "google",
+    "BedrockProvider": "bedrock",
+}
+
+
+def __getattr__(name: str):
+    if name in _LAZY_PROVIDERS:
+        return get_provider_class(_LAZY_PROVIDERS[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,27 +1,179 @@
+import json
 import os
+from typing import Any, Callable, Dict, List, Optional, Type
 import anthropic
-from .base import LLMProvider, CompletionResponse
+from pydantic import BaseModel
+from metrics import watch_retries
+from .base import LLMProvider, BatchRequest, CompletionResponse
+from .helpers import schema_tool
 
 
 class AnthropicProvider(LLMProvider):
+    name = "anthropic"
+    supports_schema = True
+
     def __init__(self):
-        self.client = anthropic.Anthropic(api_key=os.getenv("ANTHROPIC_API_KEY"))
+        # A base URL other than the Anthropic API, e.g. a proxy or a local stand-in
+        base_url = os.getenv("ANTHROPIC_BASE_URL") or None
+        self.client = anthropic.Anthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"), base_url=base_url
+        )
         if not os.getenv("ANTHROPIC_API_KEY"):
             raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
+        self.async_client = anthropic.AsyncAnthropic(
+            api_key=os.getenv("ANTHROPIC_API_KEY"), base_url=base_url
+        )
         self.model = os.getenv("ANTHROPIC_MODEL", "claude-3-opus-20240229")
+        watch_retries("anthropic._base_client")
+
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        response = self.client.messages.create(**self._params(prompt, prefix, schema))
+
+        return self._to_completion_response(response)
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        response = await self.async_client.messages.create(
+            **self._params(prompt, prefix, schema)
+        )
+
+        return self._to_completion_response(response)
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        with self.client.messages.stream(
+            **self._params(prompt, prefix, schema)
+        ) as stream:
+            for event in stream:
+                self._read_event(event, on_text)
+            response = stream.get_final_message()
+
+        return self._to_completion_response(response)
+
+    async def _astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        async with self.async_client.messages.stream(
+            **self._params(prompt, prefix, schema)
+        ) as stream:
+            async for event in stream:
+                self._read_event(event, on_text)
+            response = await stream.get_final_message()
+
+        return self._to_completion_response(response)
 
-    def completion(self, prompt: str) -> CompletionResponse:
-        response = self.client.messages.create(
-            model=self.model,
-            max_tokens=4096,
-            messages=[{"role": "user", "content": prompt}],
+    def submit_batch(self, requests: List[BatchRequest]) -> str:
+        batch = self.client.messages.batches.create(
+            requests=[
+                {
+                    "custom_id": request.custom_id,
+                    "params": self._params(
+                        request.prompt, request.prefix, request.response_schema
+                    ),
+                }
+                for request in requests
+            ]
         )
+        return batch.id
 
+    def get_batch_results(
+        self, batch_id: str
+    ) -> Optional[Dict[str, Optional[CompletionResponse]]]:
+        batch = self.client.messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            return None
+
+        return {
+            entry.custom_id: (
+                self._to_completion_response(entry.result.message)
+                if entry.result.type == "succeeded"
+                else None
+            )
+            for entry in self.client.messages.batches.results(batch_id)
+        }
+
+    def _params(
+        self, prompt: str, prefix: str, schema: Optional[Type[BaseModel]] = None
+    ) -> Dict[str, Any]:
+        """Parameters of a messages request.
+
+        Responses are constrained to a schema by forcing the use of a tool
+        taking it as input. Tools come before the messages in the cached
+        prefix, requests with different schemas don't share it.
+        """
+        params: Dict[str, Any] = {
+            "model": self.model,
+            **self.generation_params,
+            "messages": self._messages(prompt, prefix),
+        }
+        if schema is not None:
+            tool = schema_tool(schema)
+            params["tools"] = [tool]
+            params["tool_choice"] = {"type": "tool", "name": tool["name"]}
+        return params
+
+    def _read_event(self, event, on_text: Callable[[str], None]) -> None:
+        """Pass the text or the tool input in a stream event to on_text."""
+        if event.type == "text":
+            on_text(event.text)
+        elif event.type == "input_json" and event.partial_json:
+            on_text(event.partial_json)
+
+    def _messages(self, prompt: str, prefix: str) -> List[Dict[str, Any]]:
+        content: List[Dict[str, Any]] = []
+        if prompt:
+            content.append({"type": "text", "text": prompt})
+        if prefix:
+            block: Dict[str, Any] = {"type": "text", "text": prefix}
+            if self.prompt_cache:
+                # Everything up to this block is cached for the next requests
+                block["cache_control"] = {"type": "ephemeral"}
+            content.insert(0, block)
+        return [{"role": "user", "content": content}]
+
+    def _to_completion_response(self, response) -> CompletionResponse:
+        usage = response.usage
+        # input_tokens doesn't count the tokens written to or read from the cache
+        cached = getattr(usage, "cache_read_input_tokens", None) or 0
+        written = getattr(usage, "cache_creation_input_tokens", None) or 0
+        input_tokens = usage.input_tokens + cached + written
         return CompletionResponse(
-            text=response.content[0].text,
-            tokens_used=response.usage.input_tokens + response.usage.output_tokens,
+            text=self._text(response.content),
+            tokens_used=input_tokens + usage.output_tokens,
+            input_tokens=input_tokens,
+            cached_input_tokens=cached,
+            output_tokens=usage.output_tokens,
         )
 
+    def _text(self, content) -> str:
+        """Text of a message, or the input of its tool use as JSON."""
+        for block in content:
+            if block.type == "tool_use":
+                return json.dumps(block.input)
+        return "".join(block.text for block in content if block.type == "text")
+
+    @property
+    def generation_params(self) -> Dict[str, Any]:
+        return {"max_tokens": 4096}
+
     def get_context_window(self) -> int:
         context_windows = {
             "claude-3-opus-20240229": 200000,
@@ -1,6 +1,10 @@
+import asyncio
+import os
+import weakref
 from abc import ABC, abstractmethod
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional, Type
+from repository.tokens import TokenCounter, get_token_counter
 
 
 class CompletionResponse(BaseModel):
@@ -8,11 +12,32 @@ class CompletionResponse(BaseModel):
 
     text: str
     tokens_used: int
+    # Prompt tokens, including the ones read from the provider prompt cache
+    input_tokens: int = 0
+    cached_input_tokens: int = 0
+    output_tokens: int = 0
+
+
+class BatchRequest(BaseModel):
+    """A completion submitted to the batch API of a provider."""
+
+    # Identifies the completion in the results, letters, digits, _ and - only
+    custom_id: str
+    prompt: str
+    prefix: str = ""
+    # The schema of the response, see LLMProvider.completion
+    response_schema: Optional[Type[BaseModel]] = None
 
 
 class LLMProvider(ABC):
     """Abstract base class for LLM providers."""
 
+    # Name of the provider family, used to pick its tokenizer
+    name: str = ""
+
+    # Whether the provider can constrain its responses to a schema
+    supports_schema: bool = False
+
     @property
     @abstractmethod
     def max_tokens(self) -> int:
@@ -22,14 +47,183 @@ class LLMProvider(ABC):
         """
         pass
 
+    @property
+    def generation_params(self) -> Dict[str, Any]:
+        """Parameters, besides the model, that affect the generated completion."""
+        return {}
+
+    @property
+    def token_counter(self) -> TokenCounter:
+        """Token counter matching the tokenizer of this provider's model."""
+        return get_token_counter(self.name, getattr(self, "model", ""))
+
+    @property
+    def concurrency(self) -> int:
+        """Maximum number of async completions in flight for this provider."""
+        return int(os.getenv("PROVIDER_CONCURRENCY", "16"))
+
+    @property
+    def prompt_cache(self) -> bool:
+        """Whether to ask the provider to cache prompt prefixes."""
+        return os.getenv("PROMPT_CACHE", "true").lower() not in ("0", "false", "no")
+
+    @property
+    def structured_output(self) -> bool:
+        """Whether to ask the provider for responses matching a schema."""
+        return self.supports_schema and os.getenv(
+            "STRUCTURED_OUTPUT", "true"
+        ).lower() not in ("0", "false", "no")
+
     @abstractmethod
-    def completion(self, prompt: str) -> Optional[CompletionResponse]:
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
         """Generate a completion for the given prompt.
 
         Args:
             prompt: The input prompt to generate a completion for
+            prefix: Start of the prompt shared with other requests, that the
+                provider may cache. The prompt sent is prefix + prompt.
+            schema: Model of the response. Providers that support schemas
+                constrain the response to its JSON schema, the text of the
+                completion is then a JSON object. Others ignore it.
 
         Returns:
             CompletionResponse containing the generated text and tokens used
         """
         pass
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        """Generate a completion, passing the text to on_text as it is generated.
+
+        Providers with a streaming API override this. The default calls
+        on_text once with the whole text of the completion.
+
+        Args:
+            prompt: The input prompt to generate a completion for
+            on_text: Called with every piece of generated text, in order
+            prefix: Start of the prompt that the provider may cache
+            schema: Model of the response, see completion
+
+        Returns:
+            CompletionResponse containing the whole generated text and tokens used
+        """
+        result = self.completion(prompt, prefix=prefix, schema=schema)
+        if result is not None:
+            on_text(result.text)
+        return result
+
+    def submit_batch(self, requests: List[BatchRequest]) -> str:
+        """Submit completions to the batch API of the provider.
+
+        Batches are billed at a discount and don't count against the rate
+        limits of synchronous requests, but take up to a day to complete.
+        Providers with a batch API override this.
+
+        Args:
+            requests: The completions to generate
+
+        Returns:
+            The ID of the batch, to get its results with get_batch_results
+        """
+        raise NotImplementedError(f"Provider '{self.name}' has no batch API")
+
+    def get_batch_results(
+        self, batch_id: str
+    ) -> Optional[Dict[str, Optional[CompletionResponse]]]:
+        """Get the results of a batch submitted with submit_batch.
+
+        Args:
+            batch_id: The ID of the batch
+
+        Returns:
+            None while the batch is running, else the completions by custom
+            ID, None for the ones that failed or expired
+        """
+        raise NotImplementedError(f"Provider '{self.name}' has no batch API")
+
+    async def acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        """Generate a completion for the given prompt without blocking the loop.
+
+        The number of concurrent requests is bounded by a per provider
+        semaphore so that many reviews can be kept in flight safely.
+
+        Args:
+            prompt: The input prompt to generate a completion for
+            prefix: Start of the prompt that the provider may cache
+            schema: Model of the response, see completion
+
+        Returns:
+            CompletionResponse containing the generated text and tokens used
+        """
+        async with self._get_semaphore():
+            return await self._acompletion(prompt, prefix, schema)
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        """Async completion used by acompletion.
+
+        Providers with a native async client override this. The default
+        offloads the synchronous completion to a worker thread.
+        """
+        return await asyncio.to_thread(self.completion, prompt, prefix, schema)
+
+    async def astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        """Stream a completion without blocking the loop, see stream.
+
+        Requests are bounded by the same semaphore as acompletion.
+        """
+        async with self._get_semaphore():
+            return await self._astream(prompt, on_text, prefix, schema)
+
+    async def _astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        """Async stream used by astream.
+
+        Providers with a native async client override this. The default
+        offloads the synchronous stream to a worker thread, on_text is then
+        called from that thread.
+        """
+        return await asyncio.to_thread(self.stream, prompt, on_text, prefix, schema)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Semaphores are bound to the loop they are first used on, keep one
+        # per loop so the provider can be reused across asyncio.run calls.
+        if "_semaphores" not in self.__dict__:
+            self._semaphores = weakref.WeakKeyDictionary()
+
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.concurrency)
+            self._semaphores[loop] = semaphore
+        return semaphore
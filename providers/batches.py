@@ -0,0 +1,155 @@
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_BATCHES_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "sidekick", "batches.sqlite"
+)
+
+
+class BatchStore:
+    """Batches submitted to the batch APIs of the providers, until collected.
+
+    Every batch is stored with the provider and model it was submitted to,
+    the context of each of its requests needed to handle their results, and
+    snapshots of the inputs the requests were built from, e.g. the code
+    requests, since they may change before the batch completes.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = os.path.expanduser(
+            path or os.getenv("DEFERRED_BATCHES_PATH", DEFAULT_BATCHES_PATH)
+        )
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                "id TEXT PRIMARY KEY, provider TEXT NOT NULL, model TEXT NOT NULL, "
+                "submitted REAL NOT NULL, collected REAL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS requests ("
+                "batch_id TEXT NOT NULL, custom_id TEXT NOT NULL, context TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (batch_id, custom_id))"
+            )
+            columns = [row[1] for row in db.execute("PRAGMA table_info(requests)")]
+            if "attempts" not in columns:
+                # Stores of older versions don't count the attempts
+                db.execute(
+                    "ALTER TABLE requests ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+                )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS snapshots ("
+                "batch_id TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (batch_id, key))"
+            )
+
+    def add(
+        self,
+        batch_id: str,
+        provider: str,
+        model: str,
+        contexts: Dict[str, Any],
+        snapshots: Dict[str, Any],
+    ) -> None:
+        """Store a submitted batch.
+
+        Args:
+            batch_id: The ID of the batch returned by the provider
+            provider: The name of the provider
+            model: The model of the provider
+            contexts: The context of every request by custom ID
+            snapshots: The inputs the requests were built from, by key
+        """
+        with self._connect() as db:
+            db.execute("BEGIN")
+            db.execute(
+                "INSERT INTO batches VALUES (?, ?, ?, ?, NULL)",
+                (batch_id, provider, model, time.time()),
+            )
+            db.executemany(
+                "INSERT INTO requests (batch_id, custom_id, context) VALUES (?, ?, ?)",
+                [(batch_id, k, json.dumps(v)) for k, v in contexts.items()],
+            )
+            db.executemany(
+                "INSERT INTO snapshots VALUES (?, ?, ?)",
+                [(batch_id, k, json.dumps(v)) for k, v in snapshots.items()],
+            )
+            db.execute("COMMIT")
+
+    def pending(self) -> List[Tuple[str, str, str, float]]:
+        """The batches not collected yet as (ID, provider, model, submitted time)."""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT id, provider, model, submitted FROM batches "
+                "WHERE collected IS NULL ORDER BY submitted"
+            ).fetchall()
+
+    def contexts(self, batch_id: str) -> Dict[str, Any]:
+        """The context of every request of a batch by custom ID."""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT custom_id, context FROM requests WHERE batch_id = ?",
+                (batch_id,),
+            ).fetchall()
+        return {custom_id: json.loads(context) for custom_id, context in rows}
+
+    def snapshot(self, batch_id: str, key: str) -> Any:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT data FROM snapshots WHERE batch_id = ? AND key = ?",
+                (batch_id, key),
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"No snapshot {key} in batch {batch_id}")
+        return json.loads(row[0])
+
+    def handled(self, batch_id: str, custom_ids: List[str]) -> None:
+        """Drop requests whose results were handled, not to handle them again."""
+        with self._connect() as db:
+            db.executemany(
+                "DELETE FROM requests WHERE batch_id = ? AND custom_id = ?",
+                [(batch_id, custom_id) for custom_id in custom_ids],
+            )
+
+    def failed(self, batch_id: str, custom_ids: List[str]) -> int:
+        """Count a failed attempt at handling requests and return their attempts."""
+        with self._connect() as db:
+            db.execute("BEGIN")
+            db.executemany(
+                "UPDATE requests SET attempts = attempts + 1 "
+                "WHERE batch_id = ? AND custom_id = ?",
+                [(batch_id, custom_id) for custom_id in custom_ids],
+            )
+            row = db.execute(
+                "SELECT MAX(attempts) FROM requests WHERE batch_id = ? AND custom_id IN "
+                f"({', '.join('?' * len(custom_ids))})",
+                (batch_id, *custom_ids),
+            ).fetchone()
+            db.execute("COMMIT")
+        return row[0] or 0
+
+    def collected(self, batch_id: str) -> None:
+        """Mark a batch as collected and drop its requests and snapshots."""
+        with self._connect() as db:
+            db.execute("BEGIN")
+            db.execute(
+                "UPDATE batches SET collected = ? WHERE id = ?", (time.time(), batch_id)
+            )
+            db.execute("DELETE FROM requests WHERE batch_id = ?", (batch_id,))
+            db.execute("DELETE FROM snapshots WHERE batch_id = ?", (batch_id,))
+            db.execute("COMMIT")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
@@ -1,10 +1,17 @@
 import os
 import json
+from typing import Any, Callable, Dict, List, Optional, Type
 import boto3
+from pydantic import BaseModel
+from metrics import count_request
 from .base import LLMProvider, CompletionResponse
+from .helpers import schema_tool
 
 
 class BedrockProvider(LLMProvider):
+    name = "bedrock"
+    supports_schema = True
+
     def __init__(self):
         self.client = boto3.client(
             "bedrock-runtime",
@@ -23,32 +30,109 @@ class BedrockProvider(LLMProvider):
         self.model = os.getenv(
             "BEDROCK_MODEL", "anthropic.claude-3-7-sonnet-20250219-v1:0"
         )
+        # Every attempt of a request, retries included, goes through this event
+        self.client.meta.events.register("before-send.bedrock-runtime", count_request)
+
+    # boto3 has no async client, acompletion and astream use the default executor offload
+    # from LLMProvider which is bounded by the provider semaphore.
 
-    def completion(self, prompt: str) -> CompletionResponse:
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
         response = self.client.invoke_model(
-            modelId=self.model,
-            body=json.dumps(
-                {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 120000,
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [{"type": "text", "text": prompt}],
-                        }
-                    ],
-                }
-            ),
+            modelId=self.model, body=self._request_body(prompt, prefix, schema)
         )
 
         response_body = json.loads(response.get("body").read())
 
+        return self._to_completion_response(
+            self._text(response_body["content"]), response_body["usage"]
+        )
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        response = self.client.invoke_model_with_response_stream(
+            modelId=self.model, body=self._request_body(prompt, prefix, schema)
+        )
+
+        text: List[str] = []
+        usage: Dict[str, int] = {}
+        for event in response.get("body"):
+            if "chunk" not in event:
+                continue
+            chunk = json.loads(event["chunk"]["bytes"])
+            if chunk["type"] == "message_start":
+                usage.update(chunk["message"]["usage"])
+            elif chunk["type"] == "content_block_delta":
+                # Text, or the input of the tool use with a schema
+                delta = chunk["delta"].get("text") or chunk["delta"].get("partial_json")
+                if delta:
+                    text.append(delta)
+                    on_text(delta)
+            elif chunk["type"] == "message_delta":
+                usage["output_tokens"] = chunk["usage"]["output_tokens"]
+
+        return self._to_completion_response("".join(text), usage)
+
+    def _request_body(
+        self, prompt: str, prefix: str = "", schema: Optional[Type[BaseModel]] = None
+    ) -> str:
+        content: List[Dict[str, Any]] = []
+        if prefix:
+            block: Dict[str, Any] = {"type": "text", "text": prefix}
+            if self.prompt_cache:
+                block["cache_control"] = {"type": "ephemeral"}
+            content.append(block)
+        if prompt:
+            content.append({"type": "text", "text": prompt})
+
+        body: Dict[str, Any] = {
+            **self.generation_params,
+            "messages": [{"role": "user", "content": content}],
+        }
+        if schema is not None:
+            # Like the Anthropic API, the response is the input of a forced tool
+            tool = schema_tool(schema)
+            body["tools"] = [tool]
+            body["tool_choice"] = {"type": "tool", "name": tool["name"]}
+        return json.dumps(body)
+
+    def _text(self, content: List[Dict[str, Any]]) -> str:
+        """Text of a message, or the input of its tool use as JSON."""
+        for block in content:
+            if block["type"] == "tool_use":
+                return json.dumps(block["input"])
+        return "".join(block["text"] for block in content if block["type"] == "text")
+
+    def _to_completion_response(
+        self, text: str, usage: Dict[str, int]
+    ) -> CompletionResponse:
+        cached = usage.get("cache_read_input_tokens") or 0
+        input_tokens = (
+            usage.get("input_tokens", 0)
+            + cached
+            + (usage.get("cache_creation_input_tokens") or 0)
+        )
         return CompletionResponse(
-            text=response_body["content"][0]["text"],
-            tokens_used=response_body["usage"]["input_tokens"]
-            + response_body["usage"]["output_tokens"],
+            text=text,
+            tokens_used=input_tokens + usage.get("output_tokens", 0),
+            input_tokens=input_tokens,
+            cached_input_tokens=cached,
+            output_tokens=usage.get("output_tokens", 0),
         )
 
+    @property
+    def generation_params(self) -> Dict[str, Any]:
+        return {"anthropic_version": "bedrock-2023-05-31", "max_tokens": 120000}
+
     @property
     def max_tokens(self) -> int:
         # Example: Maximum tokens for completion
@@ -0,0 +1,308 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple, Type
+from pydantic import BaseModel
+from .base import LLMProvider, CompletionResponse
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "sidekick", "completions.sqlite"
+)
+
+
+class CachedProvider(LLMProvider):
+    """LLM provider decorator that caches completions on disk.
+
+    Completions are stored in a SQLite database keyed by the provider class,
+    the model, a hash of the prompt and the generation parameters. Entries
+    expire after a TTL and the least recently used ones are evicted when the
+    cache grows over its maximum size. Identical prompts requested at the same
+    time are coalesced into a single call to the wrapped provider.
+
+    Cached responses report zero tokens used since they did not cost any.
+    """
+
+    def __init__(
+        self,
+        provider: LLMProvider,
+        path: Optional[str] = None,
+        ttl: Optional[int] = None,
+        max_size: Optional[int] = None,
+    ):
+        self.provider = provider
+        self.path = os.path.expanduser(
+            path or os.getenv("SIDEKICK_CACHE_PATH", DEFAULT_CACHE_PATH)
+        )
+        self.ttl = ttl or int(os.getenv("SIDEKICK_CACHE_TTL", str(7 * 24 * 3600)))
+        self.max_size = max_size or int(
+            os.getenv("SIDEKICK_CACHE_MAX_SIZE", str(256 * 1024 * 1024))
+        )
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+
+    @property
+    def name(self) -> str:
+        return self.provider.name
+
+    @property
+    def model(self) -> str:
+        return getattr(self.provider, "model", "")
+
+    @property
+    def max_tokens(self) -> int:
+        return self.provider.max_tokens
+
+    @property
+    def generation_params(self) -> Dict[str, Any]:
+        return self.provider.generation_params
+
+    @property
+    def concurrency(self) -> int:
+        return self.provider.concurrency
+
+    @property
+    def supports_schema(self) -> bool:
+        return self.provider.supports_schema
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def key(self, prompt: str, schema: Optional[Type[BaseModel]] = None) -> str:
+        """Content address of a completion request."""
+        provider_class = type(self.provider)
+        fields = [
+            f"{provider_class.__module__}.{provider_class.__qualname__}",
+            self.model,
+            hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+            self.generation_params,
+        ]
+        if schema is not None:
+            # Responses constrained to a schema are formatted differently
+            fields.append(schema.model_json_schema())
+        data = json.dumps(
+            fields,
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        return self._cached(
+            self.key(prefix + prompt, schema),
+            lambda: self.provider.completion(prompt, prefix=prefix, schema=schema),
+        )
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        return self._cached(
+            self.key(prefix + prompt, schema),
+            lambda: self.provider.stream(prompt, on_text, prefix=prefix, schema=schema),
+            on_text,
+        )
+
+    async def acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        return await self._acached(
+            self.key(prefix + prompt, schema),
+            lambda: self.provider.acompletion(prompt, prefix=prefix, schema=schema),
+        )
+
+    async def astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        return await self._acached(
+            self.key(prefix + prompt, schema),
+            lambda: self.provider.astream(
+                prompt, on_text, prefix=prefix, schema=schema
+            ),
+            on_text,
+        )
+
+    def _cached(
+        self,
+        key: str,
+        call: Callable[[], Optional[CompletionResponse]],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Optional[CompletionResponse]:
+        """Return the cached completion of a key or call the wrapped provider.
+
+        Cached completions are passed whole to on_text, if given.
+        """
+        cached = self._get(key)
+        if cached is not None:
+            return self._hit(cached, on_text)
+
+        future, leader = self._join(key)
+        if not leader:
+            return self._hit(future.result(), on_text)
+
+        try:
+            result = call()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+
+        self._finish(key, future, result=result)
+        return result
+
+    async def _acached(
+        self,
+        key: str,
+        call: Callable[[], Awaitable[Optional[CompletionResponse]]],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Optional[CompletionResponse]:
+        cached = self._get(key)
+        if cached is not None:
+            return self._hit(cached, on_text)
+
+        future, leader = self._join(key)
+        if not leader:
+            return self._hit(await asyncio.wrap_future(future), on_text)
+
+        try:
+            result = await call()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+
+        self._finish(key, future, result=result)
+        return result
+
+    def _hit(
+        self,
+        result: Optional[CompletionResponse],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Optional[CompletionResponse]:
+        with self._lock:
+            self.hits += 1
+        if result is None:
+            return None
+        if on_text is not None:
+            on_text(result.text)
+        return result.model_copy(
+            update={"tokens_used": 0, "input_tokens": 0, "cached_input_tokens": 0}
+        )
+
+    def _join(self, key: str) -> Tuple[Future, bool]:
+        """Return the in-flight future for a key and whether the caller owns it."""
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, False
+
+            future = Future()
+            self._inflight[key] = future
+            self.misses += 1
+            return future, True
+
+    def _finish(
+        self,
+        key: str,
+        future: Future,
+        result: Optional[CompletionResponse] = None,
+        exception: Optional[BaseException] = None,
+    ) -> None:
+        try:
+            if exception is None and result is not None:
+                self._put(key, result)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def _get(self, key: str) -> Optional[CompletionResponse]:
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT value, created FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, created = row
+            if created + self.ttl < now:
+                db.execute("DELETE FROM completions WHERE key = ?", (key,))
+                return None
+
+            db.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+
+        return CompletionResponse.model_validate_json(value)
+
+    def _put(self, key: str, result: CompletionResponse) -> None:
+        value = result.model_dump_json()
+        now = time.time()
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now),
+            )
+            self._evict(db, now)
+
+    def _evict(self, db: sqlite3.Connection, now: float) -> None:
+        db.execute("DELETE FROM completions WHERE created < ?", (now - self.ttl,))
+
+        (total,) = db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM completions"
+        ).fetchone()
+        if total <= self.max_size:
+            return
+
+        # Drop the least recently used entries until the cache fits again
+        evicted = []
+        for key, size in db.execute(
+            "SELECT key, size FROM completions ORDER BY accessed"
+        ).fetchall():
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        db.executemany("DELETE FROM completions WHERE key = ?", evicted)
@@ -0,0 +1,416 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Type
+from pydantic import BaseModel
+from metrics import percentile
+from .base import LLMProvider, CompletionResponse
+
+# Percentile of a backend latency after which the request is hedged on the
+# next backend, 0 to only fail over on errors and timeouts
+HEDGE_PERCENTILE = float(os.getenv("FAILOVER_HEDGE_PERCENTILE", "95"))
+
+# Completions of a backend measured before its latency is used to hedge
+MIN_SAMPLES = int(os.getenv("FAILOVER_MIN_SAMPLES", "10"))
+
+# Seconds after which a backend that has not answered is failed over
+TIMEOUT = float(os.getenv("FAILOVER_TIMEOUT", "300"))
+
+# Consecutive failures after which a backend is tried last for a while
+MAX_FAILURES = int(os.getenv("FAILOVER_MAX_FAILURES", "3"))
+
+# Seconds an unhealthy backend is tried last
+COOLDOWN = float(os.getenv("FAILOVER_COOLDOWN", "60"))
+
+# A backend this many times slower than the fastest one is tried after it
+SLOW_FACTOR = 2.0
+
+# Latencies kept per backend
+WINDOW = 100
+
+
+class Abandoned(Exception):
+    """Raised in the stream of a backend that another backend already answered."""
+
+
+class Backend:
+    """A provider of a FailoverProvider with its health and latency stats."""
+
+    def __init__(self, provider: LLMProvider):
+        self.provider = provider
+        self.latencies: deque = deque(maxlen=WINDOW)
+        self.calls = 0
+        self.failures = 0
+        self.hedges = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def label(self) -> str:
+        model = getattr(self.provider, "model", "")
+        return f"{self.provider.name}/{model}" if model else self.provider.name
+
+    def healthy(self, now: float) -> bool:
+        return self.unhealthy_until <= now
+
+    def median(self) -> Optional[float]:
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        return percentile(list(self.latencies), 50)
+
+    def hedge_delay(self) -> float:
+        """Seconds to wait for this backend before starting the next one."""
+        if HEDGE_PERCENTILE <= 0 or len(self.latencies) < MIN_SAMPLES:
+            return TIMEOUT
+        return min(percentile(list(self.latencies), HEDGE_PERCENTILE), TIMEOUT)
+
+    def succeeded(self, latency: float) -> None:
+        self.calls += 1
+        self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def failed(self) -> None:
+        self.calls += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= MAX_FAILURES:
+            self.unhealthy_until = time.monotonic() + COOLDOWN
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "hedges": self.hedges,
+            "healthy": self.healthy(time.monotonic()),
+            "p50": percentile(list(self.latencies), 50),
+            "p95": percentile(list(self.latencies), 95),
+        }
+
+
+class Race:
+    """Attempts of a completion on several backends, the first answer wins.
+
+    Only one attempt streams its text: the first that generates some. The
+    others are abandoned when they generate text, since it would interleave
+    with the text already passed on.
+    """
+
+    def __init__(self, on_text: Optional[Callable[[str], None]] = None):
+        self.on_text = on_text
+        self.owner: Optional[Backend] = None
+        self._lock = threading.Lock()
+
+    def claim(self, backend: Backend) -> bool:
+        """Make a backend the one answering, unless another one already is."""
+        with self._lock:
+            if self.owner is None:
+                self.owner = backend
+            return self.owner is backend
+
+    def stream_to(self, backend: Backend) -> Callable[[str], None]:
+        def on_text(text: str) -> None:
+            if not self.claim(backend):
+                raise Abandoned()
+            if self.on_text is not None:
+                self.on_text(text)
+
+        return on_text
+
+
+class FailoverProvider(LLMProvider):
+    """LLM provider that hedges and fails over across several providers.
+
+    Completions go to the first backend in order. When it has not answered
+    within its FAILOVER_HEDGE_PERCENTILE latency the same request is also sent
+    to the next backend and the first answer wins, and when it fails, returns
+    nothing or times out the next backend is tried right away. Backends that
+    fail repeatedly are tried last for a cooldown, and backends much slower
+    than the fastest one are tried after it, otherwise the configured order
+    is kept.
+
+    Losing async attempts are cancelled. Losing sync attempts can't be, they
+    run to completion in the background, or until they stream some text.
+    Once a backend has streamed text its errors are raised as is, since a
+    different completion can't be appended to what was already passed on.
+    """
+
+    def __init__(self, providers: List[LLMProvider]):
+        if not providers:
+            raise ValueError("At least one provider is required")
+        self.backends = [Backend(provider) for provider in providers]
+        self._lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.backends[0].provider.name
+
+    @property
+    def model(self) -> str:
+        return getattr(self.backends[0].provider, "model", "")
+
+    @property
+    def max_tokens(self) -> int:
+        # Prompts must fit in any of the backends
+        return min(backend.provider.max_tokens for backend in self.backends)
+
+    @property
+    def generation_params(self) -> Dict[str, Any]:
+        return {
+            "backends": [
+                [backend.label, backend.provider.generation_params]
+                for backend in self.backends
+            ]
+        }
+
+    @property
+    def concurrency(self) -> int:
+        return self.backends[0].provider.concurrency
+
+    @property
+    def supports_schema(self) -> bool:
+        # Responses of any backend must be parsed the same way
+        return all(backend.provider.supports_schema for backend in self.backends)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {backend.label: backend.stats() for backend in self.backends}
+
+    def order(self) -> List[Backend]:
+        """Backends in the order to try them."""
+        now = time.monotonic()
+        with self._lock:
+            medians = [backend.median() for backend in self.backends]
+            fastest = min((m for m in medians if m is not None), default=None)
+
+            def key(item: Tuple[int, Backend]) -> Tuple[bool, bool, int]:
+                index, backend = item
+                median = medians[index]
+                slow = (
+                    fastest is not None
+                    and median is not None
+                    and median > fastest * SLOW_FACTOR
+                )
+                return (not backend.healthy(now), slow, index)
+
+            return [backend for _, backend in sorted(enumerate(self.backends), key=key)]
+
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        return self._race(
+            lambda backend, race: backend.provider.completion(
+                prompt, prefix=prefix, schema=schema
+            )
+        )
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        return self._race(
+            lambda backend, race: backend.provider.stream(
+                prompt, race.stream_to(backend), prefix=prefix, schema=schema
+            ),
+            on_text,
+        )
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        return await self._arace(
+            lambda backend, race: backend.provider.acompletion(
+                prompt, prefix=prefix, schema=schema
+            )
+        )
+
+    async def _astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        return await self._arace(
+            lambda backend, race: backend.provider.astream(
+                prompt, race.stream_to(backend), prefix=prefix, schema=schema
+            ),
+            on_text,
+        )
+
+    def _race(
+        self,
+        call: Callable[[Backend, Race], Optional[CompletionResponse]],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Optional[CompletionResponse]:
+        order = self.order()
+        race = Race(on_text)
+        answers: queue.Queue = queue.Queue()
+        started: List[Tuple[Backend, float]] = []
+
+        def attempt(backend: Backend, start: float) -> None:
+            try:
+                result, error = call(backend, race), None
+            except Abandoned:
+                answers.put((backend, None, None, True))
+                return
+            except Exception as e:
+                result, error = None, e
+            self._report(backend, start, result)
+            answers.put((backend, result, error, False))
+
+        def launch() -> None:
+            backend, start = order[len(started)], time.monotonic()
+            started.append((backend, start))
+            threading.Thread(target=attempt, args=(backend, start), daemon=True).start()
+
+        launch()
+        pending = 1
+        error: Optional[Exception] = None
+        while pending:
+            try:
+                backend, result, e, abandoned = answers.get(
+                    timeout=self._wait(order, started)
+                )
+            except queue.Empty:
+                self._hedge(order, started)
+                if len(started) < len(order):
+                    launch()
+                    pending += 1
+                    continue
+                break
+
+            pending -= 1
+            if abandoned:
+                continue
+            if result is not None and race.claim(backend):
+                return result
+            if race.owner is backend:
+                if e is not None:
+                    raise e
+                return None
+
+            error = e or error
+            if not pending and len(started) < len(order):
+                launch()
+                pending += 1
+
+        return self._give_up(error, pending)
+
+    async def _arace(
+        self,
+        call: Callable[[Backend, Race], Awaitable[Optional[CompletionResponse]]],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> Optional[CompletionResponse]:
+        order = self.order()
+        race = Race(on_text)
+        started: List[Tuple[Backend, float]] = []
+        tasks: Dict[asyncio.Task, Backend] = {}
+
+        async def attempt(
+            backend: Backend, start: float
+        ) -> Optional[CompletionResponse]:
+            try:
+                result = await call(backend, race)
+            except (Abandoned, asyncio.CancelledError):
+                raise
+            except Exception:
+                self._report(backend, start, None)
+                raise
+            self._report(backend, start, result)
+            return result
+
+        def launch() -> None:
+            backend, start = order[len(started)], time.monotonic()
+            started.append((backend, start))
+            tasks[asyncio.ensure_future(attempt(backend, start))] = backend
+
+        launch()
+        error: Optional[Exception] = None
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks,
+                    timeout=self._wait(order, started),
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    self._hedge(order, started)
+                    if len(started) < len(order):
+                        launch()
+                        continue
+                    break
+
+                for task in done:
+                    backend = tasks.pop(task)
+                    if task.cancelled():
+                        continue
+                    e = task.exception()
+                    if isinstance(e, Abandoned):
+                        continue
+                    result = None if e is not None else task.result()
+                    if result is not None and race.claim(backend):
+                        return result
+                    if race.owner is backend:
+                        if e is not None:
+                            raise e
+                        return None
+                    error = e or error
+
+                if not tasks and len(started) < len(order):
+                    launch()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        return self._give_up(error, len(tasks))
+
+    def _wait(
+        self, order: List[Backend], started: List[Tuple[Backend, float]]
+    ) -> float:
+        """Seconds until the next backend is started, or the last one times out."""
+        backend, start = started[-1]
+        delay = backend.hedge_delay() if len(started) < len(order) else TIMEOUT
+        return max(start + delay - time.monotonic(), 0)
+
+    def _hedge(
+        self, order: List[Backend], started: List[Tuple[Backend, float]]
+    ) -> None:
+        """Record that the last backend started has not answered in time."""
+        backend, start = started[-1]
+        with self._lock:
+            if time.monotonic() - start >= TIMEOUT:
+                backend.failed()
+            elif len(started) < len(order):
+                backend.hedges += 1
+
+    def _report(
+        self, backend: Backend, start: float, result: Optional[CompletionResponse]
+    ) -> None:
+        with self._lock:
+            if result is None:
+                backend.failed()
+            else:
+                backend.succeeded(time.monotonic() - start)
+
+    def _give_up(
+        self, error: Optional[Exception], pending: int
+    ) -> Optional[CompletionResponse]:
+        """Raise the last error, or a timeout if backends are still running."""
+        if pending:
+            raise TimeoutError(f"No provider answered in {TIMEOUT:g} seconds")
+        if error is not None:
+            raise error
+        return None
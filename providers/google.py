@@ -1,23 +1,169 @@
+import asyncio
+import hashlib
+import logging
 import os
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Callable, Dict, Optional, Tuple, Type
 import google.generativeai as genai
+from pydantic import BaseModel
+from metrics import watch_retries
 from .base import LLMProvider, CompletionResponse
+from .helpers import json_schema
+
+# Gemini only caches contents with at least this many tokens
+CACHE_MIN_TOKENS = int(os.getenv("GOOGLE_CACHE_MIN_TOKENS", "32768"))
+
+# Seconds a cached prefix is kept, Gemini bills the storage while it is
+CACHE_TTL = int(os.getenv("GOOGLE_CACHE_TTL", "600"))
 
 
 class GoogleProvider(LLMProvider):
+    name = "google"
+    supports_schema = True
+
     def __init__(self):
         genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
         if not os.getenv("GOOGLE_API_KEY"):
             raise ValueError("GOOGLE_API_KEY environment variable is not set")
         self.model = os.getenv("GOOGLE_MODEL", "gemini-1.5-pro")
+        watch_retries("google.api_core.retry", logging.DEBUG)
+        self._cache_lock = threading.Lock()
+        # Cached content of every prefix with its expiration time, None when
+        # the prefix could not be cached
+        self._cached_contents: Dict[str, Tuple[Optional[object], float]] = {}
+
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        model, prefix = self._model(prefix)
+        response = model.generate_content(
+            prefix + prompt, generation_config=self._generation_config(schema)
+        )
+
+        return self._to_completion_response(response)
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        model, prefix = await asyncio.to_thread(self._model, prefix)
+        response = await model.generate_content_async(
+            prefix + prompt, generation_config=self._generation_config(schema)
+        )
+
+        return self._to_completion_response(response)
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        model, prefix = self._model(prefix)
+        response = model.generate_content(
+            prefix + prompt,
+            generation_config=self._generation_config(schema),
+            stream=True,
+        )
+        for chunk in response:
+            # The last chunk may only have the finish reason
+            if chunk.parts:
+                on_text(chunk.text)
+
+        return self._to_completion_response(response)
+
+    async def _astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        model, prefix = await asyncio.to_thread(self._model, prefix)
+        response = await model.generate_content_async(
+            prefix + prompt,
+            generation_config=self._generation_config(schema),
+            stream=True,
+        )
+        async for chunk in response:
+            if chunk.parts:
+                on_text(chunk.text)
+
+        return self._to_completion_response(response)
+
+    def _generation_config(
+        self, schema: Optional[Type[BaseModel]]
+    ) -> Optional[Dict[str, Any]]:
+        """Generation config constraining the response to a schema, if any.
+
+        The cached prefix is only contents, it is shared whatever the schema.
+        """
+        if schema is None:
+            return None
+        return {
+            "response_mime_type": "application/json",
+            "response_schema": json_schema(schema),
+        }
+
+    def _model(self, prefix: str) -> Tuple[genai.GenerativeModel, str]:
+        """Return the model to use and the part of the prefix it still needs.
+
+        Long prefixes are stored once as cached content and the model reads
+        them from there, shorter ones are sent with the prompt.
+        """
+        if (
+            prefix
+            and self.prompt_cache
+            and self.token_counter.count(prefix) >= CACHE_MIN_TOKENS
+        ):
+            cached_content = self._cached_content(prefix)
+            if cached_content is not None:
+                return genai.GenerativeModel.from_cached_content(cached_content), ""
+
+        return genai.GenerativeModel(self.model), prefix
+
+    def _cached_content(self, prefix: str) -> Optional[object]:
+        key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        now = time.time()
+        with self._cache_lock:
+            cached_content, expires = self._cached_contents.get(key, (None, 0.0))
+            if expires > now:
+                return cached_content
+
+            self._cached_contents = {
+                k: v for k, v in self._cached_contents.items() if v[1] > now
+            }
+            try:
+                cached_content = genai.caching.CachedContent.create(
+                    model=self.model,
+                    contents=[prefix],
+                    ttl=timedelta(seconds=CACHE_TTL),
+                )
+            except Exception:
+                # e.g. the model doesn't support caching, don't try again
+                # until the TTL has passed
+                cached_content = None
 
-    def completion(self, prompt: str) -> CompletionResponse:
-        model = genai.GenerativeModel(self.model)
-        response = model.generate_content(prompt)
+            # Stop using the cache a bit before it expires
+            self._cached_contents[key] = (cached_content, now + CACHE_TTL * 0.9)
+            return cached_content
 
+    def _to_completion_response(self, response) -> CompletionResponse:
+        usage = response.usage_metadata
         return CompletionResponse(
             text=response.text,
-            tokens_used=response.usage_metadata.prompt_token_count
-            + response.usage_metadata.candidates_token_count,
+            tokens_used=usage.prompt_token_count + usage.candidates_token_count,
+            input_tokens=usage.prompt_token_count,
+            output_tokens=usage.candidates_token_count,
+            cached_input_tokens=getattr(usage, "cached_content_token_count", 0) or 0,
         )
 
     def get_context_window(self) -> int:
@@ -27,5 +173,6 @@ class GoogleProvider(LLMProvider):
         }
         return context_windows.get(self.model, 1000000)
 
+    @property
     def max_tokens(self) -> int:
         return self.get_context_window()
@@ -1,27 +1,243 @@
+import copy
+import json
 import json5
+import os
 import re
-from typing import Any, Optional, List
-from repository import CodeChange
+from typing import Any, Dict, Optional, List, Type
+from pydantic import BaseModel
+from repository import CodeChange, render_compact_diff
 from rules import Rule
 
+# Characters that open or close a JSON object or array
+OPENING = "{["
+CLOSING = "}]"
+
+# Slices of a response parsed with JSON5 before giving up on it
+JSON5_ATTEMPTS = 3
+
+# How the diffs are rendered in prompts, unified or compact
+DIFF_FORMAT = os.getenv("DIFF_FORMAT", "unified").lower()
+
+# Unchanged lines kept around every change by the compact format
+DIFF_CONTEXT_LINES = int(os.getenv("DIFF_CONTEXT_LINES", "1"))
+
+
+def loads(text: str) -> Any:
+    """Parse JSON with the stdlib parser, or JSON5 if it is not strict JSON."""
+    try:
+        return json.loads(text, strict=False)
+    except ValueError:
+        return json5.loads(text, strict=False)
+
 
 def parse_json(text: str) -> Optional[Any]:
+    """Parse the JSON object or array in the text of a response.
+
+    Responses are usually plain JSON, sometimes in a markdown fence or after
+    a sentence. The text from the first opening bracket is decoded with the
+    stdlib parser, which ignores whatever follows the JSON, and only
+    responses that are not strict JSON, e.g. with comments or trailing
+    commas, are parsed with the much slower JSON5 parser.
+    """
     if "```json" in text:
         text = text.split("```json")[1]
         text = text.split("```")[0]
 
-    # Looks for a json object in the text
-    # and returns it as a python object
-    match = re.search(
-        r"[\{\[].*[\}\]]", text.strip(), re.MULTILINE | re.IGNORECASE | re.DOTALL
-    )
-    if not match or not match.group(0):
+    first = _next_opening(text, 0)
+    end = max(map(text.rfind, CLOSING))
+    if first < 0 or end < first:
         raise Exception("No json object found")
 
-    return json5.loads(match.group(0), strict=False)
+    # Keep the longest value decoded, brackets in the text around it, like
+    # "see [1]", decode too. Values that are not strict JSON, e.g. with
+    # comments or trailing commas, are decoded with JSON5 a few times at most.
+    decoder = json.JSONDecoder(strict=False)
+    best: Optional[Any] = None
+    longest = 0
+    attempts = JSON5_ATTEMPTS
+    start = first
+    while 0 <= start < end:
+        try:
+            value, stop = decoder.raw_decode(text, start)
+        except ValueError:
+            if attempts:
+                attempts -= 1
+                try:
+                    return json5.loads(text[start : end + 1], strict=False)
+                except ValueError:
+                    pass
+            start = _next_opening(text, start + 1)
+            continue
+        if stop - start > longest:
+            best, longest = value, stop - start
+        start = _next_opening(text, stop)
+
+    if not longest:
+        raise Exception("No valid json object found")
+    return best
+
+
+def schema_tool(model: Type[BaseModel]) -> Dict[str, Any]:
+    """Tool whose input is a model, forcing its use makes the response match it.
+
+    The definition is the same for the Anthropic API and Bedrock.
+    """
+    return {
+        "name": model.__name__,
+        "description": (model.__doc__ or model.__name__).strip(),
+        "input_schema": json_schema(model),
+    }
+
+
+def _next_opening(text: str, start: int) -> int:
+    """Index of the first opening bracket from start, -1 if there is none."""
+    indexes = [i for i in (text.find(c, start) for c in OPENING) if i >= 0]
+    return min(indexes, default=-1)
+
+
+def json_schema(model: Type[BaseModel], strict: bool = False) -> Dict[str, Any]:
+    """JSON schema of a model to constrain the output of an LLM.
+
+    References are inlined and titles and defaults dropped, since not every
+    provider supports them.
+
+    Args:
+        model: The model of the output
+        strict: Whether to forbid additional properties and require all of
+            them, as the strict mode of OpenAI needs
+    """
+    schema = model.model_json_schema()
+    definitions = schema.pop("$defs", {})
+
+    def resolve(node: Any) -> Any:
+        if isinstance(node, list):
+            return [resolve(item) for item in node]
+        if not isinstance(node, dict):
+            return node
+        if "$ref" in node:
+            return resolve(copy.deepcopy(definitions[node["$ref"].split("/")[-1]]))
+
+        node = {
+            key: value if key in ("properties", "enum") else resolve(value)
+            for key, value in node.items()
+            if key not in ("title", "default")
+        }
+        if "properties" in node:
+            node["properties"] = {
+                name: resolve(value) for name, value in node["properties"].items()
+            }
+            if strict:
+                node["additionalProperties"] = False
+                node["required"] = list(node["properties"])
+        return node
+
+    return resolve(schema)
+
+
+class JsonArrayParser:
+    """Incremental parser of a JSON array streamed in pieces.
+
+    Every element of the array that is an object is returned by feed as soon
+    as its closing brace is received, without waiting for the rest of the
+    array. Text before the array, like a markdown fence or a sentence, is
+    skipped. Elements that are not valid JSON5 are dropped.
+    """
+
+    TOKENS = re.compile(r"[\[\]{}\"'\\]")
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.quote: Optional[str] = None
+        # Offset in the buffer of the object being received
+        self.start: Optional[int] = None
+        self.count = 0
+        self.done = False
+
+    def feed(self, text: str) -> List[Any]:
+        """Parse the next piece of text and return the objects it completed."""
+        if self.done:
+            return []
+
+        self.buffer += text
+        items = []
+        buffer = self.buffer
+        pos = self.pos
+        while not self.done:
+            match = self.TOKENS.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+
+            i = match.start()
+            c = buffer[i]
+            pos = i + 1
+
+            if self.quote is not None:
+                if c == "\\":
+                    if pos == len(buffer):
+                        # Wait for the escaped character
+                        pos = i
+                        break
+                    pos += 1
+                elif c == self.quote:
+                    self.quote = None
+            elif self.depth == 0:
+                if c == "[":
+                    self.depth = 1
+            elif c in "\"'":
+                self.quote = c
+            elif c in "[{":
+                if self.depth == 1 and c == "{":
+                    self.start = i
+                self.depth += 1
+            elif c in "]}":
+                self.depth -= 1
+                if self.depth == 1 and self.start is not None:
+                    try:
+                        items.append(loads(buffer[self.start : pos]))
+                    except ValueError:
+                        pass
+                    self.start = None
+                    self.count += 1
+                elif self.depth == 0:
+                    # Brackets in text before the actual array, keep looking
+                    self.done = self.count > 0
+
+        # Drop the text already consumed
+        keep = self.start if self.start is not None else pos
+        self.buffer = buffer[keep:]
+        self.pos = pos - keep
+        if self.start is not None:
+            self.start = 0
+
+        return items
+
+
+def stringify_code_changes(
+    changes: List[CodeChange],
+    diff_format: str = DIFF_FORMAT,
+    context: int = DIFF_CONTEXT_LINES,
+) -> str:
+    """Render the changes of a prompt, numbered from 1.
+
+    The unified format sends the diffs as they are. The compact one puts the
+    path on the line of the change number and renders the diffs with
+    render_compact_diff, trimmed to `context` unchanged lines.
+    """
+    if diff_format == "compact":
+        return "\n".join(
+            f"Change {i+1}: {change.path}\n{render_compact_diff(change.diff, context)}"
+            for i, change in enumerate(changes)
+        )
+    return "\n".join(
+        [
+            f"Change {i+1}:\n{change.path}\n{change.diff}"
+            for i, change in enumerate(changes)
+        ]
+    )
 
-def stringify_code_changes(changes: List[CodeChange]) -> str:
-    return "\n".join([f"Change {i+1}:\n{change.path}\n{change.diff}" for i, change in enumerate(changes)])
 
 def stringify_rules(rules: List[Rule]) -> str:
     return "\n".join([f"{rule.content}" for rule in rules])
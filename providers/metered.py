@@ -0,0 +1,135 @@
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Type
+from pydantic import BaseModel
+from metrics import CallRecord, Metrics, count_attempts, get_metrics
+from .base import LLMProvider, CompletionResponse
+
+
+class Call:
+    """Completion being measured."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.first_token: Optional[float] = None
+        self.result: Optional[CompletionResponse] = None
+
+    def on_text(self, on_text: Callable[[str], None]) -> Callable[[str], None]:
+        """Wrap a stream callback to measure the time to the first text."""
+
+        def wrapper(text: str) -> None:
+            if self.first_token is None:
+                self.first_token = time.monotonic() - self.start
+            on_text(text)
+
+        return wrapper
+
+
+class MeteredProvider(LLMProvider):
+    """LLM provider decorator that records the metrics of every completion.
+
+    The latency, the input, cached and output tokens and the retries of the
+    SDK are recorded for every call to the wrapped provider. Async calls are
+    measured once they got a slot from the concurrency semaphore, so the
+    latency doesn't include the time waiting for one.
+    """
+
+    def __init__(self, provider: LLMProvider, metrics: Optional[Metrics] = None):
+        self.provider = provider
+        self.metrics = metrics or get_metrics()
+
+    @property
+    def name(self) -> str:
+        return self.provider.name
+
+    @property
+    def model(self) -> str:
+        return getattr(self.provider, "model", "")
+
+    @property
+    def max_tokens(self) -> int:
+        return self.provider.max_tokens
+
+    @property
+    def generation_params(self) -> Dict[str, Any]:
+        return self.provider.generation_params
+
+    @property
+    def concurrency(self) -> int:
+        return self.provider.concurrency
+
+    @property
+    def supports_schema(self) -> bool:
+        return self.provider.supports_schema
+
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        with self._measure() as call:
+            call.result = self.provider.completion(prompt, prefix=prefix, schema=schema)
+        return call.result
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        with self._measure() as call:
+            call.result = self.provider.stream(
+                prompt, call.on_text(on_text), prefix=prefix, schema=schema
+            )
+        return call.result
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        with self._measure() as call:
+            call.result = await self.provider._acompletion(prompt, prefix, schema)
+        return call.result
+
+    async def _astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        with self._measure() as call:
+            call.result = await self.provider._astream(
+                prompt, call.on_text(on_text), prefix, schema
+            )
+        return call.result
+
+    @contextmanager
+    def _measure(self) -> Iterator[Call]:
+        call = Call()
+        error = ""
+        with count_attempts() as attempts:
+            try:
+                yield call
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                result = call.result
+                self.metrics.record(
+                    CallRecord(
+                        provider=self.name,
+                        model=self.model,
+                        latency=time.monotonic() - call.start,
+                        input_tokens=result.input_tokens if result else 0,
+                        output_tokens=result.output_tokens if result else 0,
+                        cached_input_tokens=result.cached_input_tokens if result else 0,
+                        retries=attempts.total_retries,
+                        first_token_latency=call.first_token,
+                        error=error or ("no response" if result is None else ""),
+                    )
+                )
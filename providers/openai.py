@@ -1,27 +1,216 @@
+import hashlib
+import json
 import os
-from openai import OpenAI
-from .base import LLMProvider, CompletionResponse
+from typing import Any, Callable, Dict, List, Optional, Type
+from openai import OpenAI, AsyncOpenAI
+from openai.types.chat import ChatCompletion
+from pydantic import BaseModel
+from metrics import watch_retries
+from .base import LLMProvider, BatchRequest, CompletionResponse
+from .helpers import json_schema
+
+# Statuses of batches that won't make progress anymore
+BATCH_DONE_STATUSES = {"completed", "failed", "expired", "cancelled"}
 
 
 class OpenAIProvider(LLMProvider):
+    name = "openai"
+    supports_schema = True
+
     def __init__(self):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        # A base URL other than the OpenAI API, e.g. a proxy or a local stand-in
+        base_url = os.getenv("OPENAI_BASE_URL") or None
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=base_url)
         if not os.getenv("OPENAI_API_KEY"):
             raise ValueError("OPENAI_API_KEY environment variable is not set")
+        self.async_client = AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"), base_url=base_url
+        )
         self.model = os.getenv("OPENAI_MODEL", "gpt-4-turbo-preview")
+        watch_retries("openai._base_client")
+
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        response = self.client.chat.completions.create(
+            **self._request(prompt, prefix, schema)
+        )
+
+        return self._to_completion_response(response)
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        response = await self.async_client.chat.completions.create(
+            **self._request(prompt, prefix, schema)
+        )
+
+        return self._to_completion_response(response)
 
-    def completion(self, prompt: str) -> CompletionResponse:
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
         response = self.client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
+            **self._request(prompt, prefix, schema),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+
+        text: List[str] = []
+        usage = None
+        for chunk in response:
+            usage = self._read_chunk(chunk, text, on_text) or usage
+
+        return self._stream_response(text, usage)
+
+    async def _astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> CompletionResponse:
+        response = await self.async_client.chat.completions.create(
+            **self._request(prompt, prefix, schema),
+            stream=True,
+            stream_options={"include_usage": True},
         )
 
+        text: List[str] = []
+        usage = None
+        async for chunk in response:
+            usage = self._read_chunk(chunk, text, on_text) or usage
+
+        return self._stream_response(text, usage)
+
+    def submit_batch(self, requests: List[BatchRequest]) -> str:
+        lines = []
+        for request in requests:
+            body = self._request(
+                request.prompt, request.prefix, request.response_schema
+            )
+            # The SDK merges extra_body into the request, the batch file has it as is
+            body.update(body.pop("extra_body", {}))
+            lines.append(
+                json.dumps(
+                    {
+                        "custom_id": request.custom_id,
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": body,
+                    }
+                )
+            )
+
+        batch_file = self.client.files.create(
+            file=("sidekick-batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch",
+        )
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def get_batch_results(
+        self, batch_id: str
+    ) -> Optional[Dict[str, Optional[CompletionResponse]]]:
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status not in BATCH_DONE_STATUSES:
+            return None
+
+        results: Dict[str, Optional[CompletionResponse]] = {}
+        # Expired batches still have the results of the completed requests
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                results[item["custom_id"]] = (
+                    self._to_completion_response(
+                        ChatCompletion.model_validate(response["body"])
+                    )
+                    if response.get("status_code") == 200
+                    else None
+                )
+        return results
+
+    def _request(
+        self, prompt: str, prefix: str, schema: Optional[Type[BaseModel]] = None
+    ) -> Dict[str, Any]:
+        """Arguments of a chat completion request.
+
+        OpenAI caches prompt prefixes automatically, the prefix goes first and
+        its hash routes the requests sharing it to the same cache. OpenAI puts
+        the schema of the response format before the messages, requests with
+        different schemas don't share the cached prefix.
+        """
+        request: Dict[str, Any] = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prefix + prompt}],
+            **self.generation_params,
+        }
+        if schema is not None:
+            request["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": schema.__name__,
+                    "schema": json_schema(schema, strict=True),
+                    "strict": True,
+                },
+            }
+        if prefix and self.prompt_cache:
+            key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()[:32]
+            request["extra_body"] = {"prompt_cache_key": key}
+        return request
+
+    def _read_chunk(self, chunk, text: List[str], on_text: Callable[[str], None]):
+        """Pass the text of a stream chunk to on_text and return its usage."""
+        if chunk.choices and chunk.choices[0].delta.content:
+            text.append(chunk.choices[0].delta.content)
+            on_text(chunk.choices[0].delta.content)
+        # Only the last chunk has the usage
+        return chunk.usage
+
+    def _stream_response(self, text: List[str], usage) -> CompletionResponse:
+        if usage is None:
+            return CompletionResponse(text="".join(text), tokens_used=0)
+        return CompletionResponse(text="".join(text), **self._usage(usage))
+
+    def _to_completion_response(self, response) -> CompletionResponse:
+        # The content is empty when the model refuses to answer
         return CompletionResponse(
-            text=response.choices[0].message.content,
-            tokens_used=response.usage.total_tokens,
+            text=response.choices[0].message.content or "",
+            **self._usage(response.usage),
         )
 
+    def _usage(self, usage) -> Dict[str, int]:
+        details = getattr(usage, "prompt_tokens_details", None)
+        return {
+            "tokens_used": usage.total_tokens,
+            "input_tokens": usage.prompt_tokens,
+            "output_tokens": usage.completion_tokens,
+            "cached_input_tokens": (getattr(details, "cached_tokens", 0) or 0),
+        }
+
+    @property
+    def generation_params(self) -> Dict[str, Any]:
+        return {"temperature": 0.7}
+
     def get_context_window(self) -> int:
         context_windows = {
             "gpt-4-turbo-preview": 128000,
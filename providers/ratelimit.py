@@ -0,0 +1,286 @@
+import asyncio
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple, Type
+from pydantic import BaseModel
+from metrics import ThrottleRecord, get_metrics
+from .base import LLMProvider, CompletionResponse
+
+DEFAULT_RATE_LIMIT_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "sidekick", "ratelimit.sqlite"
+)
+
+
+class TokenBucket:
+    """Requests and tokens per minute shared by the processes of a host.
+
+    The bucket is a row of a SQLite database refilled continuously at the
+    limit rate, up to a minute worth of requests and tokens. Every take runs
+    in an immediate transaction, which locks the database, so processes never
+    spend the same tokens twice.
+    """
+
+    def __init__(self, path: str, key: str, rpm: float = 0, tpm: float = 0):
+        self.path = path
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, requests REAL NOT NULL, tokens REAL NOT NULL, "
+                "updated REAL NOT NULL)"
+            )
+
+    def take(self, tokens: int) -> float:
+        """Take a request and tokens from the bucket if it has them.
+
+        Requests larger than the bucket are charged a full bucket, so that
+        they wait for it to refill instead of forever.
+
+        Returns:
+            0 if they were taken, else the seconds to wait before they can be
+        """
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        with self._transaction() as db:
+            requests, available = self._refill(db)
+
+            wait = 0.0
+            if self.rpm and requests < 1:
+                wait = (1 - requests) * 60 / self.rpm
+            if self.tpm and available < tokens:
+                wait = max(wait, (tokens - available) * 60 / self.tpm)
+            if not wait:
+                requests -= 1
+                available -= tokens
+
+            self._store(db, requests, available)
+        return wait
+
+    def reconcile(self, charged: int, used: int) -> None:
+        """Give back the tokens charged but not used, or charge the extra ones.
+
+        Tokens used over the bucket leave it in debt, later requests wait
+        until it is paid off.
+        """
+        if not self.tpm or charged == used:
+            return
+        with self._transaction() as db:
+            requests, available = self._refill(db)
+            self._store(db, requests, available + min(charged, self.tpm) - used)
+
+    def acquire(self, tokens: int) -> float:
+        """Wait until a request and tokens can be taken and return the seconds waited."""
+        start = time.monotonic()
+        while True:
+            wait = self.take(tokens)
+            if not wait:
+                return time.monotonic() - start
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: int) -> float:
+        start = time.monotonic()
+        while True:
+            wait = await asyncio.to_thread(self.take, tokens)
+            if not wait:
+                return time.monotonic() - start
+            await asyncio.sleep(wait)
+
+    def _refill(self, db: sqlite3.Connection) -> Tuple[float, float]:
+        """Requests and tokens in the bucket now."""
+        now = time.time()
+        row = db.execute(
+            "SELECT requests, tokens, updated FROM buckets WHERE key = ?", (self.key,)
+        ).fetchone()
+        if row is None:
+            return self.rpm, self.tpm
+
+        requests, tokens, updated = row
+        elapsed = max(now - updated, 0)
+        return (
+            min(requests + elapsed * self.rpm / 60, self.rpm),
+            min(tokens + elapsed * self.tpm / 60, self.tpm),
+        )
+
+    def _store(self, db: sqlite3.Connection, requests: float, tokens: float) -> None:
+        db.execute(
+            "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+            (self.key, requests, tokens, time.time()),
+        )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+
+class RateLimitedProvider(LLMProvider):
+    """LLM provider decorator that keeps completions under RPM and TPM quotas.
+
+    Every completion waits for a request and its estimated input tokens from
+    a bucket keyed by the provider and model, shared with the other sidekick
+    processes of the host. Once it is done the estimate is reconciled with the
+    tokens actually used. Completions are delayed rather than failed, so
+    parallel runs are spread over the quota instead of getting 429s.
+    """
+
+    def __init__(
+        self,
+        provider: LLMProvider,
+        rpm: float = 0,
+        tpm: float = 0,
+        path: Optional[str] = None,
+    ):
+        self.provider = provider
+        self.bucket = TokenBucket(
+            os.path.expanduser(
+                path or os.getenv("RATE_LIMIT_PATH", DEFAULT_RATE_LIMIT_PATH)
+            ),
+            f"{provider.name}/{self.model}",
+            rpm,
+            tpm,
+        )
+
+    @property
+    def name(self) -> str:
+        return self.provider.name
+
+    @property
+    def model(self) -> str:
+        return getattr(self.provider, "model", "")
+
+    @property
+    def max_tokens(self) -> int:
+        return self.provider.max_tokens
+
+    @property
+    def generation_params(self) -> Dict[str, Any]:
+        return self.provider.generation_params
+
+    @property
+    def concurrency(self) -> int:
+        return self.provider.concurrency
+
+    @property
+    def supports_schema(self) -> bool:
+        return self.provider.supports_schema
+
+    def completion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        charged = self._estimate(prompt, prefix)
+        self._throttled(self.bucket.acquire(charged))
+        return self._reconcile(
+            charged,
+            lambda: self.provider.completion(prompt, prefix=prefix, schema=schema),
+        )
+
+    def stream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        charged = self._estimate(prompt, prefix)
+        self._throttled(self.bucket.acquire(charged))
+        return self._reconcile(
+            charged,
+            lambda: self.provider.stream(prompt, on_text, prefix=prefix, schema=schema),
+        )
+
+    async def _acompletion(
+        self,
+        prompt: str,
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        charged = self._estimate(prompt, prefix)
+        self._throttled(await self.bucket.aacquire(charged))
+        return await self._areconcile(
+            charged, lambda: self.provider._acompletion(prompt, prefix, schema)
+        )
+
+    async def _astream(
+        self,
+        prompt: str,
+        on_text: Callable[[str], None],
+        prefix: str = "",
+        schema: Optional[Type[BaseModel]] = None,
+    ) -> Optional[CompletionResponse]:
+        charged = self._estimate(prompt, prefix)
+        self._throttled(await self.bucket.aacquire(charged))
+        return await self._areconcile(
+            charged, lambda: self.provider._astream(prompt, on_text, prefix, schema)
+        )
+
+    def _estimate(self, prompt: str, prefix: str) -> int:
+        if not self.bucket.tpm:
+            return 0
+        return self.token_counter.count(prefix + prompt)
+
+    def _reconcile(
+        self, charged: int, call: Callable[[], Optional[CompletionResponse]]
+    ) -> Optional[CompletionResponse]:
+        try:
+            result = call()
+        except Exception:
+            # Failed requests are not billed, give the tokens back
+            self.bucket.reconcile(charged, 0)
+            raise
+        self.bucket.reconcile(charged, result.tokens_used if result else 0)
+        return result
+
+    async def _areconcile(
+        self, charged: int, call: Callable[[], Awaitable[Optional[CompletionResponse]]]
+    ) -> Optional[CompletionResponse]:
+        try:
+            result = await call()
+        except Exception:
+            await asyncio.to_thread(self.bucket.reconcile, charged, 0)
+            raise
+        await asyncio.to_thread(
+            self.bucket.reconcile, charged, result.tokens_used if result else 0
+        )
+        return result
+
+    def _throttled(self, seconds: float) -> None:
+        if seconds:
+            get_metrics().record(ThrottleRecord(self.name, self.model, seconds))
+
+
+def rate_limited(provider: LLMProvider) -> LLMProvider:
+    """Wrap a provider in a rate limiter if it has quotas configured.
+
+    The quotas are read from <NAME>_RPM and <NAME>_TPM, e.g. OPENAI_TPM.
+    """
+    prefix = provider.name.upper()
+    rpm = float(os.getenv(f"{prefix}_RPM", "0"))
+    tpm = float(os.getenv(f"{prefix}_TPM", "0"))
+    if not rpm and not tpm:
+        return provider
+    return RateLimitedProvider(provider, rpm, tpm)
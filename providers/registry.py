@@ -0,0 +1,52 @@
+import importlib
+from importlib.metadata import entry_points
+from typing import Dict, List, Type
+from .base import LLMProvider
+
+# Entry point group third-party packages use to register providers, e.g.
+# [project.entry-points."sidekick.providers"]
+# mistral = "sidekick_mistral:MistralProvider"
+ENTRY_POINT_GROUP = "sidekick.providers"
+
+# Built-in providers, imported only when selected so that their SDKs are not
+# loaded on every start
+BUILTIN_PROVIDERS: Dict[str, str] = {
+    "openai": "providers.openai:OpenAIProvider",
+    "anthropic": "providers.anthropic:AnthropicProvider",
+    "google": "providers.google:GoogleProvider",
+    "bedrock": "providers.bedrock:BedrockProvider",
+}
+
+
+def load_object(path: str) -> object:
+    """Import an object from a "module:attribute" path."""
+    module_name, _, attribute = path.partition(":")
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def available_providers() -> List[str]:
+    """Names of the built-in and installed providers."""
+    names = list(BUILTIN_PROVIDERS)
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name not in names:
+            names.append(entry_point.name)
+    return names
+
+
+def get_provider_class(name: str) -> Type[LLMProvider]:
+    """Import the class of a provider by name.
+
+    Built-in providers take precedence over the ones registered through the
+    sidekick.providers entry point group.
+    """
+    if name in BUILTIN_PROVIDERS:
+        return load_object(BUILTIN_PROVIDERS[name])
+
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name == name:
+            return entry_point.load()
+
+    raise ValueError(
+        f"Invalid provider '{name}'. "
+        f"Must be one of: {', '.join(available_providers())}"
+    )
@@ -1,15 +1,33 @@
 from .base import Repository
 from .gitlab import GitLabRepository
-from .code_request import CodeRequest, CodeChange
-from .helpers import count_tokens, split, count_tokens_change, count_tokens_cr
+from .code_request import CodeRequest, CodeChange, DiffRefs
+from .helpers import (
+    count_tokens,
+    split,
+    split_hunks,
+    hunk_lines,
+    render_compact_diff,
+    count_tokens_change,
+    count_tokens_cr,
+)
+from .tokens import TokenCounter, get_token_counter
+from .filters import NoiseFilter, FilterResult
 
 __all__ = [
     "Repository",
     "GitLabRepository",
     "CodeRequest",
     "CodeChange",
+    "DiffRefs",
     "count_tokens",
     "count_tokens_change",
     "count_tokens_cr",
     "split",
+    "split_hunks",
+    "hunk_lines",
+    "render_compact_diff",
+    "TokenCounter",
+    "get_token_counter",
+    "NoiseFilter",
+    "FilterResult",
 ]
@@ -1,24 +1,84 @@
 from abc import ABC, abstractmethod
-from repository.code_request import CodeRequest
-from typing import List
+from repository.code_request import CodeChange, CodeRequest
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 
 class Repository(ABC):
     """Abstract base class for repository implementations."""
 
     @abstractmethod
-    def get_code_request(self, project_id: int, request_id: int) -> CodeRequest:
+    def get_code_request(
+        self,
+        project_id: int,
+        request_id: int,
+        keep: Optional[Callable[[CodeChange], Optional[CodeChange]]] = None,
+    ) -> CodeRequest:
         """Get formatted changes from a code request.
 
         Args:
             project_id: The project ID
             request_id: The request ID
+            keep: Called with every change as soon as it is downloaded, returns
+                the change to keep, possibly modified, or None to drop it.
+                Dropped changes are not held until the whole code request is
+                downloaded
 
         Returns:
             List of dictionaries containing file changes
         """
         pass
 
+    @abstractmethod
+    def list_code_requests(
+        self,
+        group_id: Optional[str] = None,
+        project_id: Optional[str] = None,
+        updated_after: Optional[str] = None,
+        state: str = "opened",
+    ) -> List[Tuple[int, int]]:
+        """List the code requests of a group or a project.
+
+        Args:
+            group_id: The group ID or path
+            project_id: The project ID or path, used when no group is given
+            updated_after: Only code requests updated after this ISO 8601 time
+            state: Only code requests in this state
+
+        Returns:
+            List of (project ID, request ID)
+        """
+        pass
+
+    @abstractmethod
+    def get_code_request_delta(self, cr: CodeRequest, sha: str) -> CodeRequest:
+        """Get a copy of a code request with only the changes pushed after a commit.
+
+        Args:
+            cr: The code request
+            sha: The commit to compare the head of the code request with
+
+        Returns:
+            The code request with the changes between sha and its head
+        """
+        pass
+
+    @abstractmethod
+    def get_reviewed_sha(self, project_id: int, mr_id: int) -> Optional[str]:
+        """Get the head commit of the last review of a code request, if any."""
+        pass
+
+    @abstractmethod
+    def set_reviewed_sha(self, project_id: int, mr_id: int, sha: str) -> None:
+        """Remember the head commit reviewed for a code request."""
+        pass
+
+    @abstractmethod
+    def get_code_request_discussions(
+        self, project_id: int, mr_id: int
+    ) -> List[Dict[str, Any]]:
+        """Get the discussions of a code request with their notes."""
+        pass
+
     @abstractmethod
     def post_comment(self, project_id: int, mr_id: int, comment: str) -> None:
         """Post a comment on a merge request."""
@@ -1,13 +1,78 @@
-from typing import List
-from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
 
 
-class CodeChange(BaseModel):
-    path: str
-    diff: str
-    base_sha: str
-    start_sha: str
-    head_sha: str
+class DiffRefs:
+    """Commits the diff of a code request is between.
+
+    The refs are the same for every change of a code request, so its changes
+    share a single instance instead of a copy of the three SHAs each.
+    """
+
+    __slots__ = ("base_sha", "start_sha", "head_sha")
+
+    def __init__(self, base_sha: str = "", start_sha: str = "", head_sha: str = ""):
+        self.base_sha = base_sha
+        self.start_sha = start_sha
+        self.head_sha = head_sha
+
+    def to_dict(self) -> Dict[str, str]:
+        return {
+            "base_sha": self.base_sha,
+            "start_sha": self.start_sha,
+            "head_sha": self.head_sha,
+        }
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, DiffRefs) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return f"DiffRefs(base_sha={self.base_sha!r}, start_sha={self.start_sha!r}, head_sha={self.head_sha!r})"
+
+
+# Refs of changes created without any, e.g. in tests and benchmarks
+NO_REFS = DiffRefs()
+
+
+class CodeChange:
+    """Diff of a file of a code request.
+
+    Merge requests can change thousands of files, so a change only holds its
+    path, its diff and the refs of its code request, in slots.
+    """
+
+    __slots__ = ("path", "diff", "refs")
+
+    def __init__(self, path: str, diff: str, refs: Optional[DiffRefs] = None):
+        self.path = path
+        self.diff = diff
+        self.refs = refs or NO_REFS
+
+    @property
+    def base_sha(self) -> str:
+        return self.refs.base_sha
+
+    @property
+    def start_sha(self) -> str:
+        return self.refs.start_sha
+
+    @property
+    def head_sha(self) -> str:
+        return self.refs.head_sha
+
+    def with_diff(self, diff: str) -> "CodeChange":
+        """Copy of the change with another diff of the same file."""
+        return CodeChange(self.path, diff, self.refs)
+
+    def __eq__(self, other: Any) -> bool:
+        return (
+            isinstance(other, CodeChange)
+            and self.path == other.path
+            and self.diff == other.diff
+            and self.refs == other.refs
+        )
+
+    def __repr__(self) -> str:
+        return f"CodeChange(path={self.path!r}, diff=<{len(self.diff)} chars>)"
 
 
 class CodeRequest:
@@ -19,6 +84,8 @@ class CodeRequest:
         project_id: int,
         mr_id: int,
         base_branch: str,
+        head_sha: str = "",
+        diff_refs: Optional[DiffRefs] = None,
     ):
         self.title = title
         self.description = description
@@ -26,3 +93,5 @@ class CodeRequest:
         self.project_id = project_id
         self.mr_id = mr_id
         self.base_branch = base_branch
+        self.head_sha = head_sha
+        self.diff_refs = diff_refs or NO_REFS
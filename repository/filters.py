@@ -0,0 +1,262 @@
+import fnmatch
+import os
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+from repository.code_request import CodeChange
+from repository.helpers import HUNK_HEADER, hunk_lines, split_hunks
+from repository.tokens import TokenCounter, get_token_counter
+
+LOCKFILES = {
+    "package-lock.json",
+    "npm-shrinkwrap.json",
+    "yarn.lock",
+    "pnpm-lock.yaml",
+    "bun.lockb",
+    "poetry.lock",
+    "Pipfile.lock",
+    "uv.lock",
+    "pdm.lock",
+    "Cargo.lock",
+    "Gemfile.lock",
+    "composer.lock",
+    "go.sum",
+    "mix.lock",
+    "pubspec.lock",
+    "Podfile.lock",
+    "packages.lock.json",
+    "flake.lock",
+}
+
+VENDORED_PATTERN = re.compile(
+    r"(^|/)(vendor|vendors|third_party|thirdparty|node_modules|bower_components|"
+    r"\.yarn|site-packages|Pods)/"
+)
+
+GENERATED_PATH_PATTERN = re.compile(
+    r"\.min\.(js|css|mjs)$|\.(js|css)\.map$|\.snap$|(^|/)__snapshots__/|"
+    r"_pb2(_grpc)?\.pyi?$|\.pb\.(go|cc|h)$|\.g\.dart$|\.designer\.cs$"
+)
+
+# Header comments of generated files, e.g. "Code generated by stringer. DO NOT
+# EDIT." or "@generated", only looked for at the top of the file
+GENERATED_MARKER = re.compile(
+    r"@generated\b|<auto-generated\b|"
+    r"\b(?:code |auto-?)?generated (?:by|from)\b.*\bdo not edit\b|"
+    r"\bthis file (?:is|was|has been) (?:auto(?:matically)?[- ]?)?generated\b",
+    re.IGNORECASE,
+)
+
+# Number of lines at the top of a file scanned for generated file markers
+MARKER_LINES = 5
+
+# Files where indentation is part of the syntax, whose indentation changes
+# are never whitespace-only
+INDENTATION_SENSITIVE = re.compile(
+    r"\.(py|pyi|pyx|yaml|yml|coffee|haml|pug|sass|slim|nim)$|"
+    r"(^|/)(Makefile|GNUmakefile)$|\.mk$"
+)
+
+# Files with added lines longer than this are considered minified
+MAX_LINE_LENGTH = int(os.getenv("SIDEKICK_MAX_LINE_LENGTH", "1000"))
+
+IGNORE_FILE = ".sidekickignore"
+
+
+@dataclass
+class FilterResult:
+    """Changes kept by the noise filter and what it removed."""
+
+    changes: List[CodeChange] = field(default_factory=list)
+    # Removed changes with the reason they were removed
+    removed: List[Tuple[CodeChange, str]] = field(default_factory=list)
+    # Number of whitespace-only hunks removed from kept changes
+    hunks_removed: int = 0
+    tokens_saved: int = 0
+
+
+class NoiseFilter:
+    """Remove changes that are noise for a review before building prompts.
+
+    Lockfiles, vendored and generated files, binaries and minified files are
+    removed, as well as hunks that only change whitespace. Glob patterns from
+    a .sidekickignore file in the repository override the built-in detectors:
+    a pattern removes matching files and a pattern starting with ! keeps them.
+    """
+
+    def __init__(
+        self,
+        ignore: Sequence[str] = (),
+        keep: Sequence[str] = (),
+        max_line_length: int = MAX_LINE_LENGTH,
+    ):
+        self.ignore = list(ignore)
+        self.keep = list(keep)
+        self.max_line_length = max_line_length
+
+    @classmethod
+    def from_config(cls, path: str = IGNORE_FILE) -> "NoiseFilter":
+        """Create a filter with the overrides of an ignore file and SIDEKICK_IGNORE."""
+        ignore = [p for p in os.getenv("SIDEKICK_IGNORE", "").split(",") if p]
+        keep = []
+
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    if line.startswith("!"):
+                        keep.append(line[1:])
+                    else:
+                        ignore.append(line)
+
+        return cls(ignore, keep)
+
+    def detect(self, change: CodeChange) -> Optional[str]:
+        """Return why a change is noise, or None if it should be reviewed."""
+        path = change.path
+        if self._matches(path, self.keep):
+            return None
+        if self._matches(path, self.ignore):
+            return "ignored"
+
+        if os.path.basename(path) in LOCKFILES:
+            return "lockfile"
+        if VENDORED_PATTERN.search(path):
+            return "vendored"
+        if GENERATED_PATH_PATTERN.search(path):
+            return "generated"
+
+        if not change.diff.strip():
+            return "empty"
+        if change.diff.startswith("Binary files"):
+            return "binary"
+
+        if GENERATED_MARKER.search("\n".join(self._head(change.diff))):
+            return "generated"
+
+        added = [line[1:] for line in hunk_lines(change.diff) if line.startswith("+")]
+        if any(len(line) > self.max_line_length for line in added):
+            return "minified"
+
+        return None
+
+    def trim(self, change: CodeChange) -> Tuple[Optional[CodeChange], int]:
+        """Remove the hunks of a change that only modify whitespace.
+
+        Returns:
+            The trimmed change, or None if all its hunks were removed, and the
+            number of hunks removed
+        """
+        hunks = split_hunks(change.diff)
+        indentation = bool(INDENTATION_SENSITIVE.search(change.path))
+        kept = [hunk for hunk in hunks if not self._whitespace_only(hunk, indentation)]
+
+        if len(kept) == len(hunks):
+            return change, 0
+        if not kept:
+            return None, len(hunks)
+        trimmed = change.with_diff("".join(kept))
+        return trimmed, len(hunks) - len(kept)
+
+    def apply(
+        self, changes: List[CodeChange], counter: Optional[TokenCounter] = None
+    ) -> FilterResult:
+        """Filter the noise out of a list of changes."""
+        result = FilterResult()
+        for change in changes:
+            self.filter(change, result, counter)
+        return result
+
+    def filter(
+        self,
+        change: CodeChange,
+        result: FilterResult,
+        counter: Optional[TokenCounter] = None,
+    ) -> Optional[CodeChange]:
+        """Filter the noise out of a change and add the outcome to a result.
+
+        Changes can be filtered one by one as they are downloaded, only the
+        tokens of the changes removed or trimmed are counted.
+
+        Returns:
+            The change without its whitespace-only hunks, None if it is noise
+        """
+        reason = self.detect(change)
+        trimmed: Optional[CodeChange] = None
+        hunks_removed = 0
+        if reason is None:
+            trimmed, hunks_removed = self.trim(change)
+            if trimmed is None:
+                reason = "whitespace"
+
+        result.hunks_removed += hunks_removed
+        if trimmed is None:
+            result.removed.append((change, reason))
+        else:
+            result.changes.append(trimmed)
+
+        if trimmed is None or hunks_removed:
+            counter = counter or get_token_counter()
+            result.tokens_saved += counter.count_change(change) - (
+                counter.count_change(trimmed) if trimmed is not None else 0
+            )
+        return trimmed
+
+    @staticmethod
+    def _matches(path: str, patterns: Sequence[str]) -> bool:
+        for pattern in patterns:
+            pattern = pattern.rstrip("/")
+            if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(
+                os.path.basename(path), pattern
+            ):
+                return True
+            # A directory pattern matches everything below it
+            if path.startswith(pattern.lstrip("/") + "/"):
+                return True
+        return False
+
+    @staticmethod
+    def _head(diff: str) -> List[str]:
+        """The first MARKER_LINES lines of the new file that are in the diff."""
+        head: List[str] = []
+        number = 0
+        for line in diff.splitlines():
+            match = HUNK_HEADER.match(line)
+            if match:
+                number = int(match.group(1))
+                if number > MARKER_LINES:
+                    break
+            elif number and not line.startswith(("-", "\\")):
+                if number > MARKER_LINES:
+                    break
+                head.append(line[1:])
+                number += 1
+        return head
+
+    @staticmethod
+    def _whitespace_only(hunk: str, indentation: bool = False) -> bool:
+        """Whether a hunk only changes whitespace, line by line.
+
+        Blank lines and trailing whitespace are ignored. Indentation is
+        ignored too unless it is part of the syntax of the file, then only
+        tabs expanded to the same width are. Whitespace inside a line, e.g.
+        in a string literal, always counts.
+        """
+        added = []
+        removed = []
+        changed = False
+        for line in hunk_lines(hunk):
+            if line.startswith("+"):
+                lines = added
+            elif line.startswith("-"):
+                lines = removed
+            else:
+                continue
+            changed = True
+            line = line[1:].expandtabs().rstrip() if indentation else line[1:].strip()
+            if line:
+                lines.append(line)
+
+        return changed and added == removed
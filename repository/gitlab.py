@@ -1,9 +1,23 @@
 import os
+import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote, urljoin
 import requests
-from typing import Dict, List, Any
-from urllib.parse import urljoin
 from .base import Repository
-from repository.code_request import CodeRequest, CodeChange
+from .http import HttpClient
+from repository.code_request import CodeRequest, CodeChange, DiffRefs
+
+# Marker of the note used to remember the last reviewed commit of a merge request
+REVIEWED_MARKER = "<!-- sidekick:reviewed-sha={} -->"
+REVIEWED_PATTERN = re.compile(r"<!-- sidekick:reviewed-sha=([0-9a-f]+) -->")
+
+# Files per page of the merge request diffs, GitLab serves up to 100
+DIFFS_PER_PAGE = int(os.getenv("GITLAB_DIFFS_PER_PAGE", "100"))
+
+# Pages of diffs downloaded ahead of the one being processed
+DIFFS_PREFETCH = int(os.getenv("GITLAB_DIFFS_PREFETCH", "4"))
 
 
 class GitLabRepository(Repository):
@@ -17,6 +31,9 @@ class GitLabRepository(Repository):
             raise ValueError("GITLAB_TOKEN environment variable is required")
 
         self.headers = {"PRIVATE-TOKEN": self.token, "Content-Type": "application/json"}
+        self.http = HttpClient(self.headers)
+        # ID of the user of the token, fetched when first needed
+        self._user_id: Optional[int] = None
 
     def get_merge_request_changes(self, project_id: int, request_id: int) -> Dict:
         url = urljoin(
@@ -24,59 +41,219 @@ class GitLabRepository(Repository):
             f"/api/v4/projects/{project_id}/merge_requests/{request_id}/changes",
         )
 
-        response = requests.get(url, headers=self.headers)
+        response = self.http.get(url)
         response.raise_for_status()
 
         return response.json()
 
-    def get_code_request(self, project_id: int, mr_id: int) -> CodeRequest:
+    def iter_merge_request_diffs(
+        self, project_id: int, mr_id: int
+    ) -> Iterator[Dict[str, Any]]:
+        """Yield the diffs of the files of a merge request, page by page.
+
+        Unlike /changes, the paginated /diffs endpoint is not truncated for
+        big merge requests. Up to DIFFS_PREFETCH pages are downloaded in the
+        background while the diffs of the previous ones are consumed, so the
+        memory used is bounded by the pages in flight. GitLab versions
+        without /diffs fall back to /changes.
+        """
+        url = f"{self.host}/api/v4/projects/{project_id}/merge_requests/{mr_id}/diffs"
+
+        def fetch(page: int) -> requests.Response:
+            response = self.http.get(
+                url, params={"per_page": DIFFS_PER_PAGE, "page": page}
+            )
+            response.raise_for_status()
+            return response
+
+        response = self.http.get(url, params={"per_page": DIFFS_PER_PAGE, "page": 1})
+        if response.status_code == 404:
+            yield from self.get_merge_request_changes(project_id, mr_id)["changes"]
+            return
+        response.raise_for_status()
+
+        # The total is left out for big collections, then follow the next
+        # pages one at a time
+        total_pages = int(response.headers.get("X-Total-Pages") or 0)
+        next_page = int(response.headers.get("X-Next-Page") or 0)
+        if not next_page:
+            yield from response.json()
+            return
+
+        prefetch = max(DIFFS_PREFETCH, 1)
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending: Deque[Future] = deque()
+            try:
+                while True:
+                    if total_pages:
+                        while next_page <= total_pages and len(pending) < prefetch:
+                            pending.append(executor.submit(fetch, next_page))
+                            next_page += 1
+                    elif next_page and not pending:
+                        pending.append(executor.submit(fetch, next_page))
+
+                    # The next pages download while this one is consumed
+                    yield from response.json()
+
+                    if not pending:
+                        return
+                    response = pending.popleft().result()
+                    if not total_pages:
+                        next_page = int(response.headers.get("X-Next-Page") or 0)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def get_code_request(
+        self,
+        project_id: int,
+        mr_id: int,
+        keep: Optional[Callable[[CodeChange], Optional[CodeChange]]] = None,
+    ) -> CodeRequest:
         url = f"{self.host}/api/v4/projects/{project_id}/merge_requests/{mr_id}"
 
-        response = requests.get(url, headers=self.headers)
+        response = self.http.get(url)
         response.raise_for_status()
 
         mr_data = response.json()
-        data = self.get_merge_request_changes(project_id, mr_id)
-        diff_refs = data["diff_refs"]
-        # Format changes to match CodeRequest model
-        formatted_changes = []
-        for change in data["changes"]:
-            formatted_changes.append(
-                CodeChange(
-                    path=change["new_path"],
-                    diff=change["diff"],
-                    base_sha=diff_refs["base_sha"],
-                    start_sha=diff_refs["start_sha"],
-                    head_sha=diff_refs["head_sha"],
-                )
+        diff_refs = DiffRefs(**(mr_data.get("diff_refs") or {}))
+        # The diff refs are shared by all the changes instead of copied. The
+        # changes go through keep while the next pages download.
+        changes = []
+        for diff in self.iter_merge_request_diffs(project_id, mr_id):
+            change: Optional[CodeChange] = CodeChange(
+                diff["new_path"], diff["diff"], diff_refs
             )
+            if keep is not None:
+                change = keep(change)
+            if change is not None:
+                changes.append(change)
 
         return CodeRequest(
             title=mr_data["title"],
             description=mr_data["description"] or "",
-            changes=formatted_changes,
+            changes=changes,
             project_id=project_id,
             mr_id=mr_id,
             base_branch=mr_data["target_branch"],
+            head_sha=diff_refs.head_sha,
+            diff_refs=diff_refs,
         )
 
-    def post_comment(self, project_id: int, mr_id: int, comment: str) -> None:
+    def list_code_requests(
+        self,
+        group_id: Optional[str] = None,
+        project_id: Optional[str] = None,
+        updated_after: Optional[str] = None,
+        state: str = "opened",
+    ) -> List[Tuple[int, int]]:
+        if group_id:
+            url = f"{self.host}/api/v4/groups/{quote(str(group_id), safe='')}/merge_requests"
+        elif project_id:
+            url = f"{self.host}/api/v4/projects/{quote(str(project_id), safe='')}/merge_requests"
+        else:
+            raise ValueError("A group or a project is required to list merge requests")
+
+        params = {"state": state, "scope": "all"}
+        if updated_after:
+            params["updated_after"] = updated_after
+
+        return [(mr["project_id"], mr["iid"]) for mr in self.http.paginate(url, params)]
+
+    def get_code_request_delta(self, cr: CodeRequest, sha: str) -> CodeRequest:
+        url = f"{self.host}/api/v4/projects/{cr.project_id}/repository/compare"
+        params = {"from": sha, "to": cr.head_sha, "straight": "false"}
+
+        response = self.http.get(url, params=params)
+        response.raise_for_status()
+
+        # Comments are posted against the merge request diff, keep its refs
+        # and ignore files only changed by merges from the target branch
+        changes = {change.path: change for change in cr.changes}
+        delta_changes = []
+        for diff in response.json()["diffs"]:
+            change = changes.get(diff["new_path"])
+            if change is None or not diff["diff"]:
+                continue
+            delta_changes.append(change.with_diff(diff["diff"]))
+
+        return CodeRequest(
+            title=cr.title,
+            description=cr.description,
+            changes=delta_changes,
+            project_id=cr.project_id,
+            mr_id=cr.mr_id,
+            base_branch=cr.base_branch,
+            head_sha=cr.head_sha,
+            diff_refs=cr.diff_refs,
+        )
+
+    def get_notes(self, project_id: int, mr_id: int) -> List[Dict[str, Any]]:
         url = f"{self.host}/api/v4/projects/{project_id}/merge_requests/{mr_id}/notes"
-        headers = {**self.headers, "Content-Type": "application/json"}
 
+        return list(self.http.paginate(url))
+
+    def get_code_request_discussions(
+        self, project_id: int, mr_id: int
+    ) -> List[Dict[str, Any]]:
+        url = f"{self.host}/api/v4/projects/{project_id}/merge_requests/{mr_id}/discussions"
+
+        return list(self.http.paginate(url))
+
+    def get_user_id(self) -> int:
+        """ID of the user the token belongs to."""
+        if self._user_id is None:
+            response = self.http.get(f"{self.host}/api/v4/user")
+            response.raise_for_status()
+            self._user_id = response.json()["id"]
+        return self._user_id
+
+    def _find_reviewed_note(
+        self, project_id: int, mr_id: int
+    ) -> Optional[Dict[str, Any]]:
+        # Anyone can paste the marker in a note, only trust the ones sidekick wrote
+        user_id = self.get_user_id()
+        for note in self.get_notes(project_id, mr_id):
+            author = note.get("author") or {}
+            if author.get("id") == user_id and REVIEWED_PATTERN.search(note["body"]):
+                return note
+        return None
+
+    def get_reviewed_sha(self, project_id: int, mr_id: int) -> Optional[str]:
+        note = self._find_reviewed_note(project_id, mr_id)
+        if note is None:
+            return None
+        return REVIEWED_PATTERN.search(note["body"]).group(1)
+
+    def set_reviewed_sha(self, project_id: int, mr_id: int, sha: str) -> None:
+        body = f"Sidekick reviewed changes up to {sha[:8]}\n\n" + (
+            REVIEWED_MARKER.format(sha)
+        )
+
+        note = self._find_reviewed_note(project_id, mr_id)
+        if note is None:
+            self.post_comment(project_id, mr_id, body)
+            return
+
+        url = (
+            f"{self.host}/api/v4/projects/{project_id}/merge_requests/{mr_id}"
+            f"/notes/{note['id']}"
+        )
+        response = self.http.put(url, json={"body": body})
+        response.raise_for_status()
+
+    def post_comment(self, project_id: int, mr_id: int, comment: str) -> None:
+        url = f"{self.host}/api/v4/projects/{project_id}/merge_requests/{mr_id}/notes"
         data = {"body": comment}
 
-        response = requests.post(url, headers=headers, json=data)
+        response = self.http.post(url, json=data)
         response.raise_for_status()  # Raise exception for non-200 status codes
 
     def post_code_request_discussion(
-        self, project_id: int, mr_id: int, comment: str,
-        position: Dict[str, Any]
+        self, project_id: int, mr_id: int, comment: str, position: Dict[str, Any]
     ) -> None:
         url = f"{self.host}/api/v4/projects/{project_id}/merge_requests/{mr_id}/discussions"
 
-        headers = {**self.headers, "Content-Type": "application/json"}
-        
         data = {
             "body": comment,
             "base_sha": position["base_sha"],
@@ -85,13 +262,13 @@ class GitLabRepository(Repository):
             "position_type": "text",
             "old_path": position["old_path"],
             "new_path": position["new_path"],
-            "old_line": None, #position["old_line"],
+            "old_line": None,  # position["old_line"],
             "new_line": str(position["new_line"]),
         }
 
-        # print(" GET ", requests.get(url, headers=headers).json())
+        # print(" GET ", self.http.get(url).json())
         # print(data)
-        response = requests.post(url, headers=headers, json=data)
+        response = self.http.post(url, json=data)
         response.raise_for_status()  # Raise exception for non-200 status codes
 
     def label_code_request(
@@ -99,9 +276,7 @@ class GitLabRepository(Repository):
     ) -> None:
         url = f"{self.host}/api/v4/projects/{project_id}/merge_requests/{mr_id}"
 
-        headers = {**self.headers, "Content-Type": "application/json"}
-
         data = {"add_labels": labels}
 
-        response = requests.put(url, headers=headers, json=data)
+        response = self.http.put(url, json=data)
         response.raise_for_status()
@@ -1,17 +1,20 @@
+import re
 from repository.code_request import CodeRequest, CodeChange
-import tiktoken
-from typing import List
+from repository.tokens import TokenCounter, get_token_counter
+from typing import List, Optional, Tuple
+
+# Header of a hunk, with the first line in the new file and the section heading
+HUNK_HEADER = re.compile(r"^@@ -\d+(?:,\d+)? \+(\d+)(?:,\d+)? @@ ?(.*)$")
 
 
 def count_tokens(text: str) -> int:
-    """Count the number of tokens in a text using tiktoken."""
-    encoder = tiktoken.get_encoding("cl100k_base")  # Using OpenAI's common encoder
-    return len(encoder.encode(text))
+    """Count the number of tokens in a text using OpenAI's common encoder."""
+    return get_token_counter().count(text)
 
 
 def count_tokens_change(change: CodeChange) -> int:
     """Count the number of tokens in a change."""
-    return count_tokens(change.path) + count_tokens(change.diff)
+    return get_token_counter().count_change(change)
 
 
 def count_tokens_cr(cr: CodeRequest) -> int:
@@ -19,65 +22,189 @@ def count_tokens_cr(cr: CodeRequest) -> int:
     changes_text = "\n".join(
         f"File: {change.path}\n{change.diff}\n" for change in cr.changes
     )
-    return (
-        count_tokens(cr.title)
-        + count_tokens(cr.description)
-        + count_tokens(changes_text)
+    return sum(
+        get_token_counter().count_batch([cr.title, cr.description, changes_text])
     )
 
 
-def split(cr: CodeRequest, max_tokens: int) -> List[CodeRequest]:
+def split_hunks(diff: str) -> List[str]:
+    """Split a unified diff into hunks, each one starting with its @@ header.
+
+    Any preamble before the first hunk header is kept with the first hunk.
+    """
+    hunks = []
+    current = []
+    in_hunk = False
+    for line in diff.splitlines(keepends=True):
+        if line.startswith("@@"):
+            if in_hunk:
+                hunks.append("".join(current))
+                current = []
+            in_hunk = True
+        current.append(line)
+    if current:
+        hunks.append("".join(current))
+    return hunks
+
+
+def hunk_lines(diff: str) -> List[str]:
+    """Lines of the hunks of a diff, from the first hunk header on.
+
+    The file headers before it are dropped. Within a hunk `+++` and `---` are
+    content, e.g. `--- note` removes the SQL comment `-- note`.
     """
-    Split a CodeRequest into multiple CodeRequests if the changes exceed the token limit.
+    start = 0 if diff.startswith("@@") else diff.find("\n@@") + 1
+    return diff[start:].splitlines()
+
+
+def render_compact_diff(diff: str, context: int = 1) -> str:
+    """Render a unified diff with fewer tokens and explicit line numbers.
+
+    Added lines are prefixed with their line number in the new file, e.g.
+    `12+    return x`, so the model doesn't have to count lines from the hunk
+    header. Runs of unchanged lines are trimmed to `context` lines around the
+    changes, with a bare `@@` where lines were cut, and blocks of removed
+    lines are replaced by how many lines they were. Hunk headers keep only
+    their section heading and the file headers before the first hunk are
+    dropped.
+
+    Diffs without hunks, e.g. the stat lines of degraded changes, are
+    returned as they are.
 
     Args:
-        cr: The original CodeRequest
-        max_tokens: Maximum number of tokens allowed per request (default: 10000)
+        diff: The unified diff of a file
+        context: Unchanged lines kept before and after every change
 
     Returns:
-        List of CodeRequests, each containing a portion of the changes
+        The compact diff
     """
-    if count_tokens(cr.changes) <= max_tokens:
-        return [cr]
+    start = diff.find("@@")
+    if start > 0:
+        # Drop the file headers, the first hunk header starts a line
+        start = diff.find("\n@@") + 1
+    if start <= 0 and not diff.startswith("@@"):
+        return diff
+    hunks = split_hunks(diff[start:])
+
+    context = max(context, 0)
+    rendered: List[str] = []
+    for hunk in hunks:
+        header, *body = hunk.splitlines()
+        match = HUNK_HEADER.match(header)
+        if match is None:
+            # Not a hunk we can number, send it as it is
+            rendered.append(hunk.rstrip("\n"))
+            continue
 
-    # Split changes into individual files/hunks
-    changes_sections = cr.changes.split("diff --git ")
-    current_changes = ""
-    current_tokens = 0
-    split_requests = []
-    part = 1
+        rendered.append(f"@@ {match.group(2)}".rstrip())
+        number = int(match.group(1))
+        unchanged: List[str] = []
+        removed = 0
+        changed = False
+
+        def flush(last: bool = False) -> None:
+            nonlocal removed
+            if removed:
+                lines = "line" if removed == 1 else "lines"
+                rendered.append(f"-({removed} {lines} removed)")
+                removed = 0
+            if not unchanged or (last and not changed):
+                return
+            # Keep the lines after the previous change and before the next one
+            head = context if changed else 0
+            tail = 0 if last else context
+            if len(unchanged) <= head + tail:
+                rendered.extend(unchanged)
+            else:
+                rendered.extend(unchanged[:head])
+                if changed and not last:
+                    rendered.append("@@")
+                rendered.extend(unchanged[len(unchanged) - tail :])
+
+        for line in body:
+            if line.startswith("-"):
+                if unchanged:
+                    flush()
+                    unchanged = []
+                removed += 1
+                changed = True
+            elif line.startswith("+"):
+                if unchanged or removed:
+                    flush()
+                    unchanged = []
+                rendered.append(f"{number}+{line[1:]}")
+                number += 1
+                changed = True
+            elif line.startswith("\\"):
+                # \ No newline at end of file
+                continue
+            else:
+                if removed:
+                    flush()
+                unchanged.append(line)
+                number += 1
+        flush(last=True)
+
+    return "\n".join(rendered) + "\n"
+
+
+def split(
+    changes: List[CodeChange],
+    max_tokens: int,
+    counter: Optional[TokenCounter] = None,
+) -> List[List[Tuple[int, CodeChange]]]:
+    """
+    Pack code changes into chunks that fit in a token budget.
 
-    for section in changes_sections:
-        if not section.strip():
-            continue
+    Changes are packed in order. A change that does not fit in the budget on its
+    own is split at the hunk level into several changes for the same path. A
+    single hunk larger than the budget is kept whole in its own chunk.
 
-        # Add "diff --git" back to all sections except the first empty one
-        section = "diff --git " + section if section else section
-        section_tokens = count_tokens(section)
-
-        # If adding this section would exceed the token limit,
-        # create a new CodeRequest
-        if current_tokens + section_tokens > max_tokens and current_changes:
-            new_request = CodeRequest(
-                title=f"{cr.title} (Part {part})",
-                description=f"{cr.description}\n(Part {part} of split request)",
-                changes=current_changes.strip(),
-            )
-            split_requests.append(new_request)
-            current_changes = ""
-            current_tokens = 0
-            part += 1
+    Args:
+        changes: The code changes to pack
+        max_tokens: Maximum number of tokens allowed per chunk
+        counter: Token counter of the target model, defaults to OpenAI's
 
-        current_changes += section
-        current_tokens += section_tokens
+    Returns:
+        List of chunks, each one a list of (index in changes, change) pairs
+    """
+    counter = counter or get_token_counter()
+    chunks = []
+    current = []
+    current_tokens = 0
 
-    # Add the last batch of changes
-    if current_changes:
-        new_request = CodeRequest(
-            title=f"{cr.title} (Part {part})",
-            description=f"{cr.description}\n(Part {part} of split request)",
-            changes=current_changes.strip(),
-        )
-        split_requests.append(new_request)
+    def add(index: int, change: CodeChange, tokens: int) -> None:
+        nonlocal current, current_tokens
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current = []
+            current_tokens = 0
+        current.append((index, change))
+        current_tokens += tokens
+
+    for index, (change, tokens) in enumerate(
+        zip(changes, counter.count_changes(changes))
+    ):
+        if tokens <= max_tokens:
+            add(index, change, tokens)
+            continue
 
-    return split_requests
+        # Too big on its own, pack its hunks into as few parts as possible
+        hunks = split_hunks(change.diff)
+        path_tokens, *hunks_tokens = counter.count_batch([change.path] + hunks)
+        part = ""
+        part_tokens = path_tokens
+        for hunk, hunk_tokens in zip(hunks, hunks_tokens):
+            if part and part_tokens + hunk_tokens > max_tokens:
+                add(index, change.with_diff(part), part_tokens)
+                part = ""
+                part_tokens = path_tokens
+            part += hunk
+            part_tokens += hunk_tokens
+        if part:
+            add(index, change.with_diff(part), part_tokens)
+
+    if current:
+        chunks.append(current)
+
+    return chunks
@@ -0,0 +1,182 @@
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Iterator, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import RequestRecord, get_metrics
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Statuses of requests known not to have been processed, safe to retry for
+# methods that are not idempotent
+UNPROCESSED_STATUSES = {429, 503}
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+
+class HttpClient:
+    """HTTP client shared by all the requests to a repository API.
+
+    It keeps connections alive in a pool, applies timeouts, retries rate
+    limited requests and server errors with jittered exponential backoff and
+    slows down proactively when the RateLimit-* headers say the quota is about
+    to run out.
+    """
+
+    def __init__(
+        self,
+        headers: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        backoff: Optional[float] = None,
+        max_backoff: float = 60.0,
+        pool_size: Optional[int] = None,
+    ):
+        self.timeout = timeout or float(os.getenv("HTTP_TIMEOUT", "30"))
+        self.retries = (
+            retries if retries is not None else int(os.getenv("HTTP_RETRIES", "5"))
+        )
+        self.backoff = backoff or float(os.getenv("HTTP_BACKOFF", "0.5"))
+        self.max_backoff = max_backoff
+        pool_size = pool_size or int(os.getenv("HTTP_POOL_SIZE", "16"))
+
+        self.session = requests.Session()
+        self.session.headers.update(headers or {})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        # Requests are spaced by this interval when the rate limit is low
+        self._interval = 0.0
+        self._next = 0.0
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url: str, **kwargs: Any) -> requests.Response:
+        return self.request("PUT", url, **kwargs)
+
+    def paginate(self, url: str, params: Optional[dict] = None) -> Iterator[Any]:
+        """Yield the items of every page of a paginated GET, in order.
+
+        Pages are followed with the X-Next-Page header, 100 items per page
+        unless params sets per_page.
+        """
+        params = {"per_page": 100, **(params or {})}
+        page = 1
+        while page:
+            response = self.get(url, params={**params, "page": page})
+            response.raise_for_status()
+            yield from response.json()
+            page = int(response.headers.get("X-Next-Page") or 0)
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """Send a request, retrying it on rate limits, server and network errors.
+
+        The response of the last attempt is returned whatever its status, it
+        is up to the caller to raise_for_status.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        statuses = RETRY_STATUSES if idempotent else UNPROCESSED_STATUSES
+        # A read timeout may happen after a POST was processed
+        errors = (
+            (requests.ConnectionError, requests.Timeout)
+            if idempotent
+            else (requests.ConnectionError,)
+        )
+
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            self._throttle()
+
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except errors:
+                if attempt >= self.retries:
+                    self._record(method, 0, start, attempt)
+                    raise
+                self._sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            except requests.RequestException:
+                self._record(method, 0, start, attempt)
+                raise
+
+            self._update_rate_limit(response)
+
+            if response.status_code not in statuses or attempt >= self.retries:
+                self._record(method, response.status_code, start, attempt)
+                return response
+
+            delay = self._retry_after(response)
+            self._sleep(delay if delay is not None else self._backoff(attempt))
+            attempt += 1
+
+    def _record(self, method: str, status: int, start: float, retries: int) -> None:
+        get_metrics().record(
+            RequestRecord(method.upper(), status, time.monotonic() - start, retries)
+        )
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter, see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def _retry_after(self, response: requests.Response) -> Optional[float]:
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return min(float(value), self.max_backoff)
+        except ValueError:
+            pass
+        try:
+            return min(
+                max(parsedate_to_datetime(value).timestamp() - time.time(), 0),
+                self.max_backoff,
+            )
+        except (TypeError, ValueError):
+            return None
+
+    def _update_rate_limit(self, response: requests.Response) -> None:
+        """Spread the remaining requests until the rate limit window resets."""
+        remaining = response.headers.get("RateLimit-Remaining")
+        reset = response.headers.get("RateLimit-Reset")
+        limit = response.headers.get("RateLimit-Limit")
+        if remaining is None or reset is None or limit is None:
+            return
+
+        try:
+            remaining, reset, limit = int(remaining), float(reset), int(limit)
+        except ValueError:
+            return
+
+        # Only throttle when less than 10% of the quota is left
+        if remaining > limit // 10:
+            interval = 0.0
+        else:
+            window = max(reset - time.time(), 0)
+            interval = min(window / max(remaining, 1), self.max_backoff)
+
+        with self._lock:
+            self._interval = interval
+
+    def _throttle(self) -> None:
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            self._sleep(start - now)
+
+    def _sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
@@ -0,0 +1,128 @@
+import hashlib
+import math
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+from repository.code_request import CodeChange
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# Tokens counted by each provider's tokenizer for every cl100k_base token,
+# measured on code diffs. Used to calibrate the local tokenizer for the
+# providers that don't publish theirs.
+CALIBRATION = {
+    "openai": 1.0,
+    "anthropic": 1.15,
+    "bedrock": 1.15,
+    "google": 1.05,
+}
+
+# Characters per token used when no tokenizer can be loaded (e.g. offline)
+CHARS_PER_TOKEN = 3.5
+
+# Maximum number of memoized change counts
+MAX_MEMOIZED_CHANGES = 100000
+
+
+@lru_cache(maxsize=None)
+def get_encoding(name: str) -> Optional[Any]:
+    """Load a tiktoken encoding once, or None if it is not available.
+
+    tiktoken is imported here, the first time tokens are counted, so that
+    commands that never count tokens don't pay for loading it.
+    """
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(name)
+    except Exception:
+        return None
+
+
+class TokenCounter:
+    """Count tokens of prompts and code changes for a model.
+
+    Counts of code changes are memoized by the hash of their path and diff so
+    that budgeting the same change again, from another action or chunk, is
+    free.
+    """
+
+    def __init__(self, encoding: str = DEFAULT_ENCODING, ratio: float = 1.0):
+        self.encoding = encoding
+        self.ratio = ratio
+        self._changes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def count(self, text: str) -> int:
+        """Count the number of tokens in a text."""
+        return self.count_batch([text])[0]
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        """Count the number of tokens of several texts at once."""
+        encoder = get_encoding(self.encoding)
+        if encoder is None:
+            return [
+                math.ceil(len(text) * self.ratio / CHARS_PER_TOKEN) for text in texts
+            ]
+
+        if len(texts) == 1:
+            tokens = [encoder.encode_ordinary(texts[0])]
+        else:
+            tokens = encoder.encode_ordinary_batch(texts)
+        return [math.ceil(len(t) * self.ratio) for t in tokens]
+
+    def count_change(self, change: CodeChange) -> int:
+        """Count the number of tokens in a change."""
+        return self.count_changes([change])[0]
+
+    def count_changes(self, changes: List[CodeChange]) -> List[int]:
+        """Count the number of tokens of every change, path and diff included."""
+        keys = [self._key(change) for change in changes]
+
+        with self._lock:
+            counts = [self._changes.get(key) for key in keys]
+
+        missing = [i for i, count in enumerate(counts) if count is None]
+        if missing:
+            texts = []
+            for i in missing:
+                texts.append(changes[i].path)
+                texts.append(changes[i].diff)
+            tokens = self.count_batch(texts)
+
+            with self._lock:
+                if len(self._changes) + len(missing) > MAX_MEMOIZED_CHANGES:
+                    self._changes.clear()
+                for n, i in enumerate(missing):
+                    counts[i] = tokens[2 * n] + tokens[2 * n + 1]
+                    self._changes[keys[i]] = counts[i]
+
+        return counts
+
+    @staticmethod
+    def _key(change: CodeChange) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(change.path.encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+        digest.update(change.diff.encode("utf-8", "surrogatepass"))
+        return digest.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(provider: str = "openai", model: str = "") -> TokenCounter:
+    """Get the shared token counter for a provider and model.
+
+    OpenAI models use their own tiktoken encoding. Other providers don't ship
+    a local tokenizer, so their counts are estimated with cl100k_base scaled by
+    a calibration ratio.
+    """
+    if provider == "openai":
+        try:
+            from tiktoken.model import encoding_name_for_model
+
+            encoding = encoding_name_for_model(model)
+        except Exception:
+            encoding = DEFAULT_ENCODING
+        return TokenCounter(encoding)
+
+    return TokenCounter(DEFAULT_ENCODING, CALIBRATION.get(provider, 1.0))
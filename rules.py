@@ -1,6 +1,8 @@
 import os
+import re
 from dataclasses import dataclass
-from typing import List
+from functools import lru_cache
+from typing import Dict, List, Optional, Pattern, Tuple
 
 
 @dataclass
@@ -11,6 +13,161 @@ class Rule:
     alwaysApply: str
     content: str
 
+    @property
+    def always_apply(self) -> bool:
+        return self.alwaysApply.strip().lower() == "true"
+
+    @property
+    def patterns(self) -> List[str]:
+        """Glob patterns of the files the rule applies to."""
+        globs = self.globs.strip().strip("[]")
+        return [
+            g.strip().strip("\"'")
+            for g in split_top_level(globs, ",")
+            if g.strip("\"' ")
+        ]
+
+    def applies_to(self, path: str) -> bool:
+        """Whether the rule applies to a file.
+
+        Rules without globs apply to every file, like before globs were used.
+        """
+        if self.always_apply or not self.patterns:
+            return True
+        regex = compile_globs(tuple(self.patterns))
+        return regex is not None and regex.match(path) is not None
+
+
+def split_top_level(text: str, separator: str) -> List[str]:
+    """Split a text on a separator, except inside {} braces."""
+    parts = []
+    depth = 0
+    start = 0
+    for i, char in enumerate(text):
+        if char == "{":
+            depth += 1
+        elif char == "}" and depth:
+            depth -= 1
+        elif char == separator and not depth:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def glob_to_regex(glob: str) -> str:
+    """Translate a glob to a regex, ** matches any number of directories.
+
+    Globs without a / match the file name in any directory. {a,b} matches
+    any of the comma-separated alternatives.
+    """
+    glob = glob.lstrip("/") if "/" in glob.rstrip("/") else "**/" + glob
+    # A directory matches everything below it
+    return _glob_body_to_regex(glob) + "(?:/.*)?"
+
+
+def _glob_body_to_regex(glob: str) -> str:
+    regex = ""
+    i = 0
+    while i < len(glob):
+        if glob.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif glob.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif glob[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif glob[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif glob[i] == "{" and _closing_brace(glob, i) != -1:
+            end = _closing_brace(glob, i)
+            alternatives = split_top_level(glob[i + 1 : end], ",")
+            regex += (
+                "(?:" + "|".join(_glob_body_to_regex(a) for a in alternatives) + ")"
+            )
+            i = end + 1
+        else:
+            regex += re.escape(glob[i])
+            i += 1
+    return regex
+
+
+def _closing_brace(glob: str, start: int) -> int:
+    """Index of the brace closing the one at start, -1 if it is not closed."""
+    depth = 0
+    for i in range(start, len(glob)):
+        if glob[i] == "{":
+            depth += 1
+        elif glob[i] == "}":
+            depth -= 1
+            if depth == 0:
+                return i
+    return -1
+
+
+@lru_cache(maxsize=None)
+def compile_globs(globs: Tuple[str, ...]) -> Optional[Pattern]:
+    """Compile several globs into a single regex matching any of them."""
+    if not globs:
+        return None
+    return re.compile("|".join(f"(?:{glob_to_regex(g)})" for g in globs) + "$")
+
+
+class RuleIndex:
+    """Index of rules to find the ones that apply to each file.
+
+    Rules marked with alwaysApply apply to every file, the others only to the
+    files matching their globs.
+    """
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        self._always = [i for i, rule in enumerate(rules) if rule.always_apply]
+        self._globbed = [
+            (i, compile_globs(tuple(rule.patterns)))
+            for i, rule in enumerate(rules)
+            if not rule.always_apply
+        ]
+        self._cache: Dict[str, Tuple[int, ...]] = {}
+
+    def _match(self, path: str) -> Tuple[int, ...]:
+        matched = self._cache.get(path)
+        if matched is None:
+            matched = tuple(
+                sorted(
+                    self._always
+                    + [
+                        i
+                        for i, regex in self._globbed
+                        if regex is None or regex.match(path)
+                    ]
+                )
+            )
+            self._cache[path] = matched
+        return matched
+
+    def rules_for(self, path: str) -> List[Rule]:
+        """Get the rules that apply to a file."""
+        return [self.rules[i] for i in self._match(path)]
+
+    def group(self, paths: List[str]) -> List[Tuple[List[Rule], List[int]]]:
+        """Group files by the rules that apply to them.
+
+        Returns:
+            List of (rules, indexes of the paths they apply to) in order of
+            first appearance
+        """
+        groups: Dict[Tuple[int, ...], List[int]] = {}
+        for n, path in enumerate(paths):
+            groups.setdefault(self._match(path), []).append(n)
+        return [
+            ([self.rules[i] for i in matched], members)
+            for matched, members in groups.items()
+        ]
+
 
 def parse_rule_file(filepath: str) -> Rule:
     """Parse a single rule file and return a Rule object."""
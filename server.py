@@ -0,0 +1,358 @@
+import argparse
+import hmac
+import json
+import os
+import queue
+import threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Set
+from colorama import Fore, Style
+from main import (
+    add_fuse_argument,
+    failed_actions,
+    get_provider,
+    get_repository,
+    parse_actions,
+    review_code_request,
+)
+from metrics import get_metrics
+from providers import LLMProvider
+from repository import Repository
+from rules import Rule, load_rules
+
+# Merge request actions that trigger a review, updates only when commits were pushed
+REVIEW_ACTIONS = {"open", "reopen", "update"}
+
+
+@dataclass(frozen=True)
+class Job:
+    project_id: int
+    cr_id: int
+
+
+def parse_webhook(payload: Dict[str, Any], label: str = "") -> Optional[Job]:
+    """Get the job to run for a GitLab merge request webhook, if any.
+
+    Args:
+        payload: The webhook payload
+        label: Only review merge requests with this label when set
+
+    Returns:
+        The job, or None if the event doesn't need a review
+    """
+    if payload.get("object_kind") != "merge_request":
+        return None
+
+    attributes = payload.get("object_attributes") or {}
+    action = attributes.get("action")
+    if action not in REVIEW_ACTIONS:
+        return None
+    # Updates without oldrev change the title, labels... but not the code
+    if action == "update" and not attributes.get("oldrev"):
+        return None
+    if attributes.get("state", "opened") != "opened":
+        return None
+
+    if label:
+        labels = [l.get("title") for l in payload.get("labels") or []]
+        if label not in labels:
+            return None
+
+    return Job(project_id=int(payload["project"]["id"]), cr_id=int(attributes["iid"]))
+
+
+class ReviewServer:
+    """Review merge requests from GitLab webhooks with a pool of workers.
+
+    Webhooks are validated with the secret token configured in GitLab and
+    queued as jobs. The provider, repository and rules are created once and
+    shared by the workers. A job for a merge request already in the queue is
+    not queued again, and one for a merge request being reviewed runs again
+    once the current review finishes.
+    """
+
+    def __init__(
+        self,
+        action_names: List[str],
+        provider: LLMProvider,
+        repository: Repository,
+        rules: List[Rule],
+        secret: str,
+        workers: int = 4,
+        post: bool = True,
+        incremental: bool = False,
+        label: str = "",
+        verbose: bool = False,
+    ):
+        if not secret:
+            raise ValueError("WEBHOOK_SECRET environment variable is required")
+
+        self.action_names = action_names
+        self.provider = provider
+        self.repository = repository
+        self.rules = rules
+        self.secret = secret
+        self.workers = workers
+        self.post = post
+        self.incremental = incremental
+        self.label = label
+        self.verbose = verbose
+
+        self.queue: "queue.Queue[Job]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._queued: Set[Job] = set()
+        self._running: Set[Job] = set()
+        self._rerun: Set[Job] = set()
+        self.in_progress = 0
+        self.processed = 0
+        self.failed = 0
+        self.tokens_used = 0
+
+    def start(self) -> None:
+        for i in range(self.workers):
+            threading.Thread(
+                target=self._work, name=f"sidekick-worker-{i}", daemon=True
+            ).start()
+
+    def enqueue(self, job: Job) -> bool:
+        """Queue a job, returns False if it was already queued."""
+        with self._lock:
+            if job in self._queued or job in self._rerun:
+                return False
+            if job in self._running:
+                self._rerun.add(job)
+                return True
+            self._queued.add(job)
+        self.queue.put(job)
+        return True
+
+    def authorized(self, token: Optional[str]) -> bool:
+        return token is not None and hmac.compare_digest(token, self.secret)
+
+    def health(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "status": "ok",
+                "queue_depth": self.queue.qsize(),
+                "in_progress": self.in_progress,
+                "workers": self.workers,
+                "processed": self.processed,
+                "failed": self.failed,
+                "tokens_used": self.tokens_used,
+            }
+
+    def _work(self) -> None:
+        while True:
+            job = self.queue.get()
+            with self._lock:
+                self._queued.discard(job)
+                self._running.add(job)
+                self.in_progress += 1
+
+            try:
+                print(
+                    f"{Fore.WHITE}Reviewing merge request {job.project_id}!{job.cr_id}{Style.RESET_ALL}"
+                )
+                results = review_code_request(
+                    job.project_id,
+                    job.cr_id,
+                    self.action_names,
+                    self.provider,
+                    self.repository,
+                    self.rules,
+                    post=self.post,
+                    verbose=self.verbose,
+                    jobs=len(self.action_names),
+                    incremental=self.incremental,
+                )
+                error = failed_actions(results)
+                if error:
+                    print(
+                        f"{Fore.RED}Review of {job.project_id}!{job.cr_id} failed: {error}{Style.RESET_ALL}"
+                    )
+                with self._lock:
+                    if error:
+                        self.failed += 1
+                    else:
+                        self.processed += 1
+                    self.tokens_used += sum(r.tokens_used for r in results.values())
+            except Exception as e:
+                print(
+                    f"{Fore.RED}Review of {job.project_id}!{job.cr_id} failed: {e}{Style.RESET_ALL}"
+                )
+                with self._lock:
+                    self.failed += 1
+            finally:
+                with self._lock:
+                    self.in_progress -= 1
+                    self._running.discard(job)
+                    rerun = job in self._rerun
+                    self._rerun.discard(job)
+                if rerun:
+                    # Commits were pushed during the review
+                    self.enqueue(job)
+                metrics = get_metrics()
+                if metrics.prometheus_path:
+                    metrics.write_prometheus(metrics.prometheus_path)
+                self.queue.task_done()
+
+    def handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.rstrip("/") == "/health":
+                    self._respond(200, server.health())
+                elif self.path.rstrip("/") == "/metrics":
+                    self._send(
+                        200,
+                        get_metrics().render_prometheus().encode("utf-8"),
+                        "text/plain; version=0.0.4",
+                    )
+                else:
+                    self._respond(404, {"error": "not found"})
+
+            def do_POST(self) -> None:
+                if self.path.rstrip("/") != "/webhook":
+                    self._respond(404, {"error": "not found"})
+                    return
+
+                if not server.authorized(self.headers.get("X-Gitlab-Token")):
+                    self._respond(401, {"error": "invalid token"})
+                    return
+
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    payload = json.loads(self.rfile.read(length))
+                    job = parse_webhook(payload, server.label)
+                except (ValueError, KeyError, TypeError) as e:
+                    self._respond(400, {"error": f"invalid payload: {e}"})
+                    return
+
+                if job is None:
+                    self._respond(200, {"status": "ignored"})
+                    return
+
+                queued = server.enqueue(job)
+                self._respond(
+                    202,
+                    {
+                        "status": "queued" if queued else "already queued",
+                        "queue_depth": server.queue.qsize(),
+                    },
+                )
+
+            def _respond(self, status: int, body: Dict[str, Any]) -> None:
+                self._send(status, json.dumps(body).encode("utf-8"), "application/json")
+
+            def _send(self, status: int, data: bytes, content_type: str) -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                if server.verbose:
+                    super().log_message(format, *args)
+
+        return Handler
+
+    def serve(self, host: str, port: int) -> None:
+        self.start()
+        httpd = ThreadingHTTPServer((host, port), self.handler())
+        print(
+            f"{Fore.WHITE}Listening for webhooks on {host}:{port} with {self.workers} workers{Style.RESET_ALL}"
+        )
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Review GitLab merge requests from webhooks"
+    )
+    parser.add_argument(
+        "--actions",
+        default=os.getenv("SIDEKICK_ACTIONS", "review_code,review_format,summarize"),
+        help="Comma-separated list of actions to perform on every merge request",
+    )
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "0.0.0.0"))
+    parser.add_argument(
+        "--port", type=int, default=int(os.getenv("SERVER_PORT", "8080"))
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=int(os.getenv("SERVER_WORKERS", "4")),
+        help="Number of merge requests reviewed at the same time",
+    )
+    parser.add_argument(
+        "-r", "--rules", help="Optional path to rules file or directory"
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="Don't post results to the merge requests",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        action="store_true",
+        default=os.getenv("SIDEKICK_CACHE", "").lower() in ("1", "true", "yes"),
+        help="Cache LLM responses on disk and reuse them for identical prompts",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help="Only review the code pushed since the last review posted by sidekick",
+    )
+    parser.add_argument(
+        "-l",
+        "--label",
+        default=os.getenv("SIDEKICK_LABEL", ""),
+        help="Only review merge requests with this label",
+    )
+    parser.add_argument(
+        "-m",
+        "--metrics",
+        default=os.getenv("SIDEKICK_METRICS"),
+        help="Also write metrics to this file, as a Prometheus textfile if it ends in .prom or else as JSON lines",
+    )
+    add_fuse_argument(parser)
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="Enable verbose output with colors"
+    )
+    args = parser.parse_args()
+
+    try:
+        get_metrics().configure(args.metrics)
+        server = ReviewServer(
+            parse_actions(args.actions, args.fuse),
+            get_provider(args.cache),
+            get_repository(),
+            load_rules(args.rules),
+            secret=os.getenv("WEBHOOK_SECRET", ""),
+            workers=args.workers,
+            post=not args.dry_run,
+            incremental=args.incremental,
+            label=args.label,
+            verbose=args.verbose,
+        )
+        server.serve(args.host, args.port)
+    except ValueError as e:
+        print(f"Error: {e}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        get_metrics().close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+import io
+import json
+from batch import BatchRunner, summarize
+from fakes import FakeGitLab, FakeProvider, MergeRequestSpec
+from repository import GitLabRepository
+from rules import Rule
+
+RULES = [Rule("naming.md", "Naming", "", "true", "Use descriptive names")]
+
+
+class DownProvider(FakeProvider):
+    def respond(self, prompt: str, prefix: str = "") -> str:
+        raise ConnectionError("provider is down")
+
+
+def run(monkeypatch, provider):
+    with FakeGitLab(MergeRequestSpec(count=2, files=3)) as gitlab:
+        monkeypatch.setenv("GITLAB_HOST", gitlab.url)
+        monkeypatch.setenv("GITLAB_TOKEN", "test")
+        runner = BatchRunner(
+            ["review_code", "summarize"], provider, GitLabRepository(), RULES
+        )
+        output = io.StringIO()
+        results, elapsed = runner.run([(1, 1), (1, 2)], output)
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    return results, elapsed, lines
+
+
+def test_reviews_succeed(monkeypatch):
+    results, elapsed, lines = run(monkeypatch, FakeProvider(latency=0))
+    assert [line["status"] for line in lines] == ["ok", "ok"]
+    assert "(0 failed)" in summarize(results, elapsed)
+
+
+def test_failed_actions_fail_the_review(monkeypatch):
+    results, elapsed, lines = run(monkeypatch, DownProvider(latency=0))
+    assert [line["status"] for line in lines] == ["error", "error"]
+    assert all(
+        "review_code: provider is down" in line["error"]
+        and "summarize: provider is down" in line["error"]
+        for line in lines
+    )
+    assert "(2 failed)" in summarize(results, elapsed)
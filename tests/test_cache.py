@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import pytest
+from providers import CachedProvider, CompletionResponse, LLMProvider
+
+
+class SlowProvider(LLMProvider):
+    """Provider counting its calls, each one taking a while."""
+
+    name = "slow"
+    max_tokens = 1000
+
+    def __init__(self, error: Optional[Exception] = None):
+        self.calls = 0
+        self.error = error
+        self._lock = threading.Lock()
+
+    def completion(self, prompt, prefix="", schema=None):
+        with self._lock:
+            self.calls += 1
+        time.sleep(0.2)
+        if self.error is not None:
+            raise self.error
+        return CompletionResponse(text=f"answer to {prompt}", tokens_used=10)
+
+    def stream(self, prompt, on_text, prefix="", schema=None):
+        result = self.completion(prompt, prefix, schema)
+        on_text(result.text)
+        return result
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "completions.sqlite")
+
+
+def test_concurrent_identical_lookups_make_one_call(path):
+    provider = SlowProvider()
+    cache = CachedProvider(provider, path)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda _: cache.completion("review"), range(8)))
+
+    assert provider.calls == 1
+    assert {result.text for result in results} == {"answer to review"}
+    # Only the call that reached the provider cost tokens
+    assert sorted(result.tokens_used for result in results) == [0] * 7 + [10]
+    assert (cache.misses, cache.hits) == (1, 7)
+
+    # Later lookups are served from the disk
+    assert cache.completion("review").tokens_used == 0
+    assert CachedProvider(provider, path).completion("review").text == (
+        "answer to review"
+    )
+    assert provider.calls == 1
+
+
+def test_concurrent_async_lookups_make_one_call(path):
+    provider = SlowProvider()
+    cache = CachedProvider(provider, path)
+    pieces = []
+
+    async def lookups():
+        return await asyncio.gather(
+            *(cache.astream("review", pieces.append) for _ in range(5)),
+            cache.acompletion("other"),
+        )
+
+    results = asyncio.run(lookups())
+    assert provider.calls == 2
+    assert [result.text for result in results[:5]] == ["answer to review"] * 5
+    assert pieces == ["answer to review"] * 5
+
+
+def test_failures_are_shared_but_not_cached(path):
+    provider = SlowProvider(ConnectionError("provider is down"))
+    cache = CachedProvider(provider, path)
+
+    def lookup(_):
+        try:
+            return cache.completion("review")
+        except ConnectionError as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lookup, range(4)))
+    assert provider.calls == 1
+    assert all(isinstance(result, ConnectionError) for result in results)
+
+    provider.error = None
+    assert cache.completion("review").tokens_used == 10
+    assert provider.calls == 2
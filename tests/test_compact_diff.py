@@ -0,0 +1,93 @@
+from repository import render_compact_diff
+
+DIFF = """diff --git a/app.py b/app.py
+--- a/app.py
++++ b/app.py
+@@ -10,12 +10,13 @@ def run():
+ a
+ b
+ c
+-old1
+-old2
++new1
+ d
+ e
+ f
+ g
++new2
++new3
+ h
+-old3
+ i
+@@ -40,2 +41,3 @@
+ x
++y
+ z
+\\ No newline at end of file
+"""
+
+
+def test_line_numbers_across_mixed_runs():
+    assert render_compact_diff(DIFF) == (
+        "@@ def run():\n"
+        " c\n"
+        "-(2 lines removed)\n"
+        "13+new1\n"
+        " d\n"
+        "@@\n"
+        " g\n"
+        "18+new2\n"
+        "19+new3\n"
+        " h\n"
+        "-(1 line removed)\n"
+        " i\n"
+        "@@\n"
+        " x\n"
+        "42+y\n"
+        " z\n"
+    )
+
+
+def test_without_context():
+    assert render_compact_diff(DIFF, context=0) == (
+        "@@ def run():\n"
+        "-(2 lines removed)\n"
+        "13+new1\n"
+        "@@\n"
+        "18+new2\n"
+        "19+new3\n"
+        "@@\n"
+        "-(1 line removed)\n"
+        "@@\n"
+        "42+y\n"
+    )
+
+
+def test_numbers_match_the_new_file():
+    old = [f"line {n}" for n in range(1, 21)]
+    new = old[:4] + ["added a"] + old[4:9] + old[12:15] + ["added b", "added c"]
+    new += old[15:]
+    diff = (
+        "@@ -3,14 +3,15 @@\n"
+        + "\n".join(f" {line}" for line in old[2:4])
+        + "\n+added a\n"
+        + "\n".join(f" {line}" for line in old[4:9])
+        + "\n-line 10\n-line 11\n-line 12\n"
+        + "\n".join(f" {line}" for line in old[12:15])
+        + "\n+added b\n+added c\n"
+        + "\n".join(f" {line}" for line in old[15:17])
+        + "\n"
+    )
+    for context in (0, 1, 3):
+        added = [
+            line.split("+", 1)
+            for line in render_compact_diff(diff, context).splitlines()
+            if line[:1].isdigit()
+        ]
+        assert added == [["5", "added a"], ["14", "added b"], ["15", "added c"]]
+        assert all(new[int(n) - 1] == text for n, text in added)
+
+
+def test_diffs_without_hunks_are_kept():
+    stat = "Binary files a/logo.png and b/logo.png differ\n"
+    assert render_compact_diff(stat) == stat
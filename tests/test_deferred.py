@@ -0,0 +1,146 @@
+import sqlite3
+import pytest
+import requests
+import deferred
+from fakes import FakeBatchAPI, FakeGitLab, MergeRequestSpec
+from providers import CompletionResponse, get_provider_class
+from providers.batches import BatchStore
+from repository import GitLabRepository
+from rules import Rule
+
+RULES = [
+    Rule("naming.md", "Naming", "", "true", "Use descriptive names"),
+    Rule("format.title.md", "Title", "", "false", "Titles start with a verb"),
+]
+
+ACTIONS = ["review_code", "review_format"]
+
+
+@pytest.fixture
+def gitlab(monkeypatch):
+    with FakeGitLab(MergeRequestSpec(files=5)) as gitlab:
+        monkeypatch.setenv("GITLAB_HOST", gitlab.url)
+        monkeypatch.setenv("GITLAB_TOKEN", "test")
+        yield gitlab
+
+
+@pytest.fixture(params=["openai", "anthropic"])
+def provider(request, monkeypatch):
+    with FakeBatchAPI() as api:
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setenv("OPENAI_BASE_URL", api.url + "/v1")
+        monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+        monkeypatch.setenv("ANTHROPIC_BASE_URL", api.url)
+        yield get_provider_class(request.param)()
+
+
+def discussions(gitlab):
+    url = f"{gitlab.url}/api/v4/projects/1/merge_requests/1/discussions"
+    return requests.get(url).json()
+
+
+def test_submit_collect_and_post(gitlab, provider, tmp_path):
+    repository = GitLabRepository()
+    store = BatchStore(str(tmp_path / "batches.sqlite"))
+
+    batch_ids = deferred.submit([(1, 1)], ACTIONS, provider, repository, RULES, store)
+    assert len(batch_ids) == 1
+
+    # The batch is still running on the first poll
+    assert deferred.collect(repository, RULES, store, post=True) == (0, 1)
+
+    tokens_used, running = deferred.collect(repository, RULES, store, post=True)
+    assert tokens_used > 0 and running == 0
+    assert store.pending() == []
+    assert discussions(gitlab)
+
+
+def test_failed_actions_keep_the_batch_pending(gitlab, provider, tmp_path, monkeypatch):
+    repository = GitLabRepository()
+    store = BatchStore(str(tmp_path / "batches.sqlite"))
+    (batch_id,) = deferred.submit([(1, 1)], ACTIONS, provider, repository, RULES, store)
+    assert provider.get_batch_results(batch_id) is None
+    results = provider.get_batch_results(batch_id)
+    assert len(results) == len(store.contexts(batch_id))
+
+    get_action = deferred.get_action
+
+    def failing_format(name, *args, **kwargs):
+        if name == "review_format":
+            raise RuntimeError("GitLab is down")
+        return get_action(name, *args, **kwargs)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(deferred, "get_action", failing_format)
+        result = deferred.process_results(
+            batch_id, results, provider, repository, RULES, store, post=True
+        )
+    assert not result.ok and "GitLab is down" in result.error
+    assert result.tokens_used > 0
+    # Only the request of the failed action is left to handle
+    assert [c["action"] for c in store.contexts(batch_id).values()] == ["review_format"]
+    posted = len(discussions(gitlab))
+
+    result = deferred.process_results(
+        batch_id, results, provider, repository, RULES, store, post=True
+    )
+    assert result.ok and store.contexts(batch_id) == {}
+    assert len(discussions(gitlab)) == posted
+
+
+def test_failed_actions_are_given_up_after_max_attempts(
+    gitlab, provider, tmp_path, monkeypatch
+):
+    repository = GitLabRepository()
+    store = BatchStore(str(tmp_path / "batches.sqlite"))
+    (batch_id,) = deferred.submit([(1, 1)], ACTIONS, provider, repository, RULES, store)
+    provider.get_batch_results(batch_id)
+    results = provider.get_batch_results(batch_id)
+
+    def down(name, *args, **kwargs):
+        raise RuntimeError("GitLab is down")
+
+    monkeypatch.setattr(deferred, "get_action", down)
+    monkeypatch.setattr(deferred, "MAX_ATTEMPTS", 2)
+    args = (batch_id, results, provider, repository, RULES, store)
+    assert not deferred.process_results(*args).ok
+    assert len(store.contexts(batch_id)) == len(results)
+    # The second attempt is the last, the batch can be collected
+    assert deferred.process_results(*args).ok
+    assert store.contexts(batch_id) == {}
+
+
+def test_unparseable_results_are_not_retried(gitlab, provider, tmp_path):
+    repository = GitLabRepository()
+    store = BatchStore(str(tmp_path / "batches.sqlite"))
+    (batch_id,) = deferred.submit([(1, 1)], ACTIONS, provider, repository, RULES, store)
+    contexts = store.contexts(batch_id)
+    results = {
+        custom_id: CompletionResponse(text="Sorry, I can't.", tokens_used=10)
+        for custom_id in contexts
+    }
+    # The completion of one chunk is missing
+    results[next(iter(contexts))] = None
+
+    result = deferred.process_results(
+        batch_id, results, provider, repository, RULES, store, post=True
+    )
+    assert result.ok and result.tokens_used == 10 * (len(results) - 1)
+    assert store.contexts(batch_id) == {}
+    assert discussions(gitlab) == []
+
+
+def test_stores_of_older_versions_count_attempts(tmp_path):
+    path = str(tmp_path / "batches.sqlite")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE requests (batch_id TEXT NOT NULL, custom_id TEXT NOT NULL, "
+        "context TEXT NOT NULL, PRIMARY KEY (batch_id, custom_id))"
+    )
+    db.execute("INSERT INTO requests VALUES ('batch', 'a', '{}')")
+    db.commit()
+    db.close()
+
+    store = BatchStore(path)
+    assert store.failed("batch", ["a"]) == 1
+    assert store.failed("batch", ["a"]) == 2
@@ -0,0 +1,100 @@
+import asyncio
+import time
+from typing import Callable, Optional
+from providers import CompletionResponse, LLMProvider
+from providers.failover import MIN_SAMPLES, FailoverProvider
+
+
+class TimedProvider(LLMProvider):
+    """Provider answering its name after a delay, streamed in a few pieces."""
+
+    max_tokens = 1000
+
+    def __init__(self, name: str, delay: float):
+        self.name = name
+        self.delay = delay
+        self.streamed = 0
+        self.stopped: Optional[str] = None
+
+    def completion(self, prompt, prefix="", schema=None):
+        time.sleep(self.delay)
+        return CompletionResponse(text=self.name, tokens_used=1)
+
+    def stream(self, prompt, on_text: Callable[[str], None], prefix="", schema=None):
+        time.sleep(self.delay)
+        for _ in range(3):
+            try:
+                on_text(self.name)
+            except Exception as e:
+                self.stopped = type(e).__name__
+                raise
+            self.streamed += 1
+        return CompletionResponse(text=self.name * 3, tokens_used=3)
+
+    async def _astream(self, prompt, on_text, prefix="", schema=None):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.stopped = "CancelledError"
+            raise
+        on_text(self.name)
+        return CompletionResponse(text=self.name, tokens_used=1)
+
+
+def failover(primary_delay: float, secondary_delay: float) -> FailoverProvider:
+    """Failover whose primary usually answers in 50 ms, it's hedged after that."""
+    provider = FailoverProvider(
+        [
+            TimedProvider("primary", primary_delay),
+            TimedProvider("secondary", secondary_delay),
+        ]
+    )
+    provider.backends[0].latencies.extend([0.05] * MIN_SAMPLES)
+    return provider
+
+
+def test_no_hedge_before_the_percentile():
+    provider = failover(0.01, 0.01)
+    assert provider.completion("prompt").text == "primary"
+    primary, secondary = provider.backends
+    assert primary.hedges == 0 and secondary.calls == 0
+
+
+def test_hedge_after_the_percentile():
+    provider = failover(1.0, 0.01)
+    start = time.monotonic()
+    assert provider.completion("prompt").text == "secondary"
+    assert time.monotonic() - start < 0.5
+    primary, secondary = provider.backends
+    assert primary.hedges == 1 and secondary.calls == 1
+
+
+def test_streamed_loser_is_abandoned():
+    provider = failover(0.3, 0.01)
+    pieces = []
+    result = provider.stream("prompt", pieces.append)
+    assert result.text == "secondary" * 3
+
+    # The primary stops at its first piece, after the secondary answered
+    primary = provider.backends[0].provider
+    deadline = time.monotonic() + 2
+    while primary.stopped is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert primary.stopped == "Abandoned" and primary.streamed == 0
+    assert pieces == ["secondary"] * 3
+
+
+def test_async_loser_is_cancelled():
+    provider = failover(1.0, 0.01)
+    primary, secondary = provider.backends
+    pieces = []
+
+    async def race():
+        result = await provider.astream("prompt", pieces.append)
+        # Let the cancelled attempt run its handler, before the loop closes
+        await asyncio.sleep(0)
+        return result, primary.provider.stopped
+
+    result, stopped = asyncio.run(race())
+    assert result.text == "secondary" and pieces == ["secondary"]
+    assert primary.hedges == 1 and stopped == "CancelledError"
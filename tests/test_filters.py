@@ -0,0 +1,71 @@
+import pytest
+from actions.budget import change_stats
+from repository import CodeChange, NoiseFilter, get_token_counter
+
+REINDENT = (
+    "@@ -1,3 +1,3 @@ def run():\n-    if x:\n-        return 1\n+if x:\n+    return 1\n"
+)
+
+
+def trim(path: str, diff: str):
+    return NoiseFilter().trim(CodeChange(path, diff))
+
+
+@pytest.mark.parametrize("path", ["app.py", "config.yaml", "Makefile"])
+def test_reindent_is_kept_where_indentation_is_syntax(path):
+    change, removed = trim(path, REINDENT)
+    assert change is not None and removed == 0
+
+
+def test_reindent_is_dropped_elsewhere():
+    change, removed = trim("app.js", REINDENT)
+    assert change is None and removed == 1
+
+
+def test_tabs_expanded_to_the_same_indentation_are_whitespace():
+    diff = "@@ -1,1 +1,1 @@\n-\tpass\n+        pass\n"
+    assert trim("app.py", diff) == (None, 1)
+
+
+def test_whitespace_inside_a_line_is_kept():
+    diff = "@@ -1,1 +1,1 @@\n-name = 'a b'\n+name = 'a  b'\n"
+    change, removed = trim("app.js", diff)
+    assert change is not None and removed == 0
+
+
+def test_removed_comment_lines_are_content():
+    # Removing the SQL comment "-- note" gives the diff line "--- note"
+    diff = "@@ -1,3 +1,2 @@\n--- note\n-  SELECT 1\n+SELECT 1\n"
+    change, removed = trim("query.sql", diff)
+    assert change is not None and removed == 0
+    assert change_stats(CodeChange("query.sql", diff)) == (1, 2)
+
+
+def test_file_headers_are_not_content():
+    diff = "--- a/query.sql\n+++ b/query.sql\n@@ -1,1 +1,1 @@\n-  SELECT 1\n+SELECT 1\n"
+    assert trim("query.sql", diff) == (None, 1)
+    assert change_stats(CodeChange("query.sql", diff)) == (1, 1)
+
+
+def test_only_the_whitespace_hunks_are_trimmed():
+    diff = REINDENT + "@@ -10,1 +10,1 @@\n-return 1\n+return 2\n"
+    change, removed = trim("app.js", diff)
+    assert removed == 1 and change.diff == "@@ -10,1 +10,1 @@\n-return 1\n+return 2\n"
+
+
+def test_changes_filtered_one_by_one_save_the_same_tokens():
+    changes = [
+        CodeChange("package-lock.json", '@@ -1,1 +1,1 @@\n-"a": 1\n+"a": 2\n'),
+        CodeChange("app.js", REINDENT + "@@ -10,1 +10,1 @@\n-return 1\n+return 2\n"),
+        CodeChange("style.css", REINDENT),
+        CodeChange("app.py", REINDENT),
+    ]
+    result = NoiseFilter().apply(changes)
+    assert [change.path for change in result.changes] == ["app.js", "app.py"]
+    assert [reason for _, reason in result.removed] == ["lockfile", "whitespace"]
+    assert result.hunks_removed == 2
+
+    counter = get_token_counter()
+    assert result.tokens_saved == sum(counter.count_changes(changes)) - sum(
+        counter.count_changes(result.changes)
+    )
@@ -0,0 +1,29 @@
+import pytest
+from fakes import FakeGitLab, MergeRequestSpec
+from repository import GitLabRepository
+
+
+@pytest.fixture
+def repository(monkeypatch):
+    with FakeGitLab(MergeRequestSpec(files=250, hunk="small")) as gitlab:
+        monkeypatch.setenv("GITLAB_HOST", gitlab.url)
+        monkeypatch.setenv("GITLAB_TOKEN", "test")
+        yield GitLabRepository()
+
+
+def test_changes_are_kept_as_they_download(repository):
+    paths = []
+
+    def keep(change):
+        paths.append(change.path)
+        return change if change.path.endswith(".py") else None
+
+    cr = repository.get_code_request(1, 1, keep)
+    everything = repository.get_code_request(1, 1)
+
+    assert paths == [change.path for change in everything.changes]
+    assert len(everything.changes) == 250
+    assert [change.path for change in cr.changes] == [
+        path for path in paths if path.endswith(".py")
+    ]
+    assert all(change.refs is cr.diff_refs for change in cr.changes)
@@ -0,0 +1,56 @@
+import pytest
+from providers.helpers import JsonArrayParser, parse_json
+
+STREAMED = (
+    "Here are the findings (see [1]):\n```json\n"
+    '[{"line": 1, "reason": "a ]} in a string"},\n'
+    ' {"line": 2, "reason": "an escaped \\" quote", "tags": [1, {"x": 2}]},\n'
+    " {line: 3, reason: 'json5',},\n"
+    " {not json},\n"
+    ' {"line": 4, "reason": "last"}]\n```\nAnd [this] is ignored.'
+)
+
+EXPECTED = [
+    {"line": 1, "reason": "a ]} in a string"},
+    {"line": 2, "reason": 'an escaped " quote', "tags": [1, {"x": 2}]},
+    {"line": 3, "reason": "json5"},
+    {"line": 4, "reason": "last"},
+]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(STREAMED)])
+def test_array_parser_chunked_feed(size):
+    parser = JsonArrayParser()
+    items = []
+    for start in range(0, len(STREAMED), size):
+        items.extend(parser.feed(STREAMED[start : start + size]))
+    assert items == EXPECTED
+    assert parser.done and parser.count == 5
+
+
+def test_array_parser_returns_objects_as_soon_as_closed():
+    parser = JsonArrayParser()
+    assert parser.feed('[{"a": 1}, {"b"') == [{"a": 1}]
+    assert parser.feed(": 2}") == [{"b": 2}]
+    assert parser.feed("]") == []
+    assert parser.feed('[{"c": 3}]') == []
+
+
+def test_parse_json_fenced():
+    text = 'Sure:\n```json\n{"results": [{"a": 1}]}\n```\nSee [1] for details.'
+    assert parse_json(text) == {"results": [{"a": 1}]}
+
+
+def test_parse_json_prefixed_with_prose():
+    text = 'The review (see [1] and {2}) found: [{"a": 1}, {"b": [2]}] in total.'
+    assert parse_json(text) == [{"a": 1}, {"b": [2]}]
+
+
+def test_parse_json_falls_back_to_json5():
+    text = "Findings:\n[{line: 1, // a comment\n 'reason': 'x',},]"
+    assert parse_json(text) == [{"line": 1, "reason": "x"}]
+
+
+def test_parse_json_without_json():
+    with pytest.raises(Exception):
+        parse_json("No findings.")
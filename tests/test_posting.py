@@ -0,0 +1,62 @@
+from actions.posting import DiscussionPoster, post_discussions
+from repository import CodeRequest
+
+
+class Repository:
+    """Repository stub counting the discussions fetched and posted."""
+
+    def __init__(self, discussions=None, fetch_error=None):
+        self.discussions = discussions or []
+        self.fetch_error = fetch_error
+        self.fetches = 0
+        self.posted = []
+
+    def get_code_request_discussions(self, project_id, mr_id):
+        self.fetches += 1
+        if self.fetch_error is not None:
+            raise self.fetch_error
+        return self.discussions
+
+    def post_code_request_discussion(self, project_id, mr_id, comment, position):
+        if comment == "fails":
+            raise RuntimeError("403 Forbidden")
+        self.posted.append(comment)
+
+
+CR = CodeRequest("Title", "", [], 1, 1, "main")
+
+
+def position(line):
+    return {"new_path": "app.py", "new_line": line}
+
+
+def test_existing_and_duplicate_discussions_are_skipped():
+    existing = [{"notes": [{"body": "Rename x.", "position": position(1)}]}]
+    repository = Repository(existing)
+    report = post_discussions(
+        repository,
+        CR,
+        [
+            ("rename x", position(1)),
+            ("Use a constant", position(2)),
+            ("use a constant!", position(2)),
+            ("fails", position(3)),
+        ],
+        concurrency=1,
+    )
+    assert repository.posted == ["Use a constant"]
+    assert (report.posted, report.skipped) == (1, 2)
+    assert [comment for comment, _ in report.errors] == ["fails"]
+    assert repository.fetches == 1
+
+
+def test_failed_fetch_is_reported_once_per_discussion():
+    repository = Repository(fetch_error=ConnectionError("GitLab is down"))
+    poster = DiscussionPoster(repository, CR)
+    for line in range(5):
+        poster.submit(f"Finding {line}", position(line))
+
+    report = poster.close()
+    assert repository.fetches == 1 and repository.posted == []
+    assert len(report.errors) == 5
+    assert all(isinstance(error, ConnectionError) for _, error in report.errors)
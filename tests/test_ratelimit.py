@@ -0,0 +1,74 @@
+import pytest
+from providers import ratelimit
+from providers.ratelimit import TokenBucket
+
+
+class Clock:
+    """Stand-in of the time module whose time only moves when advanced."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+def test_refill_and_debt(clock, tmp_path):
+    # 100 tokens and a request per second
+    bucket = TokenBucket(str(tmp_path / "ratelimit.sqlite"), "openai/gpt", 60, 6000)
+
+    assert bucket.take(5000) == 0
+    assert bucket.take(2000) == pytest.approx(10)
+
+    # The request used more than charged, the bucket is in debt
+    bucket.reconcile(5000, 8000)
+    assert bucket.take(100) == pytest.approx(21)
+    clock.advance(21)
+    assert bucket.take(100) == 0
+
+    # Tokens charged but not used are given back
+    bucket.reconcile(100, 0)
+    assert bucket.take(100) == 0
+    assert bucket.take(1) == pytest.approx(0.01)
+
+    # The bucket refills up to a minute of tokens, larger requests take it all
+    clock.advance(600)
+    assert bucket.take(10000) == 0
+    assert bucket.take(1) == pytest.approx(0.01)
+
+
+def test_requests_per_minute(clock, tmp_path):
+    bucket = TokenBucket(str(tmp_path / "ratelimit.sqlite"), "anthropic/claude", 2)
+
+    assert bucket.take(100) == 0
+    assert bucket.take(100) == 0
+    assert bucket.take(100) == pytest.approx(30)
+    clock.advance(15)
+    assert bucket.take(100) == pytest.approx(15)
+    clock.advance(15)
+    assert bucket.take(100) == 0
+    # Tokens are not limited without a TPM
+    bucket.reconcile(0, 1000000)
+    clock.advance(30)
+    assert bucket.take(100) == 0
+
+
+def test_buckets_are_shared_by_key(clock, tmp_path):
+    path = str(tmp_path / "ratelimit.sqlite")
+    first = TokenBucket(path, "openai/gpt", tpm=600)
+    second = TokenBucket(path, "openai/gpt", tpm=600)
+    other = TokenBucket(path, "openai/other", tpm=600)
+
+    assert first.take(600) == 0
+    assert second.take(60) == pytest.approx(6)
+    assert other.take(600) == 0
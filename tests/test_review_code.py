@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+import requests
+from actions import ReviewCodeAction
+from fakes import FakeGitLab, FakeProvider, MergeRequestSpec
+from repository import GitLabRepository
+from rules import Rule
+
+RULES = [Rule("naming.md", "Naming", "", "true", "Use descriptive names")]
+
+
+class FailingProvider(FakeProvider):
+    """Fake provider with a small context, failing the chunk of one file."""
+
+    def __init__(self, path: str):
+        super().__init__(latency=0, tokens_per_second=1e9, context_window=8000)
+        self.path = path
+
+    def respond(self, prompt: str, prefix: str = "") -> str:
+        if self.path in prefix:
+            raise ConnectionError("provider is down")
+        return super().respond(prompt, prefix)
+
+
+@pytest.fixture
+def gitlab(monkeypatch):
+    with FakeGitLab(MergeRequestSpec(files=20, hunk="large")) as gitlab:
+        monkeypatch.setenv("GITLAB_HOST", gitlab.url)
+        monkeypatch.setenv("GITLAB_TOKEN", "test")
+        yield gitlab
+
+
+def discussions(gitlab):
+    url = f"{gitlab.url}/api/v4/projects/1/merge_requests/1/discussions"
+    return requests.get(url, params={"per_page": 100}).json()
+
+
+@pytest.mark.parametrize("run_async", [False, True])
+def test_failed_chunk_keeps_the_others(gitlab, run_async):
+    repository = GitLabRepository()
+    cr = repository.get_code_request(1, 1)
+    provider = FailingProvider(cr.changes[0].path)
+    action = ReviewCodeAction(provider, repository, RULES)
+    assert len(action.split(cr)) > 2
+
+    if run_async:
+        result = asyncio.run(action.arun(cr, post=True))
+    else:
+        result = action.run(cr, post=True)
+
+    assert not result.ok and "provider is down" in result.error
+    assert result.tokens_used > 0
+    posted = [d["notes"][0]["position"]["new_path"] for d in discussions(gitlab)]
+    assert posted and cr.changes[0].path not in posted
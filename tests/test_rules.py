@@ -0,0 +1,69 @@
+import pytest
+from rules import Rule, RuleIndex, parse_rule_file
+
+
+def rule(globs: str, filename: str = "rule.md") -> Rule:
+    return Rule(filename, "A rule", globs, "false", "Follow the rule")
+
+
+def test_patterns_split_on_top_level_commas_only():
+    assert rule("**/*.{ts,tsx}, docs/**").patterns == ["**/*.{ts,tsx}", "docs/**"]
+    assert rule('["src/{a,b}/*.py", "*.md"]').patterns == ["src/{a,b}/*.py", "*.md"]
+
+
+@pytest.mark.parametrize(
+    "path, applies",
+    [
+        ("app.ts", True),
+        ("src/ui/button.tsx", True),
+        ("src/ui/button.js", False),
+        ("src/ui/button.tsx.map", False),
+    ],
+)
+def test_brace_glob_matches_each_alternative(path, applies):
+    assert rule("**/*.{ts,tsx}").applies_to(path) is applies
+
+
+@pytest.mark.parametrize(
+    "path, applies",
+    [
+        ("src/api/handler.py", True),
+        ("src/web/views/index.py", True),
+        ("src/web/index.py", False),
+        ("src/db/models.py", False),
+        ("lib/api/handler.py", False),
+    ],
+)
+def test_nested_brace_globs(path, applies):
+    assert rule("src/{api,web/{views,forms}}/*.py").applies_to(path) is applies
+
+
+def test_unclosed_brace_is_literal():
+    assert rule("src/{a.py").applies_to("src/{a.py")
+    assert not rule("src/{a.py").applies_to("src/a.py")
+
+
+def test_index_groups_by_brace_globs():
+    rules = [
+        rule("**/*.{ts,tsx}", "typescript.md"),
+        rule("**/*.{py,pyi}", "python.md"),
+        Rule("naming.md", "Naming", "", "true", "Use descriptive names"),
+    ]
+    groups = RuleIndex(rules).group(["a.ts", "b.py", "c.tsx", "d.pyi", "e.go"])
+    assert [([r.filename for r in rules], members) for rules, members in groups] == [
+        (["typescript.md", "naming.md"], [0, 2]),
+        (["python.md", "naming.md"], [1, 3]),
+        (["naming.md"], [4]),
+    ]
+
+
+def test_rule_file_with_brace_globs(tmp_path):
+    path = tmp_path / "typescript.md"
+    path.write_text(
+        "---\ndescription: TypeScript\nglobs: src/**/*.{ts,tsx}, test/*.ts\n"
+        "alwaysApply: false\n---\nPrefer interfaces over types\n"
+    )
+    parsed = parse_rule_file(str(path))
+    assert parsed.patterns == ["src/**/*.{ts,tsx}", "test/*.ts"]
+    assert parsed.applies_to("src/a/b.tsx") and parsed.applies_to("test/c.ts")
+    assert not parsed.applies_to("test/c.tsx")